@@ -94,7 +94,9 @@ if __name__ == '__main__':
                         resp = analyzer.get_evoked_responses(pre_id, post_id, 
                             clamp_mode='ic', 
                             min_duration=25e-3, 
-                            pulse_ids=[1]
+                            pulse_ids=[1],
+                            accumulate=True,
+                            keep_traces=False,
                         )
                         avg = resp.bsub_mean()
                         cretypes = (pre_cell.cre_type, post_cell.cre_type)
@@ -138,7 +140,7 @@ if __name__ == '__main__':
         for j, post_type in enumerate(types):
 
             # collect average 
-            rg = EvokedResponseGroup(None, None)
+            rg = EvokedResponseGroup(None, None, accumulate=True, keep_traces=False)
             for expt,conns in cache.items():
                 for conn in conns:
                     if conn['types'] != (pre_type, post_type):
@@ -0,0 +1,320 @@
+"""
+Measurement of pulse response strength, used by strength_analysis.
+
+These functions operate on plain arrays / Traces and do not access the database,
+so they can be used (and tested) without a database connection.
+"""
+from __future__ import print_function, division
+
+import numpy as np
+import scipy.signal
+
+from neuroanalysis.data import Trace
+from neuroanalysis import filter
+from neuroanalysis.event_detection import exp_deconvolve
+from neuroanalysis.baseline import float_mode
+
+
+# sample rate of traces stored in the database (see database.default_sample_rate)
+default_sample_rate = 20000
+
+
+def measure_peak(trace, sign, spike_time, pulse_times, spike_delay=1e-3, response_window=4e-3):
+    # Start measuring response after the pulse has finished, and no earlier than 1 ms after spike onset
+    # response_start = max(spike_time + spike_delay, pulse_times[1])
+
+    # Start measuring after spike and hope that the pulse offset doesn't get in the way
+    # (if we wait for the pulse to end, then we miss too many fast rise / short latency events)
+    response_start = spike_time + spike_delay
+    response_stop = response_start + response_window
+
+    # measure baseline from beginning of data until 50µs before pulse onset
+    baseline_start = 0
+    baseline_stop = pulse_times[0] - 50e-6
+
+    baseline = float_mode(trace.time_slice(baseline_start, baseline_stop).data)
+    response = trace.time_slice(response_start, response_stop)
+
+    if sign == '+':
+        i = np.argmax(response.data)
+    else:
+        i = np.argmin(response.data)
+    peak = response.data[i]
+    latency = response.time_values[i] - spike_time
+    return peak - baseline, latency
+
+
+def measure_sum(trace, sign, baseline=(0e-3, 9e-3), response=(12e-3, 17e-3)):
+    baseline = trace.time_slice(*baseline).data.sum()
+    peak = trace.time_slice(*response).data.sum()
+    return peak - baseline
+
+        
+def deconv_filter(trace, pulse_times, tau=15e-3, lowpass=1000., lpf=True, remove_artifacts=False, bsub=True):
+    dec = exp_deconvolve(trace, tau)
+
+    if remove_artifacts:
+        # after deconvolution, the pulse causes two sharp artifacts; these
+        # must be removed before LPF
+        cleaned = remove_crosstalk_artifacts(dec, pulse_times)
+    else:
+        cleaned = dec
+
+    if bsub:
+        baseline = np.median(cleaned.time_slice(cleaned.t0+5e-3, cleaned.t0+10e-3).data)
+        b_subbed = cleaned-baseline
+    else:
+        b_subbed = cleaned
+
+    if lpf:
+        return filter.bessel_filter(b_subbed, lowpass)
+    else:
+        return b_subbed
+
+
+def remove_crosstalk_artifacts(data, pulse_times):
+    dt = data.dt
+    r = [-50e-6, 250e-6]
+    edges = [(int((t+r[0])/dt), int((t+r[1])/dt)) for t in pulse_times]
+    # If window is too shortm then it becomes seneitive to sample noise.
+    # If window is too long, then it becomes sensitive to slower signals (like the AP following pulse onset)
+    return filter.remove_artifacts(data, edges, window=100e-6)
+
+
+def analyze_response_strength(rec, source, remove_artifacts=False, lpf=True, bsub=True, lowpass=1000):
+    """Perform a standardized strength analysis on a record selected by response_query or baseline_query.
+
+    1. Determine timing of presynaptic stimulus pulse edges and spike
+    2. Measure peak deflection on raw trace
+    3. Apply deconvolution / artifact removal / lpf
+    4. Measure peak deflection on deconvolved trace
+    """
+    data = Trace(rec.data, sample_rate=default_sample_rate)
+    if source == 'pulse_response':
+        # Find stimulus pulse edges for artifact removal
+        start = rec.pulse_start - rec.rec_start
+        pulse_times = [start, start + rec.pulse_dur]
+        if rec.spike_time is None:
+            # these pulses failed QC, but we analyze them anyway to make all data visible
+            spike_time = 11e-3
+        else:
+            spike_time = rec.spike_time - rec.rec_start
+    elif source == 'baseline':
+        # Fake stimulus information to ensure that background data receives
+        # the same filtering / windowing treatment
+        pulse_times = [10e-3, 12e-3]
+        spike_time = 11e-3
+    else:
+        raise ValueError("Invalid source %s" % source)
+
+    results = {}
+
+    results['raw_trace'] = data
+    results['pulse_times'] = pulse_times
+    results['spike_time'] = spike_time
+
+    # Measure crosstalk from pulse onset
+    p1 = data.time_slice(pulse_times[0]-200e-6, pulse_times[0]).median()
+    p2 = data.time_slice(pulse_times[0], pulse_times[0]+200e-6).median()
+    results['crosstalk'] = p2 - p1
+
+    # crosstalk artifacts in VC are removed before deconvolution
+    if rec.clamp_mode == 'vc' and remove_artifacts is True:
+        data = remove_crosstalk_artifacts(data, pulse_times)
+        remove_artifacts = False
+
+    # Measure deflection on raw data
+    results['pos_amp'], _ = measure_peak(data, '+', spike_time, pulse_times)
+    results['neg_amp'], _ = measure_peak(data, '-', spike_time, pulse_times)
+
+    # Deconvolution / artifact removal / filtering
+    tau = 15e-3 if rec.clamp_mode == 'ic' else 5e-3
+    dec_data = deconv_filter(data, pulse_times, tau=tau, lpf=lpf, remove_artifacts=remove_artifacts, bsub=bsub, lowpass=lowpass)
+    results['dec_trace'] = dec_data
+
+    # Measure deflection on deconvolved data
+    results['pos_dec_amp'], results['pos_dec_latency'] = measure_peak(dec_data, '+', spike_time, pulse_times)
+    results['neg_dec_amp'], results['neg_dec_latency'] = measure_peak(dec_data, '-', spike_time, pulse_times)
+
+    return results
+
+
+strength_fields = ['pos_amp', 'neg_amp', 'pos_dec_amp', 'neg_dec_amp', 'pos_dec_latency', 'neg_dec_latency', 'crosstalk']
+
+
+def strength_inputs(recs, source):
+    """Collect the stimulus timing and clamp mode needed by analyze_response_strength_batch
+    from records selected by response_query or baseline_query.
+
+    Returns (data, n_samples, pulse_times, spike_times, clamp_modes), where *data* is a
+    2D array of traces padded to the length of the longest trace.
+    """
+    n = len(recs)
+    n_samples = np.array([len(rec.data) for rec in recs], dtype=int)
+    data = np.zeros((n, n_samples.max() if n > 0 else 0))
+    for i,rec in enumerate(recs):
+        data[i, :n_samples[i]] = rec.data
+
+    clamp_modes = np.array([rec.clamp_mode for rec in recs])
+    if source == 'pulse_response':
+        rec_start = np.array([rec.rec_start for rec in recs], dtype=float)
+        start = np.array([rec.pulse_start for rec in recs], dtype=float) - rec_start
+        pulse_times = np.column_stack([start, start + np.array([rec.pulse_dur for rec in recs], dtype=float)])
+        # pulses that failed QC have no spike, but we analyze them anyway to make all data visible
+        spike_times = np.array([11e-3 if rec.spike_time is None else rec.spike_time - rec.rec_start for rec in recs], dtype=float)
+    elif source == 'baseline':
+        # Fake stimulus information to ensure that background data receives
+        # the same filtering / windowing treatment
+        pulse_times = np.tile([10e-3, 12e-3], (n, 1))
+        spike_times = np.full(n, 11e-3)
+    else:
+        raise ValueError("Invalid source %s" % source)
+
+    return data, n_samples, pulse_times, spike_times, clamp_modes
+
+
+def analyze_response_strength_batch(data, pulse_times, spike_times, clamp_modes, n_samples=None, lpf=True, bsub=True, lowpass=1000):
+    """Vectorized version of analyze_response_strength for many records at once.
+
+    Produces the same *strength_fields* as analyze_response_strength (without
+    artifact removal), but processes a whole block of traces with array operations
+    along axis 1 instead of building a Trace for every record.
+
+    Parameters
+    ----------
+    data : array
+        2D array (n_records, n_samples) of traces sampled at default_sample_rate.
+    pulse_times : array
+        (n_records, 2) array of stimulus pulse onset/offset times relative to the start of each trace.
+    spike_times : array
+        Presynaptic spike time for each record, relative to the start of each trace.
+    clamp_modes : array
+        'ic' or 'vc' for each record.
+    n_samples : array | None
+        Number of valid samples in each row of *data*, if rows have different lengths.
+        Rows are processed in groups of equal length.
+
+    Returns a dict mapping each of *strength_fields* to an array of n_records values.
+    """
+    n_recs = data.shape[0]
+    results = {k: np.empty(n_recs) for k in strength_fields}
+    if n_samples is None:
+        n_samples = np.full(n_recs, data.shape[1], dtype=int)
+
+    for length in np.unique(n_samples):
+        rows = np.argwhere(n_samples == length)[:,0]
+        group = _strength_batch(data[rows, :length], pulse_times[rows], spike_times[rows], clamp_modes[rows],
+                                lpf=lpf, bsub=bsub, lowpass=lowpass)
+        for k in strength_fields:
+            results[k][rows] = group[k]
+    return results
+
+
+def _strength_batch(data, pulse_times, spike_times, clamp_modes, lpf, bsub, lowpass):
+    # All rows in *data* have the same length here.
+    sample_rate = default_sample_rate
+    dt = 1.0 / sample_rate
+    pulse_start = pulse_times[:, 0]
+    results = {}
+
+    # Measure crosstalk from pulse onset
+    p1 = np.nanmedian(_windows(data, _time_index(pulse_start-200e-6, sample_rate), _time_index(pulse_start, sample_rate)), axis=1)
+    p2 = np.nanmedian(_windows(data, _time_index(pulse_start, sample_rate), _time_index(pulse_start+200e-6, sample_rate)), axis=1)
+    results['crosstalk'] = p2 - p1
+
+    # Windows used by measure_peak
+    base_stop = _time_index(pulse_start - 50e-6, sample_rate)
+    resp_start_t = spike_times + 1e-3
+    resp_start = _time_index(resp_start_t, sample_rate)
+    resp_stop = _time_index(resp_start_t + 4e-3, sample_rate)
+
+    # Measure deflection on raw data
+    baseline = _float_mode_rows(_windows(data, 0, base_stop))
+    response = _windows(data, resp_start, resp_stop)
+    results['pos_amp'] = np.nanmax(response, axis=1) - baseline
+    results['neg_amp'] = np.nanmin(response, axis=1) - baseline
+
+    # Exponential deconvolution (see neuroanalysis.event_detection.exp_deconvolve)
+    tau = np.where(clamp_modes == 'ic', 15e-3, 5e-3)[:, None]
+    dec = data[:, :-1] + (tau / dt) * (data[:, 1:] - data[:, :-1])
+
+    if bsub:
+        dec = dec - np.median(dec[:, _time_index(5e-3, sample_rate):_time_index(10e-3, sample_rate)], axis=1)[:, None]
+
+    if lpf:
+        # bidirectional bessel filter with mirrored padding (see neuroanalysis.filter.bessel_filter)
+        b, a = scipy.signal.bessel(1, lowpass * dt, btype='low')
+        pad = min(100, dec.shape[1])
+        padded = np.hstack([dec[:, :pad][:, ::-1], dec, dec[:, -pad:][:, ::-1]])
+        filtered = scipy.signal.lfilter(b, a, scipy.signal.lfilter(b, a, padded, axis=1)[:, ::-1], axis=1)[:, ::-1]
+        dec = filtered[:, pad:-pad]
+
+    # Measure deflection on deconvolved data
+    dec_baseline = _float_mode_rows(_windows(dec, 0, base_stop))
+    dec_response = _windows(dec, resp_start, resp_stop)
+    rows = np.arange(len(dec))
+    resp_start = np.clip(resp_start, 0, dec.shape[1])
+    for sign, argfn in (('pos', np.nanargmax), ('neg', np.nanargmin)):
+        i = argfn(dec_response, axis=1)
+        results[sign + '_dec_amp'] = dec_response[rows, i] - dec_baseline
+        results[sign + '_dec_latency'] = (resp_start + i) * dt - spike_times
+
+    return results
+
+
+def _time_index(t, sample_rate):
+    """Convert times to sample indices the same way Trace.time_slice does.
+    """
+    return np.round(np.asarray(t) * sample_rate).astype(int)
+
+
+def _windows(data, start, stop):
+    """Gather one window per row of *data* into a 2D array, NaN-padded to the longest window.
+
+    *start* and *stop* may be scalars or per-row index arrays.
+    """
+    n_rows, n_cols = data.shape
+    start = np.clip(np.broadcast_to(start, (n_rows,)), 0, n_cols)
+    stop = np.clip(np.broadcast_to(stop, (n_rows,)), 0, n_cols)
+    width = max(0, (stop - start).max())
+    inds = start[:, None] + np.arange(width)[None, :]
+    valid = inds < stop[:, None]
+    out = data[np.arange(n_rows)[:, None], np.clip(inds, 0, n_cols-1)]
+    out[~valid] = np.nan
+    return out
+
+
+def _float_mode_rows(values):
+    """Row-wise neuroanalysis.baseline.float_mode for a NaN-padded 2D array.
+
+    Bin edges and bin assignment replicate np.histogram exactly so that results
+    are identical to calling float_mode on each row.
+    """
+    n_rows = values.shape[0]
+    valid = ~np.isnan(values)
+    count = valid.sum(axis=1)
+    bins = np.clip((count ** 0.5).astype(int), 3, 500)
+
+    first = np.nanmin(values, axis=1)
+    last = np.nanmax(values, axis=1)
+    same = first == last
+    first = np.where(same, first - 0.5, first)
+    last = np.where(same, last + 0.5, last)
+    step = (last - first) / bins
+
+    def edge(k):
+        # matches np.linspace(first, last, bins+1)[k]
+        return np.where(k == bins[:, None], last[:, None], k * step[:, None] + first[:, None])
+
+    x = np.where(valid, values, first[:, None])
+    inds = ((x - first[:, None]) / (last - first)[:, None] * bins[:, None]).astype(int)
+    inds[inds == bins[:, None]] -= 1
+    inds[x < edge(inds)] -= 1
+    inc = (x >= edge(inds + 1)) & (inds != bins[:, None] - 1)
+    inds[inc] += 1
+
+    max_bins = bins.max()
+    flat = (np.arange(n_rows)[:, None] * max_bins + inds)[valid]
+    hist = np.bincount(flat, minlength=n_rows * max_bins).reshape(n_rows, max_bins)
+    mode_ind = np.argmax(hist, axis=1)[:, None]
+    return (0.5 * (edge(mode_ind) + edge(mode_ind + 1)))[:, 0]
@@ -12,10 +12,12 @@ from __future__ import print_function, division
 from collections import OrderedDict
 import argparse, time, sys, os, pickle, io, multiprocessing
 import numpy as np
-import scipy.stats
+import scipy.stats, scipy.signal
 import pandas
 
+from sqlalchemy import inspect
 from sqlalchemy.orm import aliased
+from sqlalchemy.sql.expression import func
 
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtGui, QtCore
@@ -23,14 +25,14 @@ from pyqtgraph.Qt import QtGui, QtCore
 from neuroanalysis.ui.plot_grid import PlotGrid
 from neuroanalysis.data import Trace, TraceList
 from neuroanalysis import filter
-from neuroanalysis.event_detection import exp_deconvolve
-from neuroanalysis.baseline import float_mode
 
 from multipatch_analysis.database import database as db
 from multipatch_analysis import config, synphys_cache
 from multipatch_analysis.ui.multipatch_nwb_viewer import MultipatchNwbViewer
 from multipatch_analysis.constants import EXCITATORY_CRE_TYPES, INHIBITORY_CRE_TYPES
 import multipatch_analysis.qc as qc 
+from response_strength import (measure_peak, measure_sum, deconv_filter, remove_crosstalk_artifacts,
+    analyze_response_strength, strength_fields, strength_inputs, analyze_response_strength_batch)
 
 
 
@@ -55,6 +57,22 @@ class TableGroup(object):
         for k in self.schemas:
             if k not in db.engine.table_names():
                 self[k].__table__.create(bind=db.engine)
+            else:
+                self.add_missing_columns(k)
+
+    def add_missing_columns(self, name):
+        """Add columns that were added to the schema after table *name* was created.
+
+        Existing rows get NULL in the new columns.
+        """
+        table = self[name].__table__
+        existing = [col['name'] for col in inspect(db.engine).get_columns(name)]
+        for col in table.columns:
+            if col.name in existing:
+                continue
+            coltype = col.type.compile(dialect=db.engine.dialect)
+            print("Adding column %s.%s" % (name, col.name))
+            db.engine.execute("alter table %s add column %s %s" % (name, col.name, coltype))
 
 
 class PulseResponseStrengthTableGroup(TableGroup):
@@ -80,7 +98,15 @@ class PulseResponseStrengthTableGroup(TableGroup):
             ('pos_dec_latency', 'float'),
             ('neg_dec_latency', 'float'),
             ('crosstalk', 'float'),
-        ]
+        ],
+        'strength_progress': [
+            "ID ranges of pulse_response / baseline records that have been processed by rebuild_strength",
+            ('source', 'str', '"pulse_response" or "baseline"', {'index': True}),
+            ('start_id', 'int', 'First ID in the processed range'),
+            ('stop_id', 'int', 'End of the processed range (exclusive)'),
+            ('n_records', 'int', 'Number of strength records generated for this range'),
+            ('compute_time', 'float', 'Time (s) spent processing this range'),
+        ],
         #'deconv_pulse_response': [
             #"Exponentially deconvolved pulse responses",
         #],
@@ -156,7 +182,12 @@ class ConnectionStrengthTableGroup(TableGroup):
             ('vc_base_latency_stdev', 'float'),
             ('vc_latency_ttest', 'float'),
             ('vc_latency_ks2samp', 'float'),
-            
+
+            # fingerprint of the strength records used to compute this entry
+            ('n_fg_inputs', 'int', 'Number of pulse_response_strength records for this pair'),
+            ('max_fg_input_id', 'int', 'Largest pulse_response_strength ID for this pair'),
+            ('n_bg_inputs', 'int', 'Number of baseline_response_strength records for the postsynaptic electrode'),
+            ('max_bg_input_id', 'int', 'Largest baseline_response_strength ID for the postsynaptic electrode'),
         ],
     }
 
@@ -173,93 +204,125 @@ pulse_response_strength_tables = PulseResponseStrengthTableGroup()
 connection_strength_tables = ConnectionStrengthTableGroup()
 
 def init_tables():
-    global PulseResponseStrength, BaselineResponseStrength, ConnectionStrength
+    global PulseResponseStrength, BaselineResponseStrength, StrengthProgress, ConnectionStrength
     pulse_response_strength_tables.create_tables()
     connection_strength_tables.create_tables()
 
     PulseResponseStrength = pulse_response_strength_tables['pulse_response_strength']
     BaselineResponseStrength = pulse_response_strength_tables['baseline_response_strength']
+    StrengthProgress = pulse_response_strength_tables['strength_progress']
     ConnectionStrength = connection_strength_tables['connection_strength']
 
 
-def measure_peak(trace, sign, spike_time, pulse_times, spike_delay=1e-3, response_window=4e-3):
-    # Start measuring response after the pulse has finished, and no earlier than 1 ms after spike onset
-    # response_start = max(spike_time + spike_delay, pulse_times[1])
-
-    # Start measuring after spike and hope that the pulse offset doesn't get in the way
-    # (if we wait for the pulse to end, then we miss too many fast rise / short latency events)
-    response_start = spike_time + spike_delay
-    response_stop = response_start + response_window
-
-    # measure baseline from beginning of data until 50µs before pulse onset
-    baseline_start = 0
-    baseline_stop = pulse_times[0] - 50e-6
-
-    baseline = float_mode(trace.time_slice(baseline_start, baseline_stop).data)
-    response = trace.time_slice(response_start, response_stop)
-
-    if sign == '+':
-        i = np.argmax(response.data)
-    else:
-        i = np.argmin(response.data)
-    peak = response.data[i]
-    latency = response.time_values[i] - spike_time
-    return peak - baseline, latency
-
-
-def measure_sum(trace, sign, baseline=(0e-3, 9e-3), response=(12e-3, 17e-3)):
-    baseline = trace.time_slice(*baseline).data.sum()
-    peak = trace.time_slice(*response).data.sum()
-    return peak - baseline
-
-        
-def deconv_filter(trace, pulse_times, tau=15e-3, lowpass=1000., lpf=True, remove_artifacts=False, bsub=True):
-    dec = exp_deconvolve(trace, tau)
-
-    if remove_artifacts:
-        # after deconvolution, the pulse causes two sharp artifacts; these
-        # must be removed before LPF
-        cleaned = remove_crosstalk_artifacts(dec, pulse_times)
-    else:
-        cleaned = dec
-
-    if bsub:
-        baseline = np.median(cleaned.time_slice(cleaned.t0+5e-3, cleaned.t0+10e-3).data)
-        b_subbed = cleaned-baseline
-    else:
-        b_subbed = cleaned
-
-    if lpf:
-        return filter.bessel_filter(b_subbed, lowpass)
-    else:
-        return b_subbed
-
-
-def remove_crosstalk_artifacts(data, pulse_times):
-    dt = data.dt
-    r = [-50e-6, 250e-6]
-    edges = [(int((t+r[0])/dt), int((t+r[1])/dt)) for t in pulse_times]
-    # If window is too shortm then it becomes seneitive to sample noise.
-    # If window is too long, then it becomes sensitive to slower signals (like the AP following pulse onset)
-    return filter.remove_artifacts(data, edges, window=100e-6)
-
-
 @db.default_session
-def rebuild_strength(parallel=True, workers=6, session=None):
+def rebuild_strength(parallel=True, workers=6, chunk_size=2000, session=None):
+    """Compute strength metrics for all pulse responses and baselines that have not
+    already been processed.
+
+    The set of unprocessed records is divided into small ID-range chunks that are
+    handed out to workers as they become free. Each completed chunk is recorded in
+    the strength_progress table, so an interrupted rebuild can be resumed by calling
+    this function again.
+    """
     for source in ['pulse_response', 'baseline']:
         print("Rebuilding %s strength table.." % source)
         
-        # Divide workload into equal parts for each worker
-        max_pulse_id = session.execute('select max(id) from %s' % source).fetchone()[0]
-        chunk = 1 + (max_pulse_id // workers)
-        parts = [(source, chunk*i, chunk*(i+1)) for i in range(workers)]
+        chunks, n_records = strength_chunks(source, chunk_size=chunk_size, session=session)
+        if len(chunks) == 0:
+            print("   (nothing to do)")
+            continue
+        progress = RebuildProgress(source, n_records)
 
         if parallel:
+            # Dispose DB engine before forking; see import_to_database.py
+            session.close()
+            db.engine.dispose()
             pool = multiprocessing.Pool(processes=workers)
-            pool.map(compute_strength, parts)
+            try:
+                for result in pool.imap_unordered(compute_strength, chunks, chunksize=1):
+                    progress.update(result)
+            finally:
+                pool.close()
+                pool.join()
         else:
-            for part in parts:
-                compute_strength(part)
+            for chunk in chunks:
+                progress.update(compute_strength(chunk))
+        progress.finish()
+
+
+@db.default_session
+def strength_chunks(source, chunk_size=2000, session=None):
+    """Return a list of (source, start_id, stop_id) ID ranges covering all records
+    that still need to be processed, and the total number of such records.
+
+    Records are skipped if they already have a strength entry, or if they lie in an
+    ID range that was previously recorded as complete in the strength_progress table
+    (some records are never analyzed because they lack the necessary stimulus metadata).
+    Each chunk covers at most *chunk_size* records regardless of gaps in the ID sequence.
+    """
+    strength_table = {'pulse_response': 'pulse_response_strength', 'baseline': 'baseline_response_strength'}[source]
+    query = """
+        select src.id from {source} src
+        where not exists (select 1 from {strength_table} s where s.{source}_id=src.id)
+        order by src.id
+    """.format(source=source, strength_table=strength_table)
+    ids = np.array([r[0] for r in session.execute(query)], dtype=int)
+
+    # Drop IDs covered by completed ranges. This is done here rather than with a
+    # correlated subquery, which would scan strength_progress once per record.
+    query = """
+        select start_id, stop_id from strength_progress
+        where source='{source}' order by start_id
+    """.format(source=source)
+    ranges = np.array([tuple(r) for r in session.execute(query)], dtype=int).reshape(-1, 2)
+    if len(ranges) > 0 and len(ids) > 0:
+        starts = ranges[:, 0]
+        # furthest stop_id of all ranges starting at or before each range start
+        stops = np.maximum.accumulate(ranges[:, 1])
+        j = np.searchsorted(starts, ids, side='right') - 1
+        covered = (j >= 0) & (ids < stops[np.clip(j, 0, None)])
+        ids = ids[~covered]
+
+    chunks = []
+    for i in range(0, len(ids), chunk_size):
+        chunk_ids = ids[i:i+chunk_size]
+        chunks.append((source, int(chunk_ids[0]), int(chunk_ids[-1]) + 1))
+    return chunks, len(ids)
+
+
+class RebuildProgress(object):
+    """Collects results from compute_strength and prints a live throughput report.
+    """
+    def __init__(self, source, n_records):
+        self.source = source
+        self.n_records = n_records
+        self.n_done = 0
+        self.start_time = time.time()
+        self.worker_stats = OrderedDict()  # pid: [n_records, compute_time]
+        self._msglen = 0
+
+    def update(self, result):
+        self.n_done += result['n_records']
+        stats = self.worker_stats.setdefault(result['pid'], [0, 0.0])
+        stats[0] += result['n_records']
+        stats[1] += result['compute_time']
+
+        elapsed = time.time() - self.start_time
+        rate = self.n_done / elapsed if elapsed > 0 else 0
+        remaining = max(0, self.n_records - self.n_done)
+        eta = '%dm%02ds' % divmod(int(remaining / rate), 60) if rate > 0 else '?'
+        worker_rates = ['%d' % (n / t) if t > 0 else '-' for n, t in self.worker_stats.values()]
+        msg = "  %d / %d  %0.0f rec/s  ETA %s  [per worker rec/s: %s]" % (
+            self.n_done, self.n_records, rate, eta, ' '.join(worker_rates))
+        sys.stdout.write(msg.ljust(self._msglen) + '\r')
+        sys.stdout.flush()
+        self._msglen = len(msg)
+
+    def finish(self):
+        elapsed = time.time() - self.start_time
+        print("")
+        print("  %s: processed %d records in %0.1f s (%0.0f rec/s) using %d workers" % (
+            self.source, self.n_done, elapsed, self.n_done / max(elapsed, 1e-9), len(self.worker_stats)))
 
 
 def compute_strength(inds, session=None):
@@ -311,87 +374,38 @@ def baseline_query(session):
     return q
 
 
-def analyze_response_strength(rec, source, remove_artifacts=False, lpf=True, bsub=True, lowpass=1000):
-    """Perform a standardized strength analysis on a record selected by response_query or baseline_query.
-
-    1. Determine timing of presynaptic stimulus pulse edges and spike
-    2. Measure peak deflection on raw trace
-    3. Apply deconvolution / artifact removal / lpf
-    4. Measure peak deflection on deconvolved trace
-    """
-    data = Trace(rec.data, sample_rate=db.default_sample_rate)
-    if source == 'pulse_response':
-        # Find stimulus pulse edges for artifact removal
-        start = rec.pulse_start - rec.rec_start
-        pulse_times = [start, start + rec.pulse_dur]
-        if rec.spike_time is None:
-            # these pulses failed QC, but we analyze them anyway to make all data visible
-            spike_time = 11e-3
-        else:
-            spike_time = rec.spike_time - rec.rec_start
-    elif source == 'baseline':
-        # Fake stimulus information to ensure that background data receives
-        # the same filtering / windowing treatment
-        pulse_times = [10e-3, 12e-3]
-        spike_time = 11e-3
-    else:
-        raise ValueError("Invalid source %s" % source)
-
-    results = {}
-
-    results['raw_trace'] = data
-    results['pulse_times'] = pulse_times
-    results['spike_time'] = spike_time
-
-    # Measure crosstalk from pulse onset
-    p1 = data.time_slice(pulse_times[0]-200e-6, pulse_times[0]).median()
-    p2 = data.time_slice(pulse_times[0], pulse_times[0]+200e-6).median()
-    results['crosstalk'] = p2 - p1
-
-    # crosstalk artifacts in VC are removed before deconvolution
-    if rec.clamp_mode == 'vc' and remove_artifacts is True:
-        data = remove_crosstalk_artifacts(data, pulse_times)
-        remove_artifacts = False
-
-    # Measure deflection on raw data
-    results['pos_amp'], _ = measure_peak(data, '+', spike_time, pulse_times)
-    results['neg_amp'], _ = measure_peak(data, '-', spike_time, pulse_times)
-
-    # Deconvolution / artifact removal / filtering
-    tau = 15e-3 if rec.clamp_mode == 'ic' else 5e-3
-    dec_data = deconv_filter(data, pulse_times, tau=tau, lpf=lpf, remove_artifacts=remove_artifacts, bsub=bsub, lowpass=lowpass)
-    results['dec_trace'] = dec_data
-
-    # Measure deflection on deconvolved data
-    results['pos_dec_amp'], results['pos_dec_latency'] = measure_peak(dec_data, '+', spike_time, pulse_times)
-    results['neg_dec_amp'], results['neg_dec_latency'] = measure_peak(dec_data, '-', spike_time, pulse_times)
-    
-    return results
-
-
 @db.default_session
 def _compute_strength(inds, session=None):
-    """Comput per-pulse-response strength metrics
+    """Compute per-pulse-response strength metrics for one range of IDs.
+
+    Records in the range that already have a strength entry are skipped. Once all
+    records are processed, the range is recorded in the strength_progress table
+    in the same transaction as the final batch of results.
+
+    Returns a dict with the number of records processed and the time spent.
     """
+    start_time = time.time()
     source, start_id, stop_id = inds
     if source == 'baseline':
         q = baseline_query(session)
+        id_col = db.Baseline.id
+        q = q.outerjoin(BaselineResponseStrength).filter(BaselineResponseStrength.id==None)
+        strength_table = BaselineResponseStrength
     elif source == 'pulse_response':
         q = response_query(session)
+        id_col = db.PulseResponse.id
+        q = q.outerjoin(PulseResponseStrength).filter(PulseResponseStrength.id==None)
+        strength_table = PulseResponseStrength
     else:
         raise ValueError("Invalid source %s" % source)
 
-    prof = pg.debug.Profiler(delayed=False)
+    prof = pg.debug.Profiler(disabled=True, delayed=False)
     
+    n_records = 0
     next_id = start_id
     while True:
         # Request just a chunk of all pulse responses based on ID range
-        if source == 'pulse_response':
-            q1 = q.filter(db.PulseResponse.id>=next_id).filter(db.PulseResponse.id<stop_id)
-            q1 = q1.order_by(db.PulseResponse.id)
-        else:
-            q1 = q.filter(db.Baseline.id>=next_id).filter(db.Baseline.id<stop_id)
-            q1 = q1.order_by(db.Baseline.id)
+        q1 = q.filter(id_col>=next_id).filter(id_col<stop_id).order_by(id_col)
         q1 = q1.limit(1000)  # process in 1000-record chunks
 
         prof('exec')
@@ -401,132 +415,336 @@ def _compute_strength(inds, session=None):
             break
         new_recs = []
 
-        for rec in recs:
-            result = analyze_response_strength(rec, source)
+        # analyze the entire chunk at once
+        data, n_samples, pulse_times, spike_times, clamp_modes = strength_inputs(recs, source)
+        result = analyze_response_strength_batch(data, pulse_times, spike_times, clamp_modes, n_samples=n_samples)
+        for i,rec in enumerate(recs):
             new_rec = {'%s_id'%source: rec.response_id}
-            # copy a subset of results over to new record
-            for k in ['pos_amp', 'neg_amp', 'pos_dec_amp', 'neg_dec_amp', 'pos_dec_latency', 'neg_dec_latency', 'crosstalk']:
-                new_rec[k] = result[k]
+            for k in strength_fields:
+                new_rec[k] = float(result[k][i])
             new_recs.append(new_rec)
         
         next_id = rec.response_id + 1
-        
-        sys.stdout.write("%d / %d\r" % (next_id-start_id, stop_id-start_id))
-        sys.stdout.flush()
+        n_records += len(recs)
 
         prof('process')
-        if source == 'pulse_response':
-            session.bulk_insert_mappings(PulseResponseStrength, new_recs)
-        else:
-            session.bulk_insert_mappings(BaselineResponseStrength, new_recs)
+        session.bulk_insert_mappings(strength_table, new_recs)
         prof('insert')
         new_recs = []
 
+        if len(recs) < 1000:
+            break
         session.commit()
         prof('commit')
 
+    compute_time = time.time() - start_time
+    session.add(StrengthProgress(source=source, start_id=start_id, stop_id=stop_id, n_records=n_records, compute_time=compute_time))
+    session.commit()
+    prof('commit')
+
+    return {'source': source, 'n_records': n_records, 'compute_time': compute_time, 'pid': os.getpid()}
+
 
 @db.default_session
-def rebuild_connectivity(session):
+def rebuild_connectivity(incremental=False, chunk_size=500, session=None):
+    """Compute connection_strength records from the pulse response / baseline strength tables.
+
+    If *incremental* is True, then only pairs whose input fingerprint (the number and
+    maximum ID of contributing strength records) changed since the last run are recomputed.
+    """
     print("Rebuilding connectivity table..")
-    
-    expts_in_db = list_experiments(session=session)
-    for i,expt in enumerate(expts_in_db):
-        for pair in expt.pairs:
-            fields = {}  # used to fill the new DB record
-            
-            # Use KS p value to check for differences between foreground and background
-            
-            amps = {}
-            qc_amps = {}
-            ks_pvals = {}
-            amp_means = {}
-            amp_diffs = {}
-            for clamp_mode in ('ic', 'vc'):
-                # Query all pulse amplitude records for this clamp mode
-                clamp_mode_fg = get_amps(session, pair, clamp_mode=clamp_mode)
-                clamp_mode_bg = get_baseline_amps(session, pair, limit=len(clamp_mode_fg), clamp_mode=clamp_mode)
-                amps[clamp_mode, 'fg'] = clamp_mode_fg
-                amps[clamp_mode, 'bg'] = clamp_mode_bg
-                if (len(clamp_mode_fg) == 0 or len(clamp_mode_bg) == 0):
-                    continue
-                
-                for sign in ('pos', 'neg'):
-                    # Separate into positive/negative tests and filter out responses that failed qc
-                    qc_field = {'vc': {'pos': 'in_qc_pass', 'neg': 'ex_qc_pass'}, 'ic': {'pos': 'ex_qc_pass', 'neg': 'in_qc_pass'}}[clamp_mode][sign]
-                    fg = clamp_mode_fg[clamp_mode_fg[qc_field]]
-                    bg = clamp_mode_bg[clamp_mode_bg[qc_field]]
-                    qc_amps[sign, clamp_mode, 'fg'] = fg
-                    qc_amps[sign, clamp_mode, 'bg'] = bg
-                    if (len(fg) == 0 or len(bg) == 0):
-                        continue
-                    
-                    # Measure some statistics from these records
-                    fg = fg[sign + '_dec_amp']
-                    bg = bg[sign + '_dec_amp']
-                    pval = scipy.stats.ks_2samp(fg, bg).pvalue
-                    ks_pvals[(sign, clamp_mode)] = pval
-                    # we could ensure that the average amplitude is in the right direction:
-                    fg_mean = np.mean(fg)
-                    bg_mean = np.mean(bg)
-                    amp_means[sign, clamp_mode] = {'fg': fg_mean, 'bg': bg_mean}
-                    amp_diffs[sign, clamp_mode] = fg_mean - bg_mean
-
-            # Decide whether to treat this connection as excitatory or inhibitory.
-            #   strategy: accumulate evidence for either possibility by checking
-            #   the ks p-values for each sign/clamp mode and the direction of the deflection
-            is_exc = 0
-            # print(expt.acq_timestamp, pair.pre_cell.ext_id, pair.post_cell.ext_id)
-            for sign in ('pos', 'neg'):
-                for mode in ('ic', 'vc'):
-                    ks = ks_pvals.get((sign, mode), None)
-                    if ks is None:
-                        continue
-                    # turn p value into a reasonable scale factor
-                    ks = np.log(1-np.log(ks))
-                    dif_sign = 1 if amp_diffs[sign, mode] > 0 else -1
-                    if mode == 'vc':
-                        dif_sign *= -1
-                    is_exc += dif_sign * ks
-                    # print("    ", sign, mode, is_exc, dif_sign * ks)
-
-            if is_exc > 0:
-                fields['synapse_type'] = 'ex'
-                sign = 'pos'
-            else:
-                fields['synapse_type'] = 'in'
-                sign = 'neg'
-
-            # compute the rest of statistics for only positive or negative deflections
-            for clamp_mode in ('ic', 'vc'):
-                fg = qc_amps.get((sign, clamp_mode, 'fg'))
-                bg = qc_amps.get((sign, clamp_mode, 'bg'))
-                if fg is None or bg is None or len(fg) == 0 or len(bg) == 0:
-                    fields[clamp_mode + '_n_samples'] = 0
-                    continue
-                
-                fields[clamp_mode + '_n_samples'] = len(fg)
-                fields[clamp_mode + '_crosstalk_mean'] = np.mean(fg['crosstalk'])
-                fields[clamp_mode + '_base_crosstalk_mean'] = np.mean(bg['crosstalk'])
-                
-                # measure mean, stdev, and statistical differences between
-                # fg and bg for each measurement
-                for val, field in [('amp', 'amp'), ('deconv_amp', 'dec_amp'), ('latency', 'dec_latency')]:
-                    f = fg[sign + '_' + field]
-                    b = bg[sign + '_' + field]
-                    fields[clamp_mode + '_' + val + '_mean'] = np.mean(f)
-                    fields[clamp_mode + '_' + val + '_stdev'] = np.std(f)
-                    fields[clamp_mode + '_base_' + val + '_mean'] = np.mean(b)
-                    fields[clamp_mode + '_base_' + val + '_stdev'] = np.std(b)
-                    fields[clamp_mode + '_' + val + '_ttest'] = scipy.stats.ttest_ind(f, b, equal_var=False).pvalue
-                    fields[clamp_mode + '_' + val + '_ks2samp'] = scipy.stats.ks_2samp(f, b).pvalue
-
-            conn = ConnectionStrength(pair_id=pair.id, **fields)
+
+    fingerprints = pair_input_fingerprints(session=session)
+    if incremental:
+        existing = {}
+        for cs in session.query(ConnectionStrength):
+            existing[cs.pair_id] = cs
+        dirty = []
+        for pair_id, fp in fingerprints.items():
+            cs = existing.get(pair_id)
+            if cs is None or connection_strength_fingerprint(cs) != fp:
+                dirty.append(pair_id)
+        # remove stale results before recomputing
+        stale = [existing[pair_id].id for pair_id in dirty if pair_id in existing]
+        for i in range(0, len(stale), chunk_size):
+            session.query(ConnectionStrength).filter(ConnectionStrength.id.in_(stale[i:i+chunk_size])).delete(synchronize_session=False)
+        print("   %d / %d pairs need to be updated" % (len(dirty), len(fingerprints)))
+    else:
+        dirty = list(fingerprints.keys())
+    dirty.sort()
+
+    if incremental:
+        batches = [dirty[i:i+chunk_size] for i in range(0, len(dirty), chunk_size)]
+    else:
+        # fetch every pair with a single query per table and clamp mode
+        batches = [None]
+
+    n_done = 0
+    for batch in batches:
+        amps = {}
+        for clamp_mode in ('ic', 'vc'):
+            amps[clamp_mode] = get_pair_amps(session, batch, clamp_mode=clamp_mode)
+        pair_ids = amps['ic'][0]
+
+        results = grouped_connection_strength_fields(amps)
+        for pair_id, fields in zip(pair_ids, results):
+            fp = fingerprints.get(pair_id, (0, None, 0, None))
+            fields.update(n_fg_inputs=fp[0], max_fg_input_id=fp[1], n_bg_inputs=fp[2], max_bg_input_id=fp[3])
+            conn = ConnectionStrength(pair_id=int(pair_id), **fields)
             session.add(conn)
         
         session.commit()
-        sys.stdout.write("%d / %d       \r" % (i, len(expts_in_db)))
+        n_done += len(pair_ids)
+        sys.stdout.write("%d / %d       \r" % (n_done, len(dirty)))
         sys.stdout.flush()
+    print("")
+
+
+def grouped_connection_strength_fields(amps):
+    """Compute connection_strength fields for many pairs at once.
+
+    Produces the same results as calling connection_strength_fields for each pair, but
+    means, standard deviations and t-tests are computed for all pairs with grouped
+    array operations; only the KS tests are evaluated per pair.
+
+    *amps* maps each clamp mode to the tuple returned by get_pair_amps. Returns a
+    list of field dicts, one per pair.
+    """
+    pair_ids = amps['ic'][0]
+    n_pairs = len(pair_ids)
+    results = [{} for i in range(n_pairs)]
+
+    qc_amps = {}
+    is_exc = np.zeros(n_pairs)
+    for clamp_mode in ('ic', 'vc'):
+        _, fg, fg_group, bg, bg_group = amps[clamp_mode]
+        has_data = (np.bincount(fg_group, minlength=n_pairs) > 0) & (np.bincount(bg_group, minlength=n_pairs) > 0)
+        for sign in ('pos', 'neg'):
+            # Separate into positive/negative tests and filter out responses that failed qc
+            qc_field = {'vc': {'pos': 'in_qc_pass', 'neg': 'ex_qc_pass'}, 'ic': {'pos': 'ex_qc_pass', 'neg': 'in_qc_pass'}}[clamp_mode][sign]
+            fmask = fg[qc_field].astype(bool)
+            bmask = bg[qc_field].astype(bool)
+            f = _GroupedValues(fg[fmask], fg_group[fmask], n_pairs)
+            b = _GroupedValues(bg[bmask], bg_group[bmask], n_pairs)
+            valid = has_data & (f.counts > 0) & (b.counts > 0)
+            qc_amps[sign, clamp_mode] = (f, b, valid)
+
+            # accumulate evidence for excitatory / inhibitory connection
+            # (see connection_strength_fields)
+            field = sign + '_dec_amp'
+            ks = _grouped_ks_pvalue(f, b, field, valid)
+            with np.errstate(all='ignore'):
+                score = np.log(1 - np.log(ks))
+                dif_sign = np.where(f.mean(field) - b.mean(field) > 0, 1, -1)
+            if clamp_mode == 'vc':
+                dif_sign *= -1
+            is_exc += np.where(valid, dif_sign * score, 0)
+
+    signs = np.where(is_exc > 0, 'pos', 'neg')
+    for i in range(n_pairs):
+        results[i]['synapse_type'] = 'ex' if signs[i] == 'pos' else 'in'
+
+    # compute the rest of statistics for only positive or negative deflections
+    for clamp_mode in ('ic', 'vc'):
+        for sign in ('pos', 'neg'):
+            f, b, valid = qc_amps[sign, clamp_mode]
+            selected = valid & (signs == sign)
+            cols = {clamp_mode + '_n_samples': np.where(selected, f.counts, 0)}
+            cols[clamp_mode + '_crosstalk_mean'] = f.mean('crosstalk')
+            cols[clamp_mode + '_base_crosstalk_mean'] = b.mean('crosstalk')
+            for val, field in [('amp', 'amp'), ('deconv_amp', 'dec_amp'), ('latency', 'dec_latency')]:
+                field = sign + '_' + field
+                cols[clamp_mode + '_' + val + '_mean'] = f.mean(field)
+                cols[clamp_mode + '_' + val + '_stdev'] = f.std(field)
+                cols[clamp_mode + '_base_' + val + '_mean'] = b.mean(field)
+                cols[clamp_mode + '_base_' + val + '_stdev'] = b.std(field)
+                cols[clamp_mode + '_' + val + '_ttest'] = _grouped_welch_pvalue(f, b, field)
+                cols[clamp_mode + '_' + val + '_ks2samp'] = _grouped_ks_pvalue(f, b, field, selected)
+
+            n_key = clamp_mode + '_n_samples'
+            for i in np.argwhere(signs == sign)[:,0]:
+                if not selected[i]:
+                    results[i][n_key] = 0
+                    continue
+                for k,v in cols.items():
+                    results[i][k] = v[i].item()
+
+    return results
+
+
+class _GroupedValues(object):
+    """Record array sorted by group index, with per-group statistics.
+    """
+    def __init__(self, recs, group, n_groups):
+        self.recs = recs
+        self.group = group
+        self.n_groups = n_groups
+        self.counts = np.bincount(group, minlength=n_groups)
+        self.starts = np.searchsorted(group, np.arange(n_groups), side='left')
+        self.stops = np.searchsorted(group, np.arange(n_groups), side='right')
+
+    def values(self, field, i):
+        return self.recs[field][self.starts[i]:self.stops[i]]
+
+    def mean(self, field):
+        with np.errstate(all='ignore'):
+            return np.bincount(self.group, weights=self.recs[field], minlength=self.n_groups) / self.counts
+
+    def sum_sq_dev(self, field):
+        dev = self.recs[field] - self.mean(field)[self.group]
+        return np.bincount(self.group, weights=dev**2, minlength=self.n_groups)
+
+    def std(self, field):
+        with np.errstate(all='ignore'):
+            return (self.sum_sq_dev(field) / self.counts) ** 0.5
+
+    def var(self, field):
+        with np.errstate(all='ignore'):
+            return self.sum_sq_dev(field) / (self.counts - 1)
+
+
+def _grouped_welch_pvalue(f, b, field):
+    """Welch's t-test p value for each group, as scipy.stats.ttest_ind(equal_var=False).
+    """
+    n1 = f.counts.astype(float)
+    n2 = b.counts.astype(float)
+    with np.errstate(all='ignore'):
+        vn1 = f.var(field) / n1
+        vn2 = b.var(field) / n2
+        df = (vn1 + vn2)**2 / (vn1**2 / (n1 - 1) + vn2**2 / (n2 - 1))
+        t = (f.mean(field) - b.mean(field)) / np.sqrt(vn1 + vn2)
+        return 2 * scipy.stats.t.sf(np.abs(t), df)
+
+
+def _grouped_ks_pvalue(f, b, field, mask):
+    """Two-sample KS test p value for each group where *mask* is True (NaN elsewhere).
+    """
+    pvals = np.full(f.n_groups, np.nan)
+    for i in np.argwhere(mask)[:,0]:
+        pvals[i] = scipy.stats.ks_2samp(f.values(field, i), b.values(field, i)).pvalue
+    return pvals
+
+
+def connection_strength_fields(amps):
+    """Compute the statistics stored in a connection_strength record for one pair.
+
+    *amps* maps (clamp_mode, 'fg' | 'bg') to record arrays as returned by get_amps
+    and get_baseline_amps.
+    """
+    fields = {}  # used to fill the new DB record
+    
+    # Use KS p value to check for differences between foreground and background
+    qc_amps = {}
+    ks_pvals = {}
+    amp_means = {}
+    amp_diffs = {}
+    for clamp_mode in ('ic', 'vc'):
+        clamp_mode_fg = amps[clamp_mode, 'fg']
+        clamp_mode_bg = amps[clamp_mode, 'bg']
+        if (len(clamp_mode_fg) == 0 or len(clamp_mode_bg) == 0):
+            continue
+        
+        for sign in ('pos', 'neg'):
+            # Separate into positive/negative tests and filter out responses that failed qc
+            qc_field = {'vc': {'pos': 'in_qc_pass', 'neg': 'ex_qc_pass'}, 'ic': {'pos': 'ex_qc_pass', 'neg': 'in_qc_pass'}}[clamp_mode][sign]
+            fg = clamp_mode_fg[clamp_mode_fg[qc_field]]
+            bg = clamp_mode_bg[clamp_mode_bg[qc_field]]
+            qc_amps[sign, clamp_mode, 'fg'] = fg
+            qc_amps[sign, clamp_mode, 'bg'] = bg
+            if (len(fg) == 0 or len(bg) == 0):
+                continue
+            
+            # Measure some statistics from these records
+            fg = fg[sign + '_dec_amp']
+            bg = bg[sign + '_dec_amp']
+            pval = scipy.stats.ks_2samp(fg, bg).pvalue
+            ks_pvals[(sign, clamp_mode)] = pval
+            # we could ensure that the average amplitude is in the right direction:
+            fg_mean = np.mean(fg)
+            bg_mean = np.mean(bg)
+            amp_means[sign, clamp_mode] = {'fg': fg_mean, 'bg': bg_mean}
+            amp_diffs[sign, clamp_mode] = fg_mean - bg_mean
+
+    # Decide whether to treat this connection as excitatory or inhibitory.
+    #   strategy: accumulate evidence for either possibility by checking
+    #   the ks p-values for each sign/clamp mode and the direction of the deflection
+    is_exc = 0
+    for sign in ('pos', 'neg'):
+        for mode in ('ic', 'vc'):
+            ks = ks_pvals.get((sign, mode), None)
+            if ks is None:
+                continue
+            # turn p value into a reasonable scale factor
+            ks = np.log(1-np.log(ks))
+            dif_sign = 1 if amp_diffs[sign, mode] > 0 else -1
+            if mode == 'vc':
+                dif_sign *= -1
+            is_exc += dif_sign * ks
+
+    if is_exc > 0:
+        fields['synapse_type'] = 'ex'
+        sign = 'pos'
+    else:
+        fields['synapse_type'] = 'in'
+        sign = 'neg'
+
+    # compute the rest of statistics for only positive or negative deflections
+    for clamp_mode in ('ic', 'vc'):
+        fg = qc_amps.get((sign, clamp_mode, 'fg'))
+        bg = qc_amps.get((sign, clamp_mode, 'bg'))
+        if fg is None or bg is None or len(fg) == 0 or len(bg) == 0:
+            fields[clamp_mode + '_n_samples'] = 0
+            continue
+        
+        fields[clamp_mode + '_n_samples'] = len(fg)
+        fields[clamp_mode + '_crosstalk_mean'] = np.mean(fg['crosstalk'])
+        fields[clamp_mode + '_base_crosstalk_mean'] = np.mean(bg['crosstalk'])
+        
+        # measure mean, stdev, and statistical differences between
+        # fg and bg for each measurement
+        for val, field in [('amp', 'amp'), ('deconv_amp', 'dec_amp'), ('latency', 'dec_latency')]:
+            f = fg[sign + '_' + field]
+            b = bg[sign + '_' + field]
+            fields[clamp_mode + '_' + val + '_mean'] = np.mean(f)
+            fields[clamp_mode + '_' + val + '_stdev'] = np.std(f)
+            fields[clamp_mode + '_base_' + val + '_mean'] = np.mean(b)
+            fields[clamp_mode + '_base_' + val + '_stdev'] = np.std(b)
+            fields[clamp_mode + '_' + val + '_ttest'] = scipy.stats.ttest_ind(f, b, equal_var=False).pvalue
+            fields[clamp_mode + '_' + val + '_ks2samp'] = scipy.stats.ks_2samp(f, b).pvalue
+
+    return fields
+
+
+@db.default_session
+def pair_input_fingerprints(session=None):
+    """Return {pair_id: (n_fg, max_fg_id, n_bg, max_bg_id)} describing the strength records
+    that feed into the connection_strength entry of each pair.
+
+    Foreground inputs are the pulse_response_strength records of the pair; background inputs
+    are the baseline_response_strength records recorded from the postsynaptic electrode.
+    """
+    fg = session.query(
+        db.PulseResponse.pair_id,
+        func.count(PulseResponseStrength.id),
+        func.max(PulseResponseStrength.id),
+    ).select_from(PulseResponseStrength).join(db.PulseResponse).group_by(db.PulseResponse.pair_id)
+    fg = {r[0]: (r[1], r[2]) for r in fg}
+
+    bg = session.query(
+        db.Recording.electrode_id,
+        func.count(BaselineResponseStrength.id),
+        func.max(BaselineResponseStrength.id),
+    ).select_from(BaselineResponseStrength).join(db.Baseline).join(db.Recording).group_by(db.Recording.electrode_id)
+    bg = {r[0]: (r[1], r[2]) for r in bg}
+
+    pairs = session.query(db.Pair.id, db.Cell.electrode_id).join(db.Pair.post_cell)
+    return {pair_id: fg.get(pair_id, (0, None)) + bg.get(post_elec_id, (0, None)) for pair_id, post_elec_id in pairs}
+
+
+def connection_strength_fingerprint(conn):
+    """Return the input fingerprint stored with a connection_strength record.
+    """
+    return (conn.n_fg_inputs or 0, conn.max_fg_input_id, conn.n_bg_inputs or 0, conn.max_bg_input_id)
 
 
 @db.default_session
@@ -643,6 +861,82 @@ def get_amps(session, pair, clamp_mode='ic'):
     return recs
 
 
+def get_pair_amps(session, pair_ids=None, clamp_mode='ic'):
+    """Select pulse_response_strength and baseline_response_strength records for many pairs at once.
+
+    Equivalent to calling get_amps and get_baseline_amps (with limit=len(fg)) for each pair,
+    but uses a single query for each table. If *pair_ids* is None, then all pairs are selected.
+
+    Returns (pair_ids, fg, fg_group, bg, bg_group), where *pair_ids* is a sorted array of pair IDs,
+    *fg* and *bg* are record arrays sorted by pair, and *fg_group* / *bg_group* give the index
+    into *pair_ids* for each record. Background records are repeated for each pair that shares
+    the same postsynaptic electrode.
+    """
+    select_all = pair_ids is None
+    pairs = session.query(db.Pair.id, db.Cell.electrode_id).join(db.Pair.post_cell)
+    if not select_all:
+        pairs = pairs.filter(db.Pair.id.in_(list(pair_ids)))
+    pairs = np.array(pairs.order_by(db.Pair.id).all(), dtype=int).reshape(-1, 2)
+    pair_ids, post_elecs = pairs[:, 0], pairs[:, 1]
+
+    q = session.query(
+        db.PulseResponse.pair_id,
+        PulseResponseStrength.id,
+        PulseResponseStrength.pos_amp,
+        PulseResponseStrength.neg_amp,
+        PulseResponseStrength.pos_dec_amp,
+        PulseResponseStrength.neg_dec_amp,
+        PulseResponseStrength.pos_dec_latency,
+        PulseResponseStrength.neg_dec_latency,
+        PulseResponseStrength.crosstalk,
+        db.PulseResponse.ex_qc_pass,
+        db.PulseResponse.in_qc_pass,
+        db.PatchClampRecording.clamp_mode,
+        db.StimPulse.pulse_number,
+    ).join(db.PulseResponse)
+    q, pre_rec, post_rec = join_pulse_response_to_expt(q)
+    if not select_all:
+        q = q.filter(db.PulseResponse.pair_id.in_(pair_ids.tolist()))
+    q = q.filter(db.PatchClampRecording.clamp_mode==clamp_mode)
+    q = q.filter(db.PatchClampRecording.qc_pass==True)
+    q = q.order_by(db.PulseResponse.pair_id, db.PulseResponse.id)
+    fg = pandas.read_sql_query(q.statement, q.session.bind).to_records()
+    fg = fg[np.in1d(fg['pair_id'], pair_ids)]
+    fg_group = np.searchsorted(pair_ids, fg['pair_id'])
+
+    q = session.query(
+        db.Recording.electrode_id,
+        BaselineResponseStrength.id,
+        BaselineResponseStrength.pos_amp,
+        BaselineResponseStrength.neg_amp,
+        BaselineResponseStrength.pos_dec_amp,
+        BaselineResponseStrength.neg_dec_amp,
+        BaselineResponseStrength.pos_dec_latency,
+        BaselineResponseStrength.neg_dec_latency,
+        BaselineResponseStrength.crosstalk,
+        db.Baseline.ex_qc_pass,
+        db.Baseline.in_qc_pass,
+        db.PatchClampRecording.clamp_mode,
+    ).join(db.Baseline).join(db.Recording).join(db.PatchClampRecording)
+    if not select_all:
+        q = q.filter(db.Recording.electrode_id.in_(np.unique(post_elecs).tolist()))
+    q = q.filter(db.PatchClampRecording.clamp_mode==clamp_mode)
+    q = q.filter(db.PatchClampRecording.qc_pass==True)
+    q = q.order_by(db.Recording.electrode_id, db.Baseline.id)
+    bg_recs = pandas.read_sql_query(q.statement, q.session.bind).to_records()
+
+    # select the first len(fg) background records from the postsynaptic electrode of each pair
+    elec_start = np.searchsorted(bg_recs['electrode_id'], post_elecs, side='left')
+    elec_stop = np.searchsorted(bg_recs['electrode_id'], post_elecs, side='right')
+    n_fg = np.bincount(fg_group, minlength=len(pair_ids))
+    n_bg = np.minimum(elec_stop - elec_start, n_fg)
+    bg_group = np.repeat(np.arange(len(pair_ids)), n_bg)
+    bg_index = np.concatenate([np.arange(i0, i0+n) for i0, n in zip(elec_start, n_bg)] + [np.zeros(0, dtype=int)])
+    bg = bg_recs[bg_index]
+
+    return pair_ids, fg, fg_group, bg, bg_group
+
+
 def get_baseline_amps_NO_ORM_VERSION(session, expt, dev, clamp_mode='ic'):
     # Tested this against the ORM version below; no difference in performance.
     query = """
@@ -1322,6 +1616,9 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--rebuild', action='store_true', default=False)
     parser.add_argument('--rebuild-connectivity', action='store_true', default=False, dest='rebuild_connectivity')
+    parser.add_argument('--resume', action='store_true', default=False, help='Continue an interrupted strength rebuild')
+    parser.add_argument('--update-connectivity', action='store_true', default=False, dest='update_connectivity',
+                        help='Recompute connectivity only for pairs whose strength records changed')
     parser.add_argument('--local', action='store_true', default=False)
     parser.add_argument('--workers', type=int, default=6)
     
@@ -1340,6 +1637,13 @@ if __name__ == '__main__':
         init_tables()
         rebuild_strength(parallel=(not args.local), workers=args.workers)
         rebuild_connectivity()
+    elif args.resume:
+        init_tables()
+        rebuild_strength(parallel=(not args.local), workers=args.workers)
+        rebuild_connectivity(incremental=True)
+    elif args.update_connectivity:
+        init_tables()
+        rebuild_connectivity(incremental=True)
     elif args.rebuild_connectivity and raw_input("Rebuild connectivity table? ") == 'y':
         print("drop tables..")
         connection_strength_tables.drop_tables()
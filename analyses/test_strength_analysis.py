@@ -0,0 +1,67 @@
+"""
+Regression test: analyze_response_strength_batch must give the same results as
+calling analyze_response_strength on each record.
+"""
+from __future__ import print_function, division
+from collections import namedtuple
+import numpy as np
+
+import response_strength as rs
+
+
+ResponseRec = namedtuple('ResponseRec', ['data', 'rec_start', 'pulse_start', 'pulse_dur', 'spike_time', 'clamp_mode'])
+BaselineRec = namedtuple('BaselineRec', ['data', 'clamp_mode'])
+
+
+def make_records(n=40, seed=0):
+    """Synthetic pulse responses with noise, crosstalk steps, PSP-like events,
+    varying lengths and both clamp modes.
+    """
+    rng = np.random.RandomState(seed)
+    dt = 1.0 / rs.default_sample_rate
+    recs = []
+    for i in range(n):
+        n_samples = int([40e-3, 50e-3, 60e-3][i % 3] / dt)
+        t = np.arange(n_samples) * dt
+        clamp_mode = 'ic' if i % 2 == 0 else 'vc'
+        scale = 1e-3 if clamp_mode == 'ic' else 20e-12
+        rec_start = rng.uniform(0, 10)
+        pulse_start = rng.uniform(9.5e-3, 10.5e-3)
+        pulse_dur = 2e-3
+        spike = pulse_start + rng.uniform(0.5e-3, 1.5e-3)
+
+        data = rng.normal(scale=0.05 * scale, size=n_samples) + rng.uniform(-70e-3, -60e-3)
+        # crosstalk during the stimulus pulse
+        data[(t >= pulse_start) & (t < pulse_start + pulse_dur)] += rng.uniform(-0.2, 0.2) * scale
+        # PSP-like event
+        onset = spike + rng.uniform(1e-3, 2e-3)
+        tt = np.clip(t - onset, 0, None)
+        data += rng.choice([-1, 1]) * rng.uniform(0, 1) * scale * (1 - np.exp(-tt / 1e-3)) * np.exp(-tt / 10e-3)
+
+        spike_time = None if i % 7 == 0 else rec_start + spike
+        recs.append(ResponseRec(data, rec_start, rec_start + pulse_start, pulse_dur, spike_time, clamp_mode))
+    return recs
+
+
+def check_batch_matches_scalar(recs, source, **kwds):
+    data, n_samples, pulse_times, spike_times, clamp_modes = rs.strength_inputs(recs, source)
+    batch = rs.analyze_response_strength_batch(data, pulse_times, spike_times, clamp_modes, n_samples=n_samples, **kwds)
+    for i, rec in enumerate(recs):
+        scalar = rs.analyze_response_strength(rec, source, **kwds)
+        for k in rs.strength_fields:
+            assert np.allclose(batch[k][i], scalar[k], rtol=1e-9, atol=0), (source, i, k, batch[k][i], scalar[k])
+
+
+def test_pulse_response_strength_batch():
+    check_batch_matches_scalar(make_records(), 'pulse_response')
+
+
+def test_pulse_response_strength_batch_options():
+    recs = make_records(n=12, seed=1)
+    check_batch_matches_scalar(recs, 'pulse_response', lpf=False)
+    check_batch_matches_scalar(recs, 'pulse_response', bsub=False, lowpass=2000)
+
+
+def test_baseline_strength_batch():
+    recs = [BaselineRec(rec.data, rec.clamp_mode) for rec in make_records(n=20, seed=2)]
+    check_batch_matches_scalar(recs, 'baseline')
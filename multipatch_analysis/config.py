@@ -13,10 +13,16 @@ synphys_db = "synphys"
 synphys_db_readonly_user = None
 synphys_data = None
 cache_path = "cache"
+cache_max_size = None        # byte budget for the local NWB cache; None for unlimited
+lims_cache_ttl = 7*24*3600   # seconds before cached LIMS records are refreshed; None disables the cache
+sync_copy_workers = 4        # number of files copied concurrently when syncing rigs to the server
+sync_max_rate = None         # total copy rate limit (bytes/s) when syncing rigs; None for unlimited
 rig_name = None
 n_headstages = 8
 raw_data_paths = []
 summary_files = []
+db_array_dtype = None        # eg 'float32' to downcast array columns on write
+db_array_compression = None  # None, 'zlib', or 'lz4'
 
 
 template = """
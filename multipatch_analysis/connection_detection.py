@@ -1,3 +1,4 @@
+import time, multiprocessing
 from copy import deepcopy
 import numpy as np
 import scipy.signal
@@ -10,6 +11,7 @@ from neuroanalysis.data import Trace, TraceList
 from neuroanalysis.fitting import StackedPsp
 from neuroanalysis.ui.plot_grid import PlotGrid
 from neuroanalysis.filter import bessel_filter
+from neuroanalysis.event_detection import exp_deconvolve
 
 
 class BaselineDistributor(Analyzer):
@@ -55,11 +57,9 @@ class MultiPatchSyncRecAnalyzer(Analyzer):
         
             [{pulse_n, pulse_ind, spike, response, baseline}, ...]
         
+        Window boundaries for all pulses are computed at once, and QC is applied
+        to all windows together (see qc.pulse_response_qc_pass_many).
         """
-        # detect presynaptic spikes
-        pulse_stim = PulseStimAnalyzer.get(pre_rec)
-        spikes = pulse_stim.evoked_spikes()
-        
         if not isinstance(pre_rec, MultiPatchProbe):
             # this does not look like the correct kind of stimulus; bail out
             # Ideally we can make this agnostic to the exact stim type in the future,
@@ -67,65 +67,178 @@ class MultiPatchSyncRecAnalyzer(Analyzer):
             # a baseline measurement.
             return []
 
-        dt = post_rec['primary'].dt
-        
+        win = self._pulse_windows(pre_rec, post_rec['primary'].dt, align_to, pre_pad, require_spike)
+        if win is None:
+            return []
+
+        # Add minimal QC metrics for excitatory and inhibitory measurements
+        ex_qc, in_qc = qc.pulse_response_qc_pass_many(post_rec, win['windows'], win['n_spikes'], win['adjacent'])
+        return self._build_responses(win, post_rec, ex_qc, in_qc)
+
+    def get_all_spike_responses(self, align_to='pulse', pre_pad=10e-3, require_spike=True):
+        """Return evoked responses for every ordered pair of devices in the sync recording.
+
+        Returns a dict {(pre_id, post_id): responses}, where responses is the list that
+        get_spike_responses(pre_rec, post_rec) would return. Pairs whose presynaptic
+        recording is not a MultiPatchProbe are omitted.
+
+        Response windows are computed once per presynaptic device, and the window
+        statistics used for QC are measured on all recordings at once from packed
+        (recordings, samples) arrays of the primary channel (and of the command
+        channel for voltage clamp recordings).
+        """
+        srec = self.srec
+        devs = srec.devices
+        recs = [srec[dev] for dev in devs]
+        vc_inds = [j for j, rec in enumerate(recs) if getattr(rec, 'clamp_mode', None) == 'vc']
+        packed = {}
+        def pack(chan):
+            if chan not in packed:
+                inds = range(len(recs)) if chan == 'primary' else vc_inds
+                try:
+                    packed[chan] = np.stack([recs[j][chan].data for j in inds])
+                except Exception:
+                    # recordings have different lengths, or a channel could not be loaded
+                    # (eg. "Holding value unknown"); QC stats are measured for each recording separately
+                    packed[chan] = None
+            return packed[chan]
+
+        result = {}
+        for pre_id, pre_rec in zip(devs, recs):
+            if not isinstance(pre_rec, MultiPatchProbe):
+                continue
+            windows = {}  # window info for each postsynaptic sample period
+            stats = {}    # (dt, channel) => QC stats for all channels
+            for j, (post_id, post_rec) in enumerate(zip(devs, recs)):
+                if post_rec is pre_rec:
+                    continue
+                dt = post_rec['primary'].dt
+                if dt not in windows:
+                    windows[dt] = self._pulse_windows(pre_rec, dt, align_to, pre_pad, require_spike)
+                win = windows[dt]
+                if win is None:
+                    result[(pre_id, post_id)] = []
+                    continue
+
+                primary_stats = command_stats = None
+                if pack('primary') is not None:
+                    if (dt, 'primary') not in stats:
+                        stats[(dt, 'primary')] = qc.pulse_window_stats(pack('primary'), win['windows'])
+                    primary_stats = [x[j] for x in stats[(dt, 'primary')]]
+                if post_rec.clamp_mode == 'vc' and pack('command') is not None:
+                    if (dt, 'command') not in stats:
+                        stats[(dt, 'command')] = qc.pulse_window_stats(pack('command'), win['windows'])
+                    command_stats = [x[vc_inds.index(j)] for x in stats[(dt, 'command')]]
+
+                ex_qc, in_qc = qc.pulse_response_qc_pass_many(post_rec, win['windows'], win['n_spikes'], win['adjacent'],
+                                                              primary_stats=primary_stats, command_stats=command_stats)
+                result[(pre_id, post_id)] = self._build_responses(win, post_rec, ex_qc, in_qc)
+
+        return result
+
+    def _pulse_windows(self, pre_rec, dt, align_to, pre_pad, require_spike):
+        """Return a dict describing the response windows for the evoked spikes in *pre_rec*,
+        or None if no pulses are selected.
+
+        Everything here depends only on the presynaptic recording (and the postsynaptic
+        sample period *dt*), so it can be shared by all postsynaptic recordings.
+        """
+        # detect presynaptic spikes
+        pulse_stim = PulseStimAnalyzer.get(pre_rec)
+        spikes = pulse_stim.evoked_spikes()
+
+        # select pulses to extract
+        if require_spike:
+            inds = np.array([i for i,pulse in enumerate(spikes) if pulse['spike'] is not None], dtype=int)
+        else:
+            inds = np.arange(len(spikes))
+        if len(inds) == 0:
+            return None
+
+        pulse_ind = np.array([pulse['pulse_ind'] for pulse in spikes], dtype=int)
+        pulse_len = np.array([pulse['pulse_len'] for pulse in spikes], dtype=int)
+
         # Select ranges to extract from postsynaptic recording
+        if align_to == 'spike':
+            # start recording window at the rising phase of the presynaptic spike
+            align = np.array([spikes[i]['spike']['rise_index'] for i in inds], dtype=int)
+        elif align_to == 'pulse':
+            # align to pulse onset
+            align = pulse_ind[inds]
+        else:
+            raise ValueError("align_to must be 'spike' or 'pulse'")
+        rec_start = np.maximum(0, align - int(pre_pad / dt))
+
+        # get times of nearby pulses
+        has_prev = inds > 0
+        has_next = inds + 1 < len(spikes)
+        this_pulse = pulse_ind[inds]
+        prev_pulse = np.where(has_prev, pulse_ind[inds-1] + pulse_len[inds-1], 0)
+        next_pulse = np.where(has_next, pulse_ind[np.minimum(inds+1, len(spikes)-1)], 0)
+
+        # truncate window early if there is another pulse; otherwise, stop 50 ms later
+        max_stop = rec_start + int(50e-3 / dt)
+        rec_stop = np.where(has_next, np.minimum(max_stop, next_pulse), max_stop)
+
+        # select baseline region between 8th and 9th pulses (shared by all pulses)
+        base_stop = spikes[8]['pulse_ind']
+        base_start = base_stop - int(100e-3 / dt)
+
+        # Extract presynaptic spike and stimulus command
+        pre_trace = pre_rec['primary']
+        command = pre_rec['command']
+        pre_chunks = []
+        command_chunks = []
+        for start, stop in zip(rec_start, rec_stop):
+            pre_chunks.append(pre_trace[int(start):int(stop)])
+            command_chunks.append(command[int(start):int(stop)])
+
+        return {
+            'spikes': [spikes[i] for i in inds],
+            'windows': np.column_stack([rec_start, rec_stop]),
+            'n_spikes': np.array([0 if spikes[i]['spike'] is None else 1 for i in inds]),  # eventually should check for multiple spikes
+            'adjacent': np.where(
+                np.column_stack([has_prev, has_next]),
+                np.column_stack([prev_pulse - this_pulse, next_pulse - this_pulse]) * dt,
+                np.inf,
+            ),
+            'baseline': (base_start, base_stop),
+            'pre_rec': pre_chunks,
+            'command': command_chunks,
+        }
+
+    def _build_responses(self, win, post_rec, ex_qc, in_qc):
+        """Return the list of response records for one postsynaptic recording, given the
+        windows from _pulse_windows() and the QC results for each window.
+        """
+        post_trace = post_rec['primary']
+
+        # windows are clipped to the end of the recording, as slicing would do
+        windows = win['windows']
+        assert np.all(np.minimum(windows[:, 1], len(post_trace)) > windows[:, 0])
+
+        base_start, base_stop = win['baseline']
+        baseline = post_trace[base_start:base_stop]
+        assert len(baseline) > 0
+
         result = []
-        for i,pulse in enumerate(spikes):
-            pulse = pulse.copy()
-            spike = pulse['spike']
-            if require_spike and spike is None:
-                continue
-            
-            if align_to == 'spike':
-                # start recording window at the rising phase of the presynaptic spike
-                pulse['rec_start'] = spike['rise_index'] - int(pre_pad / dt)
-            elif align_to == 'pulse':
-                # align to pulse onset
-                pulse['rec_start'] = pulse['pulse_ind'] - int(pre_pad / dt)
-            pulse['rec_start'] = max(0, pulse['rec_start'])
-            
-            # get times of nearby pulses
-            prev_pulse = None if i == 0 else spikes[i-1]['pulse_ind'] + spikes[i-1]['pulse_len']
-            this_pulse = pulse['pulse_ind']
-            next_pulse = None if i+1 >= len(spikes) else spikes[i+1]['pulse_ind']
-
-            max_stop = pulse['rec_start'] + int(50e-3 / dt)
-            if next_pulse is not None:
-                # truncate window early if there is another pulse
-                pulse['rec_stop'] = min(max_stop, next_pulse)
-            else:
-                # otherwise, stop 50 ms later
-                pulse['rec_stop'] = max_stop
-            
+        for j,spike in enumerate(win['spikes']):
+            pulse = spike.copy()
+            start, stop = int(windows[j, 0]), int(windows[j, 1])
+            pulse['rec_start'] = start
+            pulse['rec_stop'] = stop
+
             # Extract data from postsynaptic recording
-            pulse['response'] = post_rec['primary'][pulse['rec_start']:pulse['rec_stop']]
-            assert len(pulse['response']) > 0
-
-            # Extract presynaptic spike and stimulus command
-            pulse['pre_rec'] = pre_rec['primary'][pulse['rec_start']:pulse['rec_stop']]
-            pulse['command'] = pre_rec['command'][pulse['rec_start']:pulse['rec_stop']]
-
-            # select baseline region between 8th and 9th pulses
-            baseline_dur = int(100e-3 / dt)
-            stop = spikes[8]['pulse_ind']
-            start = stop - baseline_dur
-            pulse['baseline'] = post_rec['primary'][start:stop]
-            pulse['baseline_start'] = start
-            pulse['baseline_stop'] = stop
-
-            # Add minimal QC metrics for excitatory and inhibitory measurements
-            pulse_window = [pulse['rec_start'], pulse['rec_stop']]
-            n_spikes = 0 if spike is None else 1  # eventually should check for multiple spikes
-            adj_pulse_times = []
-            if prev_pulse is not None:
-                adj_pulse_times.append((prev_pulse - this_pulse) * dt)
-            if next_pulse is not None:
-                adj_pulse_times.append((next_pulse - this_pulse) * dt)
-            pulse['ex_qc_pass'], pulse['in_qc_pass'] = qc.pulse_response_qc_pass(post_rec=post_rec, window=pulse_window, n_spikes=n_spikes, adjacent_pulses=adj_pulse_times)
-
-            assert len(pulse['baseline']) > 0
+            pulse['response'] = post_trace[start:stop]
+            pulse['pre_rec'] = win['pre_rec'][j]
+            pulse['command'] = win['command'][j]
 
+            pulse['baseline'] = baseline
+            pulse['baseline_start'] = base_start
+            pulse['baseline_stop'] = base_stop
+
+            pulse['ex_qc_pass'] = bool(ex_qc[j])
+            pulse['in_qc_pass'] = bool(in_qc[j])
             result.append(pulse)
         
         return result
@@ -212,17 +325,19 @@ class MultiPatchExperimentAnalyzer(Analyzer):
         self.expt = expt
         self._all_spikes = None
 
-    def get_evoked_responses(self, pre_id, post_id, clamp_mode='ic', stim_filter=None, min_duration=None, pulse_ids=None):
+    def get_evoked_responses(self, pre_id, post_id, clamp_mode='ic', stim_filter=None, min_duration=None, pulse_ids=None,
+                             accumulate=False, keep_traces=True):
         """Return all evoked responses from device pre_id to post_id with the given
         clamp mode and stimulus conditions.
         
         All traces are *downsampled* to the minimum sample rate across the set
         of returned responses.
         
-        Returns a list of (response, baseline) pairs. 
+        Returns a list of (response, baseline) pairs. *accumulate* and *keep_traces*
+        are passed to EvokedResponseGroup.
         """
         all_spikes = self._all_evoked_responses()
-        responses = EvokedResponseGroup(pre_id, post_id)
+        responses = EvokedResponseGroup(pre_id, post_id, accumulate=accumulate, keep_traces=keep_traces)
         if pre_id not in all_spikes or post_id not in all_spikes[pre_id]:
             return responses
         
@@ -280,6 +395,7 @@ class MultiPatchExperimentAnalyzer(Analyzer):
             all_spikes = {}
             for srec in self.expt.contents:
                 mp_analyzer = MultiPatchSyncRecAnalyzer.get(srec)
+                responses = mp_analyzer.get_all_spike_responses()
                 
                 for pre_rec in srec.recordings:
                     if not isinstance(pre_rec, MultiPatchProbe):
@@ -294,7 +410,7 @@ class MultiPatchExperimentAnalyzer(Analyzer):
                         post_id = post_rec.device_id
                         all_spikes[pre_id].setdefault(post_id, [])
                         spikes = {
-                            'spikes': mp_analyzer.get_spike_responses(pre_rec, post_rec),
+                            'spikes': responses[(pre_id, post_id)],
                             'pre_rec': pre_rec,
                             'post_rec': post_rec,
                         }
@@ -426,53 +542,187 @@ def plot_response_averages(expt, show_baseline=False, **kwds):
     return plots
 
 
+class TraceAccumulator(object):
+    """Running sum, sum of squares and count of traces, aligned on their first sample.
+
+    Traces are resampled on entry to the lowest sample rate seen so far. If a trace with
+    a lower sample rate is added later, the accumulated sums are resampled (and filtered)
+    again to match, so mean() and std() then differ slightly from TraceList.mean() of the
+    same traces, which resamples each trace only once. If all traces have the same sample
+    rate, mean() matches TraceList.mean(). As with TraceList.mean(), the result is clipped
+    to the length of the shortest trace.
+    """
+    def __init__(self, dt=None):
+        self.dt = dt
+        self.n = 0
+        self.sum = None
+        self.sumsq = None
+
+    def add(self, trace):
+        if self.dt is None or trace.dt > self.dt * (1 + 1e-9):
+            self._regrid(trace.dt)
+        data = np.asarray(self._resample(trace, self.dt).data, dtype=float)
+        self._add_sums(data, data**2, 1)
+
+    def merge(self, other):
+        """Add all traces accumulated by *other* into this accumulator.
+        """
+        if other.n == 0:
+            return
+        if self.dt is None or other.dt > self.dt * (1 + 1e-9):
+            self._regrid(other.dt)
+        s = self._resample(Trace(other.sum, dt=other.dt), self.dt).data
+        ss = self._resample(Trace(other.sumsq, dt=other.dt), self.dt).data
+        self._add_sums(s, ss, other.n)
+
+    def _add_sums(self, s, ss, n):
+        if self.sum is None:
+            self.sum = s.copy()
+            self.sumsq = ss.copy()
+        else:
+            # clip ragged ends to the shortest trace
+            m = min(len(self.sum), len(s))
+            self.sum = self.sum[:m]
+            self.sumsq = self.sumsq[:m]
+            self.sum += s[:m]
+            self.sumsq += ss[:m]
+        self.n += n
+
+    def _regrid(self, dt):
+        if self.sum is not None:
+            self.sum = self._resample(Trace(self.sum, dt=self.dt), dt).data
+            self.sumsq = self._resample(Trace(self.sumsq, dt=self.dt), dt).data
+        self.dt = dt
+
+    @staticmethod
+    def _resample(trace, dt):
+        if abs(trace.dt - dt) <= dt * 1e-9:
+            return trace
+        return trace.resample(sample_rate=1.0 / dt)
+
+    def mean(self):
+        if self.n == 0:
+            return None
+        return Trace(self.sum / self.n, dt=self.dt)
+
+    def std(self):
+        if self.n == 0:
+            return None
+        mean = self.sum / self.n
+        return Trace(np.sqrt(np.clip(self.sumsq / self.n - mean**2, 0, None)), dt=self.dt)
+
+
 class EvokedResponseGroup(object):
     """A group of similar synaptic responses.
 
     This is intended to be used as a container for many repeated responses evoked from
     a single pre/postsynaptic pair. It provides methods for computing the average,
     baseline-subtracted response and for fitting the average to a curve.
+
+    If *accumulate* is True, responses and baselines are also added to running sums
+    (see TraceAccumulator) that are used for the mean, std and baseline-subtracted mean,
+    aligned on their first sample. If *keep_traces* is also False, the traces themselves
+    are not stored, so memory use does not grow with the number of responses.
     """
-    def __init__(self, pre_id=None, post_id=None, **kwds):
+    def __init__(self, pre_id=None, post_id=None, accumulate=False, keep_traces=True, **kwds):
+        if not (accumulate or keep_traces):
+            raise ValueError("keep_traces=False requires accumulate=True")
         self.pre_id = pre_id
         self.post_id = post_id
         self.kwds = kwds
+        self.keep_traces = keep_traces
         self.responses = []
         self.baselines = []
         self.spikes = []
         self.commands = []
+        self._accumulators = (TraceAccumulator(), TraceAccumulator()) if accumulate else None
         self._bsub_mean = None
 
     def add(self, response, baseline, pre_spike=None, stim_command=None):
-        self.responses.append(response)
-        self.baselines.append(baseline)
-        self.spikes.append(pre_spike)
-        self.commands.append(stim_command)
+        if self._accumulators is not None:
+            self._accumulators[0].add(response)
+            if baseline is not None:
+                self._accumulators[1].add(baseline)
+        if self.keep_traces:
+            self.responses.append(response)
+            self.baselines.append(baseline)
+            self.spikes.append(pre_spike)
+            self.commands.append(stim_command)
+        self._bsub_mean = None
+
+    def merge(self, other):
+        """Add all responses from another EvokedResponseGroup to this one.
+
+        If either group accumulates, this group is switched to accumulator mode; traces are
+        only kept if both groups keep them.
+        """
+        if self._accumulators is None and other._accumulators is None:
+            self.responses.extend(other.responses)
+            self.baselines.extend(other.baselines)
+            self.spikes.extend(other.spikes)
+            self.commands.extend(other.commands)
+        else:
+            self._accumulators = self._get_accumulators()
+            for mine, theirs in zip(self._accumulators, other._get_accumulators()):
+                mine.merge(theirs)
+            if self.keep_traces and other.keep_traces:
+                self.responses.extend(other.responses)
+                self.baselines.extend(other.baselines)
+                self.spikes.extend(other.spikes)
+                self.commands.extend(other.commands)
+            else:
+                self.keep_traces = False
+                self.responses, self.baselines, self.spikes, self.commands = [], [], [], []
         self._bsub_mean = None
 
+    def _get_accumulators(self):
+        """Return this group's accumulators, or new ones built from its stored traces.
+        """
+        if self._accumulators is not None:
+            return self._accumulators
+        accumulators = (TraceAccumulator(), TraceAccumulator())
+        for response, baseline in zip(self.responses, self.baselines):
+            accumulators[0].add(response)
+            if baseline is not None:
+                accumulators[1].add(baseline)
+        return accumulators
+
     def __len__(self):
+        if self._accumulators is not None:
+            return self._accumulators[0].n
         return len(self.responses)
 
     def bsub_mean(self):
         """Return a baseline-subtracted, average evoked response trace between two cells.
 
-        All traces are downsampled to the minimum sample rate in the set.
+        All traces are downsampled to the minimum sample rate in the set. If there is no
+        baseline data, the average is returned without subtraction and its 'baseline_med'
+        and 'baseline_std' metadata are None.
         """
         if len(self) == 0:
             return None
 
         if self._bsub_mean is None:
-            responses = self.responses
-            baselines = self.baselines
-            
-            # downsample all traces to the same rate
-            # yarg: how does this change SNR?
-            avg = TraceList([r.copy(t0=0) for r in responses]).mean()
-            avg_baseline = TraceList([b.copy(t0=0) for b in baselines]).mean().data
+            if self._accumulators is not None:
+                avg = self._accumulators[0].mean()
+                avg_baseline = self._accumulators[1].mean()
+            else:
+                responses = self.responses
+                baselines = [b for b in self.baselines if b is not None]
+                
+                # downsample all traces to the same rate
+                # yarg: how does this change SNR?
+                avg = TraceList([r.copy(t0=0) for r in responses]).mean()
+                avg_baseline = TraceList([b.copy(t0=0) for b in baselines]).mean() if len(baselines) > 0 else None
+            avg_baseline = np.array([]) if avg_baseline is None else avg_baseline.data
 
             # subtract baseline
-            baseline = np.median(avg_baseline)
-            bsub = avg.data - baseline
+            if len(avg_baseline) == 0:
+                baseline = None
+                bsub = avg.data.copy()
+            else:
+                baseline = np.median(avg_baseline)
+                bsub = avg.data - baseline
 
             result = avg.copy(data=bsub)
             assert len(result.time_values) == len(result)
@@ -492,8 +742,18 @@ class EvokedResponseGroup(object):
     def mean(self):
         if len(self) == 0:
             return None
+        if self._accumulators is not None:
+            return self._accumulators[0].mean()
         return TraceList(self.responses).mean()
 
+    def std(self):
+        """Return the standard deviation across all responses at each sample, with
+        responses aligned on their first sample.
+        """
+        if len(self) == 0:
+            return None
+        return self._get_accumulators()[0].std()
+
     def fit_psp(self, **kwds):
         response = self.bsub_mean()
         if response is None:
@@ -501,7 +761,19 @@ class EvokedResponseGroup(object):
         return fit_psp(response, **kwds)
 
 
-def fit_psp(response, mode='ic', sign='any', xoffset=11e-3, yoffset=(0, 'fixed'), mask_stim_artifact=True, method='leastsq', fit_kws=None, **kwds):
+def fit_psp(response, mode='ic', sign='any', xoffset=11e-3, yoffset=(0, 'fixed'), mask_stim_artifact=True, method='leastsq', fit_kws=None, init_values=None, vary=True, **kwds):
+    """Fit a StackedPsp to an averaged response (stimulus at 10 ms).
+
+    If *sign* is 'any', the fit is run once for each amplitude sign and the best
+    fit is returned. *init_values* optionally gives initial values for parameters
+    that vary within bounds (values outside the bounds are ignored; only the
+    magnitude of 'amp' is used). If *vary* is False, no optimization is done: all
+    parameters are held at their values from *init_values* (or their defaults), so
+    the returned fit just evaluates the model there.
+
+    The returned fit has extra attributes ``fit_time`` (wall time in seconds),
+    ``n_fits`` and ``total_nfev`` summed over all sign attempts.
+    """
     t = response.time_values
     y = response.data
 
@@ -555,6 +827,25 @@ def fit_psp(response, mode='ic', sign='any', xoffset=11e-3, yoffset=(0, 'fixed')
     for amp, amp_min, amp_max in amps:
         p2 = base_params.copy()
         p2['amp'] = (amp, amp_min, amp_max)
+        if init_values is not None:
+            for k, v in init_values.items():
+                bounds = p2.get(k)
+                if not isinstance(bounds, tuple) or len(bounds) != 3:
+                    continue
+                if k == 'amp':
+                    v = abs(v) * np.sign(amp)
+                if bounds[1] <= v <= bounds[2]:
+                    p2[k] = (v, bounds[1], bounds[2])
+        if not vary:
+            for k, v in list(p2.items()):
+                if isinstance(v, str):
+                    # constraint expression
+                    continue
+                if init_values is not None and k in init_values:
+                    v = init_values[k]
+                elif isinstance(v, tuple):
+                    v = v[0]
+                p2[k] = (v, 'fixed')
         params.append(p2)
 
     dt = response.dt
@@ -571,18 +862,24 @@ def fit_psp(response, mode='ic', sign='any', xoffset=11e-3, yoffset=(0, 'fixed')
     if 'weight' not in fit_kws:
         fit_kws['weights'] = weight
     
+    start = time.time()
     best_fit = None
     best_score = None
+    total_nfev = 0
     for p in params:
         fit = psp.fit(y, x=t, params=p, fit_kws=fit_kws, method=method)
+        total_nfev += fit.nfev
         err = np.sum(fit.residual**2)
         if best_fit is None or err < best_score:
             best_fit = fit
             best_score = err
     fit = best_fit
+    fit.fit_time = time.time() - start
+    fit.n_fits = len(params)
+    fit.total_nfev = total_nfev
 
     # nrmse = fit.nrmse()
-    if 'baseline_std' in response.meta:
+    if response.meta.get('baseline_std') is not None:
         fit.snr = abs(fit.best_values['amp']) / response.meta['baseline_std']
         fit.err = fit.rmse() / response.meta['baseline_std']
     # print fit.best_values
@@ -593,12 +890,155 @@ def fit_psp(response, mode='ic', sign='any', xoffset=11e-3, yoffset=(0, 'fixed')
     return fit
 
 
+def estimate_psp(response, mode='ic', mask_stim_artifact=True, decay_tau=None, cutoff=2000., min_snr=4., min_ratio=2.):
+    """Cheap estimate of PSP sign, amplitude and onset from the peak of the
+    exponentially deconvolved response, for use as initial values in fit_psp.
+
+    Returns a dict with keys 'sign', 'amp' and 'xoffset'. 'sign' is '+' or '-' only
+    if the deconvolved peak is at least *min_snr* times the baseline noise and
+    *min_ratio* times the largest opposite-sign peak; otherwise it is 'any'.
+    """
+    if decay_tau is None:
+        decay_tau = 50e-3 if mode == 'ic' else 4e-3
+    dt = response.dt
+    y = response.data
+    i_stim = int(10e-3 / dt)
+    i_start = int((12e-3 if mask_stim_artifact else 10e-3) / dt)
+    i_stop = min(len(y) - 1, int(20e-3 / dt))
+    estimate = {'sign': 'any', 'amp': None, 'xoffset': None}
+    if i_stim < 2 or i_stop - i_start < 2:
+        return estimate
+
+    deconv = bessel_filter(exp_deconvolve(response, decay_tau), cutoff).data
+    noise = deconv[:i_stim].std()
+    win = deconv[i_start:i_stop] - np.median(deconv[:i_stim])
+    i_pos = np.argmax(win)
+    i_neg = np.argmin(win)
+    pos = win[i_pos]
+    neg = -win[i_neg]
+    if pos >= neg:
+        sign, s, i_peak, peak, other = '+', 1, i_pos, pos, neg
+    else:
+        sign, s, i_peak, peak, other = '-', -1, i_neg, neg, pos
+    if peak <= 0:
+        return estimate
+
+    # onset is where the deconvolved peak rises through half its height
+    j = i_peak
+    while j > 0 and s * win[j-1] > peak / 2.:
+        j -= 1
+    estimate['xoffset'] = response.time_values[i_start + j]
+    resp = s * (y[i_start:i_stop] - np.median(y[:i_stim]))
+    estimate['amp'] = s * max(resp.max(), 0)
+    if peak > min_snr * noise and peak > min_ratio * other:
+        estimate['sign'] = sign
+    return estimate
+
+
+def _fit_psp_estimated(response, kwds):
+    """Fit *response* starting from estimate_psp() (see fit_psp_many).
+    """
+    kwds = kwds.copy()
+    decay_tau = kwds.get('decay_tau')
+    if isinstance(decay_tau, tuple):
+        decay_tau = decay_tau[0]
+    est = estimate_psp(response, mode=kwds.get('mode', 'ic'), mask_stim_artifact=kwds.get('mask_stim_artifact', True), decay_tau=decay_tau)
+    if kwds.get('sign', 'any') == 'any':
+        kwds['sign'] = est['sign']
+    init = {}
+    if est['amp']:
+        init['amp'] = est['amp']
+    if est['xoffset'] is not None:
+        init['xoffset'] = est['xoffset']
+    kwds['init_values'] = init
+    fit = fit_psp(response, **kwds)
+    fit.estimate = est
+    return fit
+
+
+def _fit_psp_worker(args):
+    # fit results keep a reference to the model function, which can not be
+    # pickled, so only the outcome is sent back to the parent process
+    response, kwds = args
+    if response is None:
+        return None
+    fit = _fit_psp_estimated(response, kwds)
+    return {
+        # includes parameters that are not model arguments (eg. amp_ratio)
+        'values': {k: p.value for k, p in fit.params.items()},
+        'stderr': {k: p.stderr for k, p in fit.params.items()},
+        'correl': {k: p.correl for k, p in fit.params.items()},
+        'best_values': fit.best_values,
+        'success': fit.success,
+        'message': fit.message,
+        'nfev': fit.nfev,
+        'errorbars': fit.errorbars,
+        'covar': fit.covar,
+        'estimate': fit.estimate,
+        'fit_time': fit.fit_time,
+        'n_fits': fit.n_fits,
+        'total_nfev': fit.total_nfev,
+    }
+
+
+def fit_psp_many(responses, workers=None, **kwds):
+    """Fit a list of averaged responses with fit_psp in a pool of processes.
+
+    Each fit starts from estimate_psp(); if *sign* is 'any' and the estimated sign
+    is unambiguous, the opposite-sign fit is skipped. Extra keyword arguments are
+    passed to fit_psp. *workers* defaults to the number of CPUs; None entries in
+    *responses* give None.
+
+    Each fit has ``estimate``, ``fit_time``, ``n_fits`` and ``total_nfev`` attributes
+    for profiling (see fit_psp). Fit objects can not be sent between processes, so
+    with more than one worker the fit returned is rebuilt in this process by
+    evaluating the model at the parameter values found by the worker (without
+    optimizing again). The outcome of the worker's optimization is copied to it:
+    ``success``, ``message``, ``nfev``, ``errorbars`` and ``covar``, the ``stderr``
+    and ``correl`` of each parameter, and the profiling attributes. Other statistics
+    (residual, chisqr, aic, etc.) are computed from the rebuilt fit and match the
+    worker's.
+    """
+    responses = list(responses)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len([r for r in responses if r is not None]))
+    if workers <= 1:
+        return [None if r is None else _fit_psp_estimated(r, kwds) for r in responses]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(_fit_psp_worker, [(r, kwds) for r in responses])
+    finally:
+        pool.close()
+        pool.join()
+
+    fits = []
+    for response, result in zip(responses, results):
+        if result is None:
+            fits.append(None)
+            continue
+        fkwds = kwds.copy()
+        fkwds['sign'] = '-' if result['best_values']['amp'] < 0 else '+'
+        fkwds['init_values'] = result['values']
+        fkwds['vary'] = False
+        fit = fit_psp(response, **fkwds)
+        for k in ('estimate', 'fit_time', 'n_fits', 'total_nfev', 'success', 'message', 'nfev', 'errorbars', 'covar'):
+            setattr(fit, k, result[k])
+        for k, par in fit.params.items():
+            par.stderr = result['stderr'][k]
+            par.correl = result['correl'][k]
+        fits.append(fit)
+    return fits
+
+
 def detect_connections(expt):
     analyzer = MultiPatchExperimentAnalyzer.get(expt)
 
     # First get average evoked responses for all pre/post pairs with long decay time
     all_responses, rows, cols = analyzer.get_evoked_response_matrix(clamp_mode='ic', min_duration=16e-3)
 
+    pairs = []
     for pre_id in rows:
         for post_id in cols:
             try:
@@ -607,13 +1047,15 @@ def detect_connections(expt):
                     continue
             except KeyError:
                 continue
+            pairs.append((pre_id, post_id))
 
-            # fit average to extract PSP decay
-            fit = response.fit_psp(yoffset=0)
+    # fit averages to extract PSP decay
+    fits = fit_psp_many([all_responses[pair].bsub_mean() for pair in pairs], yoffset=0)
 
-            # make connectivity call
-            lsnr = np.log(fit.snr)
-            lnrmse = np.log(fit.nrmse())
-            if lsnr > lnrmse + 6:
-                print "Connection:", pre_id, post_id, fit.snr, fit.nrmse()
+    for (pre_id, post_id), fit in zip(pairs, fits):
+        # make connectivity call
+        lsnr = np.log(fit.snr)
+        lnrmse = np.log(fit.nrmse())
+        if lsnr > lnrmse + 6:
+            print "Connection:", pre_id, post_id, fit.snr, fit.nrmse()
 
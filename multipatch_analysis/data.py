@@ -12,6 +12,39 @@ class MultiPatchExperiment(MiesNwb):
     def create_sync_recording(self, sweep_id):
         return MultiPatchSyncRecording(self, sweep_id)
 
+    def sweep_ids(self):
+        """Return a sorted list of all sweep IDs in this file.
+
+        Unlike ``contents``, this does not create any sync recordings.
+        """
+        if self._sweeps is not None:
+            return [srec.key for srec in self._sweeps]
+        if getattr(self, '_timeseries', None) is None:
+            self._timeseries = {}
+            for ts_name, ts in self.hdf['acquisition/timeseries'].items():
+                src = dict([field.split('=') for field in ts.attrs['source'].split(';')])
+                src['hdf_group_name'] = 'acquisition/timeseries/' + ts_name
+                self._timeseries.setdefault(int(src['Sweep']), {})[int(src['AD'])] = src
+        return sorted(self._timeseries.keys())
+
+    def iter_sync_recordings(self, sweep_ids=None, release=True):
+        """Iterate over sync recordings, creating each one only when it is needed.
+
+        If *release* is True, then each recording is released (see
+        MultiPatchSyncRecording.release) after the caller is finished with it,
+        so that only one sweep is held in memory at a time.
+        """
+        if sweep_ids is None:
+            sweep_ids = self.sweep_ids()
+        cached = {} if self._sweeps is None else {srec.key: srec for srec in self._sweeps}
+        for sweep_id in sweep_ids:
+            srec = cached.get(sweep_id)
+            if srec is None:
+                srec = self.create_sync_recording(sweep_id)
+            yield srec
+            if release:
+                srec.release()
+
         
 class MultiPatchSyncRecording(MiesSyncRecording):
     def __init__(self, nwb, sweep_id):
@@ -54,6 +87,25 @@ class MultiPatchSyncRecording(MiesSyncRecording):
 
         return self._baseline_regions
 
+    def release(self):
+        """Detach all analyzers and drop cached trace data and HDF5 handles held by
+        this sync recording and its recordings.
+
+        The recording remains usable; data will be reloaded from the file if needed.
+        """
+        self._baseline_mask = None
+        self._baseline_regions = None
+        _detach_analyzers(self)
+        for rec in self.recordings:
+            _detach_analyzers(rec)
+            if isinstance(rec, MultiPatchProbe):
+                rec._base_regions = None
+                rec = rec._parent_rec
+            _detach_analyzers(rec)
+            rec._hdf_group = None
+            for chan in rec._channels.values():
+                chan._data = None
+
 
 class MultiPatchProbe(MiesRecording):
     def __init__(self, recording):
@@ -97,6 +149,14 @@ class Analyzer(object):
         setattr(obj, attr, self)
 
 
+def _detach_analyzers(obj):
+    """Remove all analyzers attached to *obj* (see Analyzer._attach).
+    """
+    for attr, val in list(obj.__dict__.items()):
+        if attr.startswith('_') and isinstance(val, Analyzer):
+            delattr(obj, attr)
+
+
 class PulseStimAnalyzer(Analyzer):
     """Used for analyzing a patch clamp recording with square-pulse stimuli.
     """
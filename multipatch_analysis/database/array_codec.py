@@ -0,0 +1,135 @@
+"""
+Compact binary encoding for arrays stored in NDArray columns.
+
+Arrays are stored as a short fixed header followed by the raw little-endian
+array data:
+
+   magic     4s   b'MPNA'
+   version   B    codec version (currently 1)
+   dtype     4s   numpy dtype string, eg b'<f4' (space padded)
+   compress  B    0=none, 1=zlib, 2=lz4
+   ndim      B    number of dimensions
+   shape     ndim * Q
+
+Blobs written by older versions with np.save (beginning with the .npy magic string)
+are still read transparently; see database.migrate_array_columns() to rewrite them.
+"""
+import io, struct, zlib
+import numpy as np
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+
+_array_magic = b'MPNA'
+_array_codec_version = 1
+_npy_magic = b'\x93NUMPY'
+_array_header = struct.Struct('<4sB4sBB')
+_compression_codes = {None: 0, 'zlib': 1, 'lz4': 2}
+_compression_names = {v:k for k,v in _compression_codes.items()}
+
+def encode_array(arr, dtype=None, compression=None):
+    """Encode an array into the compact binary format used for NDArray columns.
+
+    Parameters
+    ----------
+    arr : array
+        The array to encode. Object arrays are not supported.
+    dtype : str | None
+        If given, floating-point arrays are cast to this dtype before encoding
+        (eg. 'float32' to halve storage size).
+    compression : None | 'zlib' | 'lz4'
+        Optional compression applied to the array payload.
+    """
+    arr = np.asarray(arr)
+    if arr.dtype.hasobject:
+        raise TypeError("Cannot encode object arrays")
+    if dtype is not None and arr.dtype.kind == 'f':
+        arr = arr.astype(dtype)
+    # (ascontiguousarray returns at least 1 dimension)
+    arr = np.ascontiguousarray(arr, dtype=arr.dtype.newbyteorder('<')).reshape(arr.shape)
+    dtype_str = arr.dtype.str.encode('ascii')
+    if len(dtype_str) > 4:
+        raise TypeError("Cannot encode array with dtype %s" % arr.dtype)
+
+    payload = arr.tobytes()
+    if compression == 'zlib':
+        payload = zlib.compress(payload)
+    elif compression == 'lz4':
+        if lz4_frame is None:
+            raise ImportError("lz4 compression requested but the lz4 package is not installed")
+        payload = lz4_frame.compress(payload)
+    elif compression is not None:
+        raise ValueError("Unsupported compression %r" % compression)
+
+    header = _array_header.pack(_array_magic, _array_codec_version, dtype_str.ljust(4),
+                                _compression_codes[compression], arr.ndim)
+    shape = struct.pack('<%dQ' % arr.ndim, *arr.shape)
+    return header + shape + payload
+
+
+def decode_array(value, copy=False):
+    """Decode an array from a binary NDArray column value.
+
+    Accepts both the compact format written by encode_array() and legacy
+    .npy blobs. Compact arrays are decoded without copying, so they are
+    read-only views on the (decompressed) payload unless *copy* is True.
+
+    Raises ValueError if *value* is truncated or not a recognized encoding.
+    """
+    if value is None:
+        return None
+    prefix = bytes(value[:len(_npy_magic)])
+    if prefix == _npy_magic:
+        return np.load(io.BytesIO(value), allow_pickle=False)
+
+    if len(value) < _array_header.size:
+        raise ValueError("Array blob is too short (%d bytes) to contain a header" % len(value))
+    magic, version, dtype_str, compression, ndim = _array_header.unpack_from(value, 0)
+    if magic != _array_magic:
+        raise ValueError("Unrecognized array encoding (prefix %r)" % prefix)
+    if version > _array_codec_version:
+        raise ValueError("Array was encoded with newer codec version %d" % version)
+    if compression not in _compression_names:
+        raise ValueError("Unrecognized array compression code %d" % compression)
+    offset = _array_header.size
+    if len(value) < offset + 8 * ndim:
+        raise ValueError("Array blob is truncated (%d bytes) inside its %d-d shape" % (len(value), ndim))
+    shape = struct.unpack_from('<%dQ' % ndim, value, offset)
+    offset += 8 * ndim
+    try:
+        dtype = np.dtype(dtype_str.strip().decode('ascii'))
+    except (TypeError, UnicodeDecodeError):
+        raise ValueError("Unrecognized array dtype %r" % dtype_str)
+    if dtype.hasobject or dtype.itemsize == 0:
+        raise ValueError("Unsupported array dtype %s" % dtype)
+    n_bytes = int(np.prod(shape)) * dtype.itemsize
+
+    compression = _compression_names[compression]
+    if compression is None:
+        payload = value
+    else:
+        payload = bytes(value[offset:])
+        offset = 0
+        if compression == 'lz4' and lz4_frame is None:
+            raise ImportError("lz4 package is required to decode this array")
+        try:
+            if compression == 'zlib':
+                payload = zlib.decompress(payload)
+            else:
+                payload = lz4_frame.decompress(payload)
+        except Exception as exc:
+            raise ValueError("Could not decompress array payload (%s): %s" % (compression, exc))
+    if len(payload) - offset != n_bytes:
+        raise ValueError("Array blob has %d payload bytes; expected %d for %s %s" % (len(payload) - offset, n_bytes, shape, dtype))
+
+    arr = np.frombuffer(payload, dtype=dtype, count=n_bytes // dtype.itemsize, offset=offset).reshape(shape)
+    return arr.copy() if copy else arr
+
+
+def is_legacy_array(value):
+    """Return True if *value* is an array blob written with np.save.
+    """
+    return value is not None and bytes(value[:len(_npy_magic)]) == _npy_magic
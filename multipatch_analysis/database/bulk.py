@@ -0,0 +1,109 @@
+"""
+Fast insertion of large numbers of rows, bypassing the ORM.
+
+On PostgreSQL, rows are streamed to the server with ``COPY ... FROM STDIN``
+(CSV form); on other databases they are inserted with a single executemany.
+Primary keys can be allocated in advance so that rows in other tables may
+reference them without a round trip per row.
+"""
+import io, sys, csv, datetime
+
+from sqlalchemy import Boolean, DateTime, LargeBinary
+from sqlalchemy.sql import text
+
+from . import database as db
+from .. import config
+
+
+class BulkWriter(object):
+    """Inserts rows using the connection (and transaction) of an ORM session.
+
+    Example::
+
+        writer = BulkWriter(session)
+        ids = writer.allocate_ids(db.StimPulse, len(pulses))
+        writer.insert(db.StimPulse, [{'id': i, 'recording_id': ...} for i in ids])
+    """
+    def __init__(self, session):
+        self.session = session
+        self.conn = session.connection()
+        self.use_copy = self.conn.dialect.name == 'postgresql'
+
+    def allocate_ids(self, table, n):
+        """Reserve *n* primary key values for *table* and return them as a list.
+        """
+        table = getattr(table, '__table__', table)
+        if n == 0:
+            return []
+        if self.use_copy:
+            q = text("select nextval('%s_id_seq') from generate_series(1, :n)" % table.name)
+            return [r[0] for r in self.conn.execute(q, n=n)]
+        else:
+            # no sequences; assumes a single writer (eg. sqlite)
+            max_id = self.conn.execute(text("select max(id) from %s" % table.name)).fetchone()[0] or 0
+            return list(range(max_id + 1, max_id + n + 1))
+
+    def insert(self, table, rows):
+        """Insert a list of dicts into *table*.
+
+        All rows must have the same keys. Array columns may be given as numpy arrays;
+        they are encoded the same way NDArray does. time_created is filled in if it
+        is not given.
+        """
+        table = getattr(table, '__table__', table)
+        if len(rows) == 0:
+            return
+        if 'time_created' in table.c and 'time_created' not in rows[0]:
+            now = datetime.datetime.now()
+            for row in rows:
+                row['time_created'] = now
+
+        if self.use_copy:
+            self._copy(table, rows)
+        else:
+            self.conn.execute(table.insert(), rows)
+
+    def _copy(self, table, rows):
+        columns = list(rows[0].keys())
+        formatters = [_copy_formatter(table.c[col].type) for col in columns]
+
+        buf = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        writer = csv.writer(buf, lineterminator='\n')
+        for row in rows:
+            writer.writerow([None if row[col] is None else fmt(row[col]) for col, fmt in zip(columns, formatters)])
+
+        sql = "COPY %s (%s) FROM STDIN WITH CSV" % (table.name, ', '.join(columns))
+        cursor = self.conn.connection.cursor()
+        try:
+            buf.seek(0)
+            if hasattr(cursor, 'copy_expert'):
+                # psycopg2
+                cursor.copy_expert(sql, buf)
+            else:
+                # pg8000
+                data = buf.getvalue()
+                if not isinstance(data, bytes):
+                    data = data.encode('utf8')
+                cursor.execute(sql, stream=io.BytesIO(data))
+        finally:
+            cursor.close()
+
+
+def _copy_formatter(coltype):
+    """Return a function that converts python values to COPY CSV text for a column type.
+    """
+    if isinstance(coltype, db.NDArray):
+        return lambda v: '\\x' + _hex(db.encode_array(v, dtype=config.db_array_dtype, compression=config.db_array_compression))
+    if isinstance(coltype, LargeBinary):
+        return lambda v: '\\x' + _hex(v)
+    if isinstance(coltype, Boolean):
+        return lambda v: 't' if v else 'f'
+    if isinstance(coltype, DateTime):
+        return lambda v: v.isoformat()
+    if isinstance(coltype, db.FloatType):
+        return lambda v: repr(float(v))
+    return lambda v: v if isinstance(v, str) else str(v)
+
+
+def _hex(data):
+    return bytes(data).hex() if sys.version_info[0] >= 3 else bytes(data).encode('hex')
@@ -1,7 +1,8 @@
 """
 Accumulate all experiment data into a set of linked tables.
 """
-import os, io, time
+from __future__ import print_function
+import os, io, time, numbers
 import numpy as np
 
 import sqlalchemy
@@ -13,10 +14,12 @@ from sqlalchemy import create_engine, Column, Integer, String, Boolean, Float, D
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship, deferred, sessionmaker, aliased
+from sqlalchemy.sql import text, bindparam
 from sqlalchemy.types import TypeDecorator
 from sqlalchemy.sql.expression import func
 
 from .. import config
+from .array_codec import encode_array, decode_array, is_legacy_array
 
 default_sample_rate = 20000
 
@@ -207,19 +210,28 @@ table_schemas = {
 
 ORMBase = declarative_base()
 
+#-------------- array codec ----------------
+# see array_codec.py for the storage format
+
+# tables/columns that contain NDArray data
+array_columns = [('pulse_response', 'data'), ('baseline', 'data'), ('stim_pulse', 'data')]
+
+
 class NDArray(TypeDecorator):
     """For marshalling arrays in/out of binary DB fields.
+
+    Storage dtype and compression are taken from config.db_array_dtype and
+    config.db_array_compression.
     """
     impl = LargeBinary
-    
+
     def process_bind_param(self, value, dialect):
-        buf = io.BytesIO()
-        np.save(buf, value, allow_pickle=False)
-        return buf.getvalue()
-        
+        if value is None:
+            return None
+        return encode_array(value, dtype=config.db_array_dtype, compression=config.db_array_compression)
+
     def process_result_value(self, value, dialect):
-        buf = io.BytesIO(value)
-        return np.load(buf, allow_pickle=False)
+        return decode_array(value)
 
 
 class FloatType(TypeDecorator):
@@ -323,8 +335,8 @@ def create_all_mappings():
 
         @property
         def nwb_cache_file(self):
-            from ..synphys_cache import SynPhysCache
-            return SynPhysCache().get_cache(self.nwb_file)
+            from ..synphys_cache import get_cache
+            return get_cache().get_cache(self.nwb_file)
 
         @property
         def data(self):
@@ -335,11 +347,12 @@ def create_all_mappings():
 
             if not hasattr(self, '_data'):
                 from ..data import MultiPatchExperiment
+                from ..synphys_cache import get_cache
                 try:
                     self._data = MultiPatchExperiment(self.nwb_cache_file)
                 except IOError:
-                    os.remove(self.nwb_cache_file)
-                    self._data = MultiPatchExperiment(self.nwb_cache_file)
+                    # copy again only if the cached file is corrupt
+                    self._data = MultiPatchExperiment(get_cache().get_cache(self.nwb_file, verify=True))
             return self._data
 
         @property
@@ -475,6 +488,61 @@ def vacuum(tables=None):
                 conn.execute('vacuum analyze %s' % table)
 
 
+def migrate_array_columns(tables=None, batch_size=1000, dtype='config', compression='config'):
+    """Rewrite legacy np.save array blobs in place using the compact array codec.
+
+    Rows are processed in ID order in batches of *batch_size*; each batch is
+    committed separately so the migration can be interrupted and restarted.
+    Rows that are already in the compact format are left untouched.
+
+    Parameters
+    ----------
+    tables : list | None
+        Names of tables to migrate. By default, all tables listed in
+        *array_columns* are migrated.
+    dtype : str | None
+        Storage dtype for floating-point arrays, or None to keep the original
+        dtype. The default 'config' uses config.db_array_dtype.
+    compression : str | None
+        Compression for array payloads, or None for no compression. The default
+        'config' uses config.db_array_compression.
+
+    Returns a dict mapping table name to the number of rows rewritten.
+    """
+    dtype = config.db_array_dtype if dtype == 'config' else dtype
+    compression = config.db_array_compression if compression == 'config' else compression
+
+    counts = {}
+    for table, column in array_columns:
+        if tables is not None and table not in tables:
+            continue
+        select = text('select id, {col} from {table} where id > :last_id order by id limit :limit'.format(col=column, table=table))
+        update = text('update {table} set {col}=:data where id=:row_id'.format(col=column, table=table))
+        update = update.bindparams(bindparam('data', type_=LargeBinary))
+
+        n_rewritten = 0
+        last_id = -1
+        while True:
+            with engine.begin() as conn:
+                rows = conn.execute(select, last_id=last_id, limit=batch_size).fetchall()
+                if len(rows) == 0:
+                    break
+                updates = []
+                for row_id, value in rows:
+                    if not is_legacy_array(value):
+                        continue
+                    arr = decode_array(value)
+                    updates.append({'row_id': row_id, 'data': encode_array(arr, dtype=dtype, compression=compression)})
+                if len(updates) > 0:
+                    conn.execute(update, updates)
+                n_rewritten += len(updates)
+                last_id = rows[-1][0]
+            print("  %s: %d rows rewritten (last id %d)\r" % (table, n_rewritten, last_id), end='')
+        print("")
+        counts[table] = n_rewritten
+    return counts
+
+
 def default_session(fn):
     def wrap_with_session(*args, **kwds):
         close = False
@@ -513,3 +581,145 @@ def experiment_from_timestamp(ts, session=None):
 
 
 
+
+
+def _pulse_response_matrix_query(session, source):
+    """Return (query, id_column, metadata dtype) used by pulse_response_matrix.
+    """
+    if source == 'pulse_response':
+        # time of the first spike evoked by each pulse; pulses without a spike are kept
+        # by the outer join below and get spike_time=NaN
+        first_spike = session.query(
+            StimSpike.pulse_id.label('pulse_id'),
+            func.min(StimSpike.max_dvdt_time).label('max_dvdt_time'),
+        ).group_by(StimSpike.pulse_id).subquery()
+        q = session.query(
+            PulseResponse.id,
+            PulseResponse.data,
+            PulseResponse.pair_id,
+            PulseResponse.start_time,
+            StimPulse.pulse_number,
+            StimPulse.onset_time,
+            StimPulse.duration,
+            first_spike.c.max_dvdt_time,
+            PatchClampRecording.clamp_mode,
+            PulseResponse.ex_qc_pass,
+            PulseResponse.in_qc_pass,
+        )
+        q = q.join(StimPulse, PulseResponse.stim_pulse)
+        q = q.outerjoin(first_spike, first_spike.c.pulse_id==StimPulse.id)
+        q = q.join(Recording, PulseResponse.recording).join(PatchClampRecording).join(SyncRec)
+        id_col = PulseResponse.id
+        dtype = [
+            ('id', int), ('pair_id', int), ('start_time', float), ('pulse_number', int),
+            ('pulse_start', float), ('pulse_dur', float), ('spike_time', float),
+            ('clamp_mode', 'U2'), ('ex_qc_pass', bool), ('in_qc_pass', bool), ('n_samples', int),
+        ]
+    elif source == 'baseline':
+        q = session.query(
+            Baseline.id,
+            Baseline.data,
+            Baseline.start_time,
+            PatchClampRecording.clamp_mode,
+            Baseline.ex_qc_pass,
+            Baseline.in_qc_pass,
+        )
+        q = q.join(Recording, Baseline.recording).join(PatchClampRecording).join(SyncRec)
+        id_col = Baseline.id
+        dtype = [
+            ('id', int), ('start_time', float), ('clamp_mode', 'U2'),
+            ('ex_qc_pass', bool), ('in_qc_pass', bool), ('n_samples', int),
+        ]
+    else:
+        raise ValueError("Invalid source %s" % source)
+    return q, id_col, dtype
+
+
+@default_session
+def pulse_response_matrix(pair=None, experiment=None, filters=None, source='pulse_response', n_samples=None, chunk_size=1000, session=None):
+    """Load many pulse response (or baseline) traces into a single 2D array.
+
+    Matching rows are streamed from the server in chunks of *chunk_size* and copied
+    into a preallocated array, avoiding the creation of one ORM object per trace.
+
+    Parameters
+    ----------
+    pair : Pair | int | None
+        Select only responses recorded for this pair. For baseline data, this selects
+        baselines recorded from the postsynaptic cell of the pair.
+    experiment : Experiment | int | None
+        Select only data from this experiment.
+    filters : list | None
+        Extra SQLAlchemy filter expressions applied to the query (eg.
+        ``[PatchClampRecording.clamp_mode=='ic']``).
+    source : 'pulse_response' | 'baseline'
+        The table to load data from.
+    n_samples : int | None
+        Initial number of columns to allocate. The array is widened automatically
+        if longer traces are encountered.
+
+    Returns
+    -------
+    data : array
+        Float array of shape (n_responses, n_samples), ordered by ID. Rows shorter
+        than the longest trace are padded with NaN.
+    meta : array
+        Structured array with one record per row of *data*; the *n_samples* field
+        gives the number of valid samples in each row. For pulse responses, times
+        (start_time, pulse_start, spike_time) are relative to the beginning of the
+        recording; spike_time is NaN where no spike was detected.
+    """
+    q, id_col, meta_dtype = _pulse_response_matrix_query(session, source)
+
+    if pair is not None:
+        if isinstance(pair, numbers.Integral):
+            pair = session.query(Pair).get(int(pair))
+        if source == 'pulse_response':
+            q = q.filter(PulseResponse.pair_id==pair.id)
+        else:
+            q = q.filter(Recording.electrode_id==pair.post_cell.electrode_id)
+    if experiment is not None:
+        expt_id = int(experiment) if isinstance(experiment, numbers.Integral) else experiment.id
+        q = q.filter(SyncRec.experiment_id==expt_id)
+    for f in (filters or []):
+        q = q.filter(f)
+
+    n_rows = q.order_by(None).count()
+    if n_rows == 0:
+        return _fill_response_matrix([], 0, n_samples, source, meta_dtype)
+    q = q.order_by(id_col).yield_per(chunk_size)
+    return _fill_response_matrix(q, n_rows, n_samples, source, meta_dtype)
+
+
+def _fill_response_matrix(recs, n_rows, n_samples, source, meta_dtype):
+    """Copy the rows of *recs* (as returned by _pulse_response_matrix_query) into a
+    NaN-padded (n_rows, n_samples) array, widening it as needed. See pulse_response_matrix.
+    """
+    data = np.empty((n_rows, n_samples or 0), dtype=float)
+    data[:] = np.nan
+    meta = np.empty(n_rows, dtype=meta_dtype)
+
+    i = -1
+    for i, rec in enumerate(recs):
+        if i >= n_rows:
+            # rows were added since the count was taken
+            break
+        arr = rec.data
+        if len(arr) > data.shape[1]:
+            wider = np.empty((n_rows, len(arr)), dtype=float)
+            wider[:] = np.nan
+            wider[:, :data.shape[1]] = data
+            data = wider
+        data[i, :len(arr)] = arr
+
+        if source == 'pulse_response':
+            spike_time = np.nan if rec.max_dvdt_time is None else rec.max_dvdt_time
+            meta[i] = (rec.id, rec.pair_id, rec.start_time, rec.pulse_number, rec.onset_time,
+                       rec.duration, spike_time, rec.clamp_mode, bool(rec.ex_qc_pass),
+                       bool(rec.in_qc_pass), len(arr))
+        else:
+            meta[i] = (rec.id, rec.start_time, rec.clamp_mode, bool(rec.ex_qc_pass),
+                       bool(rec.in_qc_pass), len(arr))
+
+    # rows may have been deleted since the count was taken
+    return data[:i+1], meta[:i+1]
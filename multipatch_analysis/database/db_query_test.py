@@ -1,5 +1,4 @@
 from __future__ import print_function
-import io
 import numpy as np
 import pyqtgraph as pg
 from neuroanalysis.data import Trace, TraceList
@@ -13,42 +12,17 @@ ts = datetime.datetime.fromtimestamp(1502312765.005)
 pre_ch = 0
 post_ch = 6
 
-q = session.query(db.Experiment.id).filter(db.Experiment.acq_timestamp==ts)
-exp = q[0]
+expt = db.experiment_from_timestamp(ts, session=session)
+pair = [p for p in expt.pairs if p.pre_cell.electrode.device_id == pre_ch and p.post_cell.electrode.device_id == post_ch][0]
 
-
-conditions = [
-    "experiment.id=%s" % exp.id,
-    "pre_rec.device_key=%s" % pre_ch,
-    "post_rec.device_key=%s" % post_ch,
-    "post_pcrec.clamp_mode='ic'",
-    "multi_patch_probe.induction_frequency<100",
-    "(stim_pulse.pulse_number=1 or stim_pulse.pulse_number=9)",
+# first-pulse and recovery-pulse responses recorded in current clamp at < 100 Hz
+probes = session.query(db.MultiPatchProbe.patch_clamp_recording_id).filter(db.MultiPatchProbe.induction_frequency<100)
+filters = [
+    db.PatchClampRecording.clamp_mode=='ic',
+    db.PatchClampRecording.id.in_(probes),
+    db.StimPulse.pulse_number.in_([1, 9]),
 ]
-
-
-query = """
-    select 
-        pulse_response.data 
-    from 
-        pulse_response
-        join stim_pulse on pulse_response.pulse_id=stim_pulse.id
-        join recording post_rec on pulse_response.recording_id=post_rec.id
-        join patch_clamp_recording post_pcrec on post_pcrec.recording_id=post_rec.id
-        join multi_patch_probe on multi_patch_probe.patch_clamp_recording_id=post_pcrec.id
-        join recording pre_rec on stim_pulse.recording_id=pre_rec.id
-        join sync_rec on post_rec.sync_rec_id=sync_rec.id
-        join experiment on sync_rec.experiment_id=experiment.id
-    where
-        {conditions}
-""".format(conditions='\n        and '.join(conditions))
-
-print(query)
-
-rp = session.execute(query)
-
-recs = rp.fetchall()
-data = [np.load(io.BytesIO(rec[0])) for rec in recs]
+data, meta = db.pulse_response_matrix(pair=pair, filters=filters, session=session)
 print("\n\nloaded %d records" % len(data))
 
 
@@ -56,6 +30,7 @@ print("\n\nloaded %d records" % len(data))
 plt = pg.plot(labels={'left': ('Vm', 'V')})
 traces = TraceList()
 for i,x in enumerate(data):
+    x = x[:meta['n_samples'][i]]
     trace = Trace(x - np.median(x[:100]), sample_rate=20000)
     traces.append(trace)
     if i<100:
@@ -1,5 +1,5 @@
 from acq4.util.DataManager import getDirHandle
-import os, re, json, yaml, shutil
+import os, re, json, yaml, shutil, multiprocessing
 from collections import OrderedDict
 from datetime import datetime, timedelta
 import numpy as np
@@ -7,12 +7,14 @@ import pyqtgraph as pg
 from neuroanalysis.baseline import float_mode
 from neuroanalysis.data import PatchClampRecording
 from . import database as db
+from .bulk import BulkWriter
 from .. import lims
 from ..data import MultiPatchExperiment, MultiPatchProbe
 from ..connection_detection import PulseStimAnalyzer, MultiPatchSyncRecAnalyzer, BaselineDistributor
 from .. import config
 from .. import constants
 from .. import qc
+from ..util import StageTimer, MemoryMonitor
 
 
 class SliceSubmission(object):
@@ -131,9 +133,20 @@ class ExperimentDBSubmission(object):
     """
     message = "Generating database entries"
 
-    def __init__(self, expt):
+    # Number of consecutive sweeps analyzed per worker task. Tasks are handed out in
+    # sweep order and written in sweep order, so about workers * sweep_chunk_size
+    # analyzed sweeps are waiting to be written at any time.
+    sweep_chunk_size = 4
+
+    def __init__(self, expt, workers=None, bulk=True, stream=False, max_rss=None):
         self.expt = expt
+        self.workers = workers
+        self.bulk = bulk
+        self.stream = stream
+        self.timer = StageTimer()
+        self.memory = MemoryMonitor(budget=max_rss)
         self._fields = None
+        self._pool = None
 
     def submitted(self):
         ts = self.expt.datetime
@@ -270,206 +283,468 @@ class ExperimentDBSubmission(object):
 
         # Load NWB file and create data entries
         self._load_nwb(session, expt_entry, elecs_by_ad_channel, pairs_by_device_id)
+        with self.timer.stage('flush'):
+            session.flush()
 
         return expt_entry
 
     def _load_nwb(self, session, expt_entry, elecs_by_ad_channel, pairs_by_device_id):
-        nwb = self.expt.data
-        
-        for srec in nwb.contents:
-            temp = srec.meta.get('temperature', None)
-            srec_entry = db.SyncRec(ext_id=srec.key, experiment=expt_entry, temperature=temp)
-            session.add(srec_entry)
-            
-            srec_has_mp_probes = False
-            
-            rec_entries = {}
-            all_pulse_entries = {}
-            for rec in srec.recordings:
-                
-                # import all recordings
-                rec_entry = db.Recording(
-                    sync_rec=srec_entry,
-                    electrode=elecs_by_ad_channel[rec.device_id],  # should probably just skip if this causes KeyError?
-                    start_time=rec.start_time,
-                )
-                session.add(rec_entry)
-                rec_entries[rec.device_id] = rec_entry
-                
-                # import patch clamp recording information
-                if not isinstance(rec, PatchClampRecording):
-                    continue
-                qc_pass = qc.recording_qc_pass(rec)
-                pcrec_entry = db.PatchClampRecording(
-                    recording=rec_entry,
-                    clamp_mode=rec.clamp_mode,
-                    patch_mode=rec.patch_mode,
-                    stim_name=rec.meta['stim_name'],
-                    baseline_potential=rec.baseline_potential,
-                    baseline_current=rec.baseline_current,
-                    baseline_rms_noise=rec.baseline_rms_noise,
-                    qc_pass=qc_pass,
-                )
-                session.add(pcrec_entry)
-
-                # import test pulse information
-                tp = rec.nearest_test_pulse
-                if tp is not None:
-                    tp_entry = db.TestPulse(
-                        start_index=tp.indices[0],
-                        stop_index=tp.indices[1],
-                        baseline_current=tp.baseline_current,
-                        baseline_potential=tp.baseline_potential,
-                        access_resistance=tp.access_resistance,
-                        input_resistance=tp.input_resistance,
-                        capacitance=tp.capacitance,
-                        time_constant=tp.time_constant,
-                    )
-                    session.add(tp_entry)
-                    pcrec_entry.nearest_test_pulse = tp_entry
-                    
-                # import information about STP protocol
-                if not isinstance(rec, MultiPatchProbe):
-                    continue
-                srec_has_mp_probes = True
-                psa = PulseStimAnalyzer.get(rec)
-                ind_freq, rec_delay = psa.stim_params()
-                mprec_entry = db.MultiPatchProbe(
-                    patch_clamp_recording=pcrec_entry,
-                    induction_frequency=ind_freq,
-                    recovery_delay=rec_delay,
-                )
-                session.add(mprec_entry)
-            
-                # import presynaptic stim pulses
-                pulses = psa.pulses()
-                
-                pulse_entries = {}
-                all_pulse_entries[rec.device_id] = pulse_entries
-                
-                rec_tvals = rec['primary'].time_values
-
-                for i,pulse in enumerate(pulses):
-                    # Record information about all pulses, including test pulse.
-                    t0 = rec_tvals[pulse[0]]
-                    t1 = rec_tvals[pulse[1]]
-                    data_start = max(0, t0 - 10e-3)
-                    data_stop = t0 + 10e-3
-                    pulse_entry = db.StimPulse(
-                        recording=rec_entry,
-                        pulse_number=i,
-                        onset_time=t0,
-                        amplitude=pulse[2],
-                        duration=t1-t0,
-                        data=rec['primary'].time_slice(data_start, data_stop).resample(sample_rate=20000).data,
-                        data_start_time=data_start,
-                    )
-                    session.add(pulse_entry)
-                    pulse_entries[i] = pulse_entry
-                    
-
-                # import presynaptic evoked spikes
-                # For now, we only detect up to 1 spike per pulse, but eventually
-                # this may be adapted for more.
-                spikes = psa.evoked_spikes()
-                for i,sp in enumerate(spikes):
-                    pulse = pulse_entries[sp['pulse_n']]
-                    if sp['spike'] is not None:
-                        spinfo = sp['spike']
-                        extra = {
-                            'peak_time': rec_tvals[spinfo['peak_index']],
-                            'max_dvdt_time': rec_tvals[spinfo['rise_index']],
-                            'max_dvdt': spinfo['max_dvdt'],
-                        }
-                        if 'peak_diff' in spinfo:
-                            extra['peak_diff'] = spinfo['peak_diff']
-                        if 'peak_value' in spinfo:
-                            extra['peak_value'] = spinfo['peak_value']
-                        
-                        pulse.n_spikes = 1
-                    else:
-                        extra = {}
-                        pulse.n_spikes = 0
-                    
-                    spike_entry = db.StimSpike(
-                        pulse=pulse,
-                        **extra
-                    )
-                    session.add(spike_entry)
-                    pulse.first_spike = spike_entry
-            
-            if not srec_has_mp_probes:
+        """Analyze all sweeps in the NWB file and write their DB entries.
+
+        In streaming mode (self.stream), sync recordings are created one at a time and
+        released after each is written, and the NWB file is closed when finished.
+        """
+        timer = self.timer
+        with timer.stage('load'):
+            nwb = self.expt.data
+            if self.stream:
+                sweep_ids = nwb.sweep_ids()
+                srecs = nwb.iter_sync_recordings(sweep_ids)
+            else:
+                sweep_ids = [srec.key for srec in nwb.contents]
+                srecs = nwb.contents
+
+        if self.workers is None or self.workers < 2 or len(sweep_ids) < 2:
+            try:
+                for srec in srecs:
+                    srec_data = extract_sync_rec(srec, timer)
+                    with timer.stage('orm'):
+                        self._write_sync_rec(session, srec_data, expt_entry, elecs_by_ad_channel, pairs_by_device_id)
+                    del srec_data
+                    self._check_memory(session)
+            finally:
+                if self.stream:
+                    self.expt.close_data()
+            return
+
+        # Analyze sweeps in a process pool; each worker opens its own handle to the NWB file.
+        # Results are written (by this process only) in sweep order.
+        k = self.sweep_chunk_size
+        chunks = [(nwb.filename, sweep_ids[i:i+k]) for i in range(0, len(sweep_ids), k)]
+        pool = self._pool
+        own_pool = pool is None
+        if own_pool:
+            pool = self._start_pool()
+        try:
+            results = {}
+            for chunk_data, times, qc_times in pool.imap_unordered(_extract_sync_recs, chunks):
+                timer.merge(times)
+                if qc_times is not None and qc.profile is not None:
+                    qc.profile.merge(qc_times)
+                for srec_data in chunk_data:
+                    results[srec_data['ext_id']] = srec_data
+                # write every sweep that is ready, in order
+                while len(sweep_ids) > 0 and sweep_ids[0] in results:
+                    with timer.stage('orm'):
+                        self._write_sync_rec(session, results.pop(sweep_ids.pop(0)), expt_entry, elecs_by_ad_channel, pairs_by_device_id)
+                self._check_memory(session)
+            if len(sweep_ids) > 0:
+                missing = [sweep_id for sweep_id in sweep_ids if sweep_id not in results]
+                raise Exception("%d sweeps were not written; sweeps missing from worker results: %s" % (len(sweep_ids), missing))
+        finally:
+            if own_pool:
+                pool.close()
+                pool.join()
+            if self.stream:
+                self.expt.close_data()
+
+    def _start_pool(self):
+        """Start the sweep worker pool, or return None if sweeps are analyzed in this process.
+        """
+        if self.workers is None or self.workers < 2:
+            return None
+        # Dispose DB engine before forking, otherwise child processes will
+        # inherit and muck with the same connections. See util/import_to_database.py
+        db.engine.dispose()
+        return multiprocessing.Pool(processes=self.workers)
+
+    def _check_memory(self, session):
+        """Record memory usage after a sweep is written; if we are over budget, then
+        push pending ORM objects to the DB so they are not all held until the end.
+        """
+        if not self.memory.sample():
+            with self.timer.stage('flush'):
+                session.flush()
+
+    def _write_sync_rec(self, session, srec_data, expt_entry, elecs_by_ad_channel, pairs_by_device_id):
+        """Create DB entries from the plain records generated by extract_sync_rec().
+
+        If self.bulk is True, then stim_pulse, stim_spike, pulse_response and baseline
+        rows are written with BulkWriter rather than through the ORM.
+        """
+        srec_entry = db.SyncRec(ext_id=srec_data['ext_id'], experiment=expt_entry, temperature=srec_data['temperature'])
+        session.add(srec_entry)
+
+        rec_entries = {}
+        all_pulse_entries = {}
+        for rec in srec_data['recordings']:
+            # import all recordings
+            rec_entry = db.Recording(
+                sync_rec=srec_entry,
+                electrode=elecs_by_ad_channel[rec['device_id']],  # should probably just skip if this causes KeyError?
+                start_time=rec['start_time'],
+            )
+            session.add(rec_entry)
+            rec_entries[rec['device_id']] = rec_entry
+
+            # import patch clamp recording information
+            pcrec = rec['patch_clamp']
+            if pcrec is None:
                 continue
-            
-            # import postsynaptic responses
-            mpa = MultiPatchSyncRecAnalyzer(srec)
-            for pre_dev in srec.devices:
-                for post_dev in srec.devices:
-                    if pre_dev == post_dev:
-                        continue
-
-                    # get all responses, regardless of the presence of a spike
-                    responses = mpa.get_spike_responses(srec[pre_dev], srec[post_dev], align_to='pulse', require_spike=False)
-                    post_tvals = srec[post_dev]['primary'].time_values
-                    for resp in responses:
-                        # base_entry = db.Baseline(
-                        #     recording=rec_entries[post_dev],
-                        #     start_index=resp['baseline_start'],
-                        #     stop_index=resp['baseline_stop'],
-                        #     data=resp['baseline'].resample(sample_rate=20000).data,
-                        #     mode=float_mode(resp['baseline'].data),
-                        # )
-                        # session.add(base_entry)
-                        pair_entry = pairs_by_device_id[(pre_dev, post_dev)]
-                        if resp['ex_qc_pass']:
-                            pair_entry.n_ex_test_spikes += 1
-                        if resp['in_qc_pass']:
-                            pair_entry.n_in_test_spikes += 1
-                        resp_entry = db.PulseResponse(
-                            recording=rec_entries[post_dev],
-                            stim_pulse=all_pulse_entries[pre_dev][resp['pulse_n']],
-                            pair=pair_entry,
-                            # baseline=base_entry,
-                            start_time=post_tvals[resp['rec_start']],
-                            data=resp['response'].resample(sample_rate=20000).data,
-                            ex_qc_pass=resp['ex_qc_pass'],
-                            in_qc_pass=resp['in_qc_pass'],
-                        )
-                        session.add(resp_entry)
-                        
-            # generate up to 20 baseline snippets for each recording
-            for dev in srec.devices:
-                rec = srec[dev]
-                rec_tvals = rec['primary'].time_values
-                dist = BaselineDistributor.get(rec)
-                for i in range(20):
-                    base = dist.get_baseline_chunk(20e-3)
-                    if base is None:
-                        # all out!
-                        break
-                    start, stop = base
-                    data = rec['primary'][start:stop].resample(sample_rate=20000).data
-
-                    ex_qc_pass, in_qc_pass = qc.pulse_response_qc_pass(rec, [start, stop], None, [])
-
-                    base_entry = db.Baseline(
-                        recording=rec_entries[dev],
-                        start_time=rec_tvals[start],
-                        data=data,
-                        mode=float_mode(data),
-                        ex_qc_pass=ex_qc_pass,
-                        in_qc_pass=in_qc_pass,
-                    )
-                    session.add(base_entry)
-            
-        
+            pcrec_entry = db.PatchClampRecording(recording=rec_entry, **pcrec['fields'])
+            session.add(pcrec_entry)
+
+            # import test pulse information
+            if pcrec['test_pulse'] is not None:
+                tp_entry = db.TestPulse(**pcrec['test_pulse'])
+                session.add(tp_entry)
+                pcrec_entry.nearest_test_pulse = tp_entry
+
+            # import information about STP protocol
+            mprec = pcrec['multi_patch_probe']
+            if mprec is None:
+                continue
+            mprec_entry = db.MultiPatchProbe(
+                patch_clamp_recording=pcrec_entry,
+                induction_frequency=mprec['induction_frequency'],
+                recovery_delay=mprec['recovery_delay'],
+            )
+            session.add(mprec_entry)
+
+        # count QC-passed responses for each pair
+        for resp in srec_data['responses']:
+            pair_entry = pairs_by_device_id[(resp['pre_dev'], resp['post_dev'])]
+            if resp['ex_qc_pass']:
+                pair_entry.n_ex_test_spikes += 1
+            if resp['in_qc_pass']:
+                pair_entry.n_in_test_spikes += 1
+
+        if self.bulk:
+            self._bulk_write_sync_rec(session, srec_data, rec_entries, pairs_by_device_id)
+            return
+
+        for rec in srec_data['recordings']:
+            if rec['patch_clamp'] is None or rec['patch_clamp']['multi_patch_probe'] is None:
+                continue
+            # import presynaptic stim pulses and evoked spikes
+            pulse_entries = {}
+            all_pulse_entries[rec['device_id']] = pulse_entries
+            for pulse in rec['patch_clamp']['multi_patch_probe']['pulses']:
+                pulse_entry = db.StimPulse(recording=rec_entries[rec['device_id']], **pulse['fields'])
+                session.add(pulse_entry)
+                pulse_entries[pulse['fields']['pulse_number']] = pulse_entry
+                for spike in pulse['spikes']:
+                    session.add(db.StimSpike(pulse=pulse_entry, **spike))
+
+        # import postsynaptic responses
+        for resp in srec_data['responses']:
+            pair_entry = pairs_by_device_id[(resp['pre_dev'], resp['post_dev'])]
+            resp_entry = db.PulseResponse(
+                recording=rec_entries[resp['post_dev']],
+                stim_pulse=all_pulse_entries[resp['pre_dev']][resp['pulse_n']],
+                pair=pair_entry,
+                start_time=resp['start_time'],
+                data=resp['data'],
+                ex_qc_pass=resp['ex_qc_pass'],
+                in_qc_pass=resp['in_qc_pass'],
+            )
+            session.add(resp_entry)
+
+        # import baseline snippets
+        for base in srec_data['baselines']:
+            base_entry = db.Baseline(
+                recording=rec_entries[base['device_id']],
+                start_time=base['start_time'],
+                data=base['data'],
+                mode=base['mode'],
+                ex_qc_pass=base['ex_qc_pass'],
+                in_qc_pass=base['in_qc_pass'],
+            )
+            session.add(base_entry)
+
+    def _bulk_write_sync_rec(self, session, srec_data, rec_entries, pairs_by_device_id):
+        """Write stim_pulse, stim_spike, pulse_response and baseline rows for one sync rec
+        with BulkWriter.
+
+        Recording and pair entries are flushed first so that their IDs are known; stim_pulse
+        IDs are allocated in advance so that spikes and responses can reference them directly.
+        """
+        with self.timer.stage('flush'):
+            session.flush()
+        writer = BulkWriter(session)
+
+        mp_recs = [rec for rec in srec_data['recordings']
+                   if rec['patch_clamp'] is not None and rec['patch_clamp']['multi_patch_probe'] is not None]
+        n_pulses = sum([len(rec['patch_clamp']['multi_patch_probe']['pulses']) for rec in mp_recs])
+        with self.timer.stage('copy'):
+            pulse_ids = iter(writer.allocate_ids(db.StimPulse, n_pulses))
+
+        spike_cols = ['peak_time', 'peak_diff', 'peak_val', 'max_dvdt_time', 'max_dvdt']
+        pulse_rows = []
+        spike_rows = []
+        pulse_ids_by_dev = {}
+        for rec in mp_recs:
+            rec_id = rec_entries[rec['device_id']].id
+            ids = pulse_ids_by_dev.setdefault(rec['device_id'], {})
+            for pulse in rec['patch_clamp']['multi_patch_probe']['pulses']:
+                pulse_id = next(pulse_ids)
+                fields = pulse['fields']
+                ids[fields['pulse_number']] = pulse_id
+                row = {'id': pulse_id, 'recording_id': rec_id, 'n_spikes': None}
+                row.update(fields)
+                pulse_rows.append(row)
+                for spike in pulse['spikes']:
+                    row = {'pulse_id': pulse_id}
+                    for col in spike_cols:
+                        row[col] = spike.get(col)
+                    spike_rows.append(row)
+
+        resp_rows = []
+        for resp in srec_data['responses']:
+            resp_rows.append({
+                'recording_id': rec_entries[resp['post_dev']].id,
+                'pulse_id': pulse_ids_by_dev[resp['pre_dev']][resp['pulse_n']],
+                'pair_id': pairs_by_device_id[(resp['pre_dev'], resp['post_dev'])].id,
+                'start_time': resp['start_time'],
+                'data': resp['data'],
+                'ex_qc_pass': resp['ex_qc_pass'],
+                'in_qc_pass': resp['in_qc_pass'],
+            })
+
+        base_rows = []
+        for base in srec_data['baselines']:
+            base_rows.append({
+                'recording_id': rec_entries[base['device_id']].id,
+                'start_time': base['start_time'],
+                'data': base['data'],
+                'mode': base['mode'],
+                'ex_qc_pass': base['ex_qc_pass'],
+                'in_qc_pass': base['in_qc_pass'],
+            })
+
+        with self.timer.stage('copy'):
+            writer.insert(db.StimPulse, pulse_rows)
+            writer.insert(db.StimSpike, spike_rows)
+            writer.insert(db.PulseResponse, resp_rows)
+            writer.insert(db.Baseline, base_rows)
+
+    def timing_report(self):
+        """Return a string describing the time spent in each import stage.
+
+        'orm' is the time spent creating DB entries in this process; the rows are
+        written to the server during 'flush', 'copy' (bulk mode) and 'commit'.
+        When sweeps are analyzed in parallel, the load/detect/extract/resample
+        times are summed over all worker processes.
+        """
+        return self.timer.report()
+
+    def memory_report(self):
+        """Return a string describing the memory high-water mark during import.
+        """
+        return self.memory.report()
+
     def submit(self):
+        # fork sweep workers before a DB session is opened (see _start_pool)
+        self._pool = self._start_pool()
         session = db.Session()
         try:
             exp = self.create(session)
-            session.commit()
+            with self.timer.stage('commit'):
+                session.commit()
         except:
             session.rollback()
             raise
         finally:
             session.close()
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+
+def _extract_sync_recs(args):
+    """Process pool entry point: open an NWB file and extract data from the requested sweeps.
+    """
+    nwb_file, sweep_ids = args
+    timer = StageTimer()
+    if qc.profile is not None:
+        # collect QC times for this chunk only; they are merged by the parent process
+        qc.enable_profile()
+    with timer.stage('load'):
+        nwb = MultiPatchExperiment(nwb_file)
+    results = [extract_sync_rec(srec, timer) for srec in nwb.iter_sync_recordings(sweep_ids)]
+    nwb.close()
+    return results, timer.times, (None if qc.profile is None else qc.profile.times)
+
+
+def extract_sync_rec(srec, timer):
+    """Analyze one sync recording and return plain records (dicts, lists and arrays)
+    describing everything that ExperimentDBSubmission writes to the DB for it.
+
+    This function does not touch the DB, so it can run in a worker process.
+    """
+    srec_data = {
+        'ext_id': srec.key,
+        'temperature': srec.meta.get('temperature', None),
+        'recordings': [],
+        'responses': [],
+        'baselines': [],
+    }
+    srec_has_mp_probes = False
+
+    for rec in srec.recordings:
+        rec_data = {'device_id': rec.device_id, 'start_time': rec.start_time, 'patch_clamp': None}
+        srec_data['recordings'].append(rec_data)
+
+        # patch clamp recording information
+        if not isinstance(rec, PatchClampRecording):
+            continue
+        with timer.stage('detect'):
+            qc_pass = qc.recording_qc_pass(rec)
+            pcrec = {
+                'fields': {
+                    'clamp_mode': rec.clamp_mode,
+                    'patch_mode': rec.patch_mode,
+                    'stim_name': rec.meta['stim_name'],
+                    'baseline_potential': rec.baseline_potential,
+                    'baseline_current': rec.baseline_current,
+                    'baseline_rms_noise': rec.baseline_rms_noise,
+                    'qc_pass': qc_pass,
+                },
+                'test_pulse': None,
+                'multi_patch_probe': None,
+            }
+            rec_data['patch_clamp'] = pcrec
+
+            # test pulse information
+            tp = rec.nearest_test_pulse
+            if tp is not None:
+                pcrec['test_pulse'] = {
+                    'start_index': tp.indices[0],
+                    'stop_index': tp.indices[1],
+                    'baseline_current': tp.baseline_current,
+                    'baseline_potential': tp.baseline_potential,
+                    'access_resistance': tp.access_resistance,
+                    'input_resistance': tp.input_resistance,
+                    'capacitance': tp.capacitance,
+                    'time_constant': tp.time_constant,
+                }
+
+        # information about STP protocol
+        if not isinstance(rec, MultiPatchProbe):
+            continue
+        srec_has_mp_probes = True
+        with timer.stage('detect'):
+            psa = PulseStimAnalyzer.get(rec)
+            ind_freq, rec_delay = psa.stim_params()
+            pulses = psa.pulses()
+            spikes = psa.evoked_spikes()
+        mprec = {'induction_frequency': ind_freq, 'recovery_delay': rec_delay, 'pulses': []}
+        pcrec['multi_patch_probe'] = mprec
+
+        # presynaptic stim pulses
+        rec_tvals = rec['primary'].time_values
+        for i,pulse in enumerate(pulses):
+            # Record information about all pulses, including test pulse.
+            t0 = rec_tvals[pulse[0]]
+            t1 = rec_tvals[pulse[1]]
+            data_start = max(0, t0 - 10e-3)
+            data_stop = t0 + 10e-3
+            with timer.stage('extract'):
+                chunk = rec['primary'].time_slice(data_start, data_stop)
+            with timer.stage('resample'):
+                data = chunk.resample(sample_rate=20000).data
+            mprec['pulses'].append({
+                'fields': {
+                    'pulse_number': i,
+                    'onset_time': t0,
+                    'amplitude': pulse[2],
+                    'duration': t1-t0,
+                    'data': data,
+                    'data_start_time': data_start,
+                },
+                'spikes': [],
+            })
+
+        # presynaptic evoked spikes
+        # For now, we only detect up to 1 spike per pulse, but eventually
+        # this may be adapted for more.
+        for sp in spikes:
+            pulse = mprec['pulses'][sp['pulse_n']]
+            if sp['spike'] is not None:
+                spinfo = sp['spike']
+                extra = {
+                    'peak_time': rec_tvals[spinfo['peak_index']],
+                    'max_dvdt_time': rec_tvals[spinfo['rise_index']],
+                    'max_dvdt': spinfo['max_dvdt'],
+                }
+                if 'peak_diff' in spinfo:
+                    extra['peak_diff'] = spinfo['peak_diff']
+                if 'peak_value' in spinfo:
+                    # stored in the stim_spike.peak_val column
+                    extra['peak_val'] = spinfo['peak_value']
+                pulse['fields']['n_spikes'] = 1
+            else:
+                extra = {}
+                pulse['fields']['n_spikes'] = 0
+            pulse['spikes'].append(extra)
+
+    if not srec_has_mp_probes:
+        return srec_data
+
+    # postsynaptic responses
+    mpa = MultiPatchSyncRecAnalyzer(srec)
+    # get all responses for all pairs, regardless of the presence of a spike
+    with timer.stage('extract'):
+        all_responses = mpa.get_all_spike_responses(align_to='pulse', require_spike=False)
+    for pre_dev in srec.devices:
+        for post_dev in srec.devices:
+            if pre_dev == post_dev:
+                continue
+
+            responses = all_responses.get((pre_dev, post_dev), [])
+            post_tvals = srec[post_dev]['primary'].time_values
+            for resp in responses:
+                with timer.stage('resample'):
+                    data = resp['response'].resample(sample_rate=20000).data
+                srec_data['responses'].append({
+                    'pre_dev': pre_dev,
+                    'post_dev': post_dev,
+                    'pulse_n': resp['pulse_n'],
+                    'start_time': post_tvals[resp['rec_start']],
+                    'data': data,
+                    'ex_qc_pass': resp['ex_qc_pass'],
+                    'in_qc_pass': resp['in_qc_pass'],
+                })
+
+    # generate up to 20 baseline snippets for each recording
+    for dev in srec.devices:
+        rec = srec[dev]
+        rec_tvals = rec['primary'].time_values
+        dist = BaselineDistributor.get(rec)
+        with timer.stage('extract'):
+            bases = []
+            for i in range(20):
+                base = dist.get_baseline_chunk(20e-3)
+                if base is None:
+                    # all out!
+                    break
+                bases.append(base)
+            ex_qc_pass, in_qc_pass = qc.pulse_response_qc_pass_many(rec, bases, None, [[]] * len(bases))
+
+        for i, (start, stop) in enumerate(bases):
+            with timer.stage('extract'):
+                chunk = rec['primary'][start:stop]
+            with timer.stage('resample'):
+                data = chunk.resample(sample_rate=20000).data
+
+            srec_data['baselines'].append({
+                'device_id': dev,
+                'start_time': rec_tvals[start],
+                'data': data,
+                'mode': float_mode(data),
+                'ex_qc_pass': bool(ex_qc_pass[i]),
+                'in_qc_pass': bool(in_qc_pass[i]),
+            })
+
+    return srec_data
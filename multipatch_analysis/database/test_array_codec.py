@@ -0,0 +1,121 @@
+"""
+Round-trip tests for the NDArray column codec.
+"""
+from __future__ import print_function, division
+import io
+import numpy as np
+import pytest
+
+from multipatch_analysis.database import array_codec
+from multipatch_analysis.database.array_codec import encode_array, decode_array, is_legacy_array
+
+
+dtypes = ['float64', 'float32', '>f8', 'int16', 'int64', 'uint8', 'bool', 'complex128']
+compressions = [None, 'zlib', 'lz4']
+shapes = [(0,), (1,), (1000,), (3, 4), (2, 3, 4), ()]
+
+
+def make_array(dtype, shape, seed=0):
+    rng = np.random.RandomState(seed)
+    return (rng.normal(size=shape) * 100).astype(dtype)
+
+
+def check_compression(compression):
+    if compression == 'lz4' and array_codec.lz4_frame is None:
+        pytest.skip("lz4 is not installed")
+
+
+@pytest.mark.parametrize('compression', compressions)
+@pytest.mark.parametrize('dtype', dtypes)
+def test_round_trip(dtype, compression):
+    check_compression(compression)
+    for shape in shapes:
+        arr = make_array(dtype, shape)
+        value = encode_array(arr, compression=compression)
+        assert not is_legacy_array(value)
+        out = decode_array(value)
+        assert out.shape == arr.shape
+        assert out.dtype == arr.dtype.newbyteorder('<')
+        assert np.array_equal(out, arr)
+
+
+@pytest.mark.parametrize('compression', compressions)
+def test_downcast(compression):
+    check_compression(compression)
+    arr = make_array('float64', (500,))
+    out = decode_array(encode_array(arr, dtype='float32', compression=compression))
+    assert out.dtype == np.float32
+    assert np.array_equal(out, arr.astype('float32'))
+
+    # only floating-point arrays are downcast
+    arr = make_array('int64', (500,))
+    out = decode_array(encode_array(arr, dtype='float32', compression=compression))
+    assert out.dtype == np.int64
+    assert np.array_equal(out, arr)
+
+
+@pytest.mark.parametrize('compression', compressions)
+def test_copy(compression):
+    check_compression(compression)
+    arr = make_array('float64', (100,))
+    value = encode_array(arr, compression=compression)
+
+    # decoded arrays are read-only views unless a copy is requested
+    view = decode_array(value)
+    assert not view.flags.writeable
+    out = decode_array(value, copy=True)
+    out += 1
+    assert np.array_equal(out, arr + 1)
+    assert np.array_equal(decode_array(value), arr)
+
+
+@pytest.mark.parametrize('dtype', dtypes)
+def test_legacy(dtype):
+    for shape in shapes:
+        arr = make_array(dtype, shape)
+        buf = io.BytesIO()
+        np.save(buf, arr, allow_pickle=False)
+        value = buf.getvalue()
+        assert is_legacy_array(value)
+        out = decode_array(value)
+        assert out.dtype == arr.dtype
+        assert np.array_equal(out, arr)
+    assert not is_legacy_array(None)
+    assert decode_array(None) is None
+
+
+def test_buffer_types():
+    arr = make_array('float32', (10, 10))
+    for compression in (None, 'zlib'):
+        value = encode_array(arr, compression=compression)
+        assert np.array_equal(decode_array(bytearray(value)), arr)
+
+
+@pytest.mark.parametrize('compression', compressions)
+def test_invalid(compression):
+    check_compression(compression)
+    value = encode_array(make_array('float64', (3, 4)), compression=compression)
+
+    # truncated at every point: header, shape, and payload
+    for n in [0, 1, 4, array_codec._array_header.size - 1, array_codec._array_header.size + 3, len(value) - 1]:
+        with pytest.raises(ValueError):
+            decode_array(value[:n])
+
+    # trailing garbage (ignored after a compressed stream)
+    if compression is None:
+        with pytest.raises(ValueError):
+            decode_array(value + b'\0' * 8)
+
+    # bad magic, newer version, unknown compression and dtype
+    with pytest.raises(ValueError):
+        decode_array(b'XXXX' + value[4:])
+    for i, b in [(4, b'\x09'), (9, b'\x07'), (5, b'zz  ')]:
+        with pytest.raises(ValueError):
+            decode_array(value[:i] + b + value[i+len(b):])
+
+
+def test_encode_errors():
+    with pytest.raises(TypeError):
+        encode_array(np.array([None, 1]))
+    with pytest.raises(ValueError):
+        encode_array(np.zeros(3), compression='bz2')
@@ -0,0 +1,105 @@
+"""
+Tests for pulse_response_matrix that do not need a database connection: row
+assembly is tested with stand-in records, and the query is checked as compiled SQL.
+"""
+from __future__ import print_function, division
+from collections import namedtuple
+import numpy as np
+from sqlalchemy.dialects import postgresql
+
+from multipatch_analysis.database import database as db
+
+
+PulseResponseRec = namedtuple('PulseResponseRec', ['id', 'data', 'pair_id', 'start_time', 'pulse_number', 'onset_time',
+                                                   'duration', 'max_dvdt_time', 'clamp_mode', 'ex_qc_pass', 'in_qc_pass'])
+BaselineRec = namedtuple('BaselineRec', ['id', 'data', 'start_time', 'clamp_mode', 'ex_qc_pass', 'in_qc_pass'])
+
+
+def pulse_response_recs(lengths, seed=0):
+    rng = np.random.RandomState(seed)
+    recs = []
+    for i, n in enumerate(lengths):
+        spike = None if i % 2 else rng.uniform(10e-3, 12e-3)
+        recs.append(PulseResponseRec(i + 1, rng.normal(size=n), 7, i * 0.5, i % 8 + 1, 10e-3, 2e-3,
+                                     spike, 'ic' if i % 3 else 'vc', i % 4 != 0, None))
+    return recs
+
+
+def matrix_query_info(source):
+    session = db.Session()
+    try:
+        return db._pulse_response_matrix_query(session, source)
+    finally:
+        session.close()
+
+
+def fill(recs, n_rows, n_samples, source='pulse_response'):
+    q, id_col, meta_dtype = matrix_query_info(source)
+    return db._fill_response_matrix(recs, n_rows, n_samples, source, meta_dtype)
+
+
+def check_rows(data, meta, recs):
+    assert data.shape == (len(recs), max([len(r.data) for r in recs]))
+    for row, m, rec in zip(data, meta, recs):
+        n = len(rec.data)
+        assert m['n_samples'] == n
+        assert m['id'] == rec.id
+        assert np.array_equal(row[:n], rec.data)
+        # short rows are padded with NaN
+        assert np.all(np.isnan(row[n:]))
+
+
+def test_nan_padding():
+    recs = pulse_response_recs([100, 80, 100, 60, 90])
+    data, meta = fill(recs, len(recs), 100)
+    check_rows(data, meta, recs)
+
+    # spike_time is NaN where no spike was detected
+    for m, rec in zip(meta, recs):
+        if rec.max_dvdt_time is None:
+            assert np.isnan(m['spike_time'])
+        else:
+            assert m['spike_time'] == rec.max_dvdt_time
+    assert list(meta['clamp_mode']) == [rec.clamp_mode for rec in recs]
+    assert list(meta['in_qc_pass']) == [False] * len(recs)
+
+
+def test_widen():
+    # later rows longer than the initial allocation (or no initial allocation)
+    recs = pulse_response_recs([50, 60, 120, 40, 200, 30])
+    for n_samples in (None, 0, 50, 100, 300):
+        data, meta = fill(recs, len(recs), n_samples)
+        if n_samples is not None and n_samples > 200:
+            # never narrowed
+            assert data.shape == (len(recs), n_samples)
+            data = data[:, :200]
+        check_rows(data, meta, recs)
+
+
+def test_row_count_changes():
+    recs = pulse_response_recs([50, 60, 70, 80])
+    # rows deleted since the count was taken
+    data, meta = fill(recs[:2], 4, 80)
+    assert data.shape == (2, 80) and len(meta) == 2
+    # rows added since the count was taken
+    data, meta = fill(recs, 3, 80)
+    assert data.shape == (3, 80) and list(meta['id']) == [1, 2, 3]
+    # no rows
+    data, meta = fill([], 0, None)
+    assert data.shape == (0, 0) and len(meta) == 0
+
+
+def test_baseline_rows():
+    rng = np.random.RandomState(1)
+    recs = [BaselineRec(i, rng.normal(size=n), i * 0.1, 'ic', True, False) for i, n in enumerate([30, 50, 40])]
+    data, meta = fill(recs, len(recs), None, source='baseline')
+    check_rows(data, meta, recs)
+
+
+def test_first_spike_outer_join():
+    q, id_col, meta_dtype = matrix_query_info('pulse_response')
+    sql = ' '.join(str(q.statement.compile(dialect=postgresql.dialect())).split())
+    # pulses without a spike are kept, and pulses with several spikes appear once,
+    # with the time of the earliest spike
+    assert 'LEFT OUTER JOIN (SELECT stim_spike.pulse_id AS pulse_id, min(stim_spike.max_dvdt_time) AS max_dvdt_time FROM stim_spike GROUP BY stim_spike.pulse_id)' in sql
+    assert 'JOIN stim_spike' not in sql
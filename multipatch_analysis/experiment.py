@@ -9,6 +9,8 @@ import sys
 import re
 import traceback
 import pickle
+import sqlite3
+from contextlib import contextmanager
 from collections import OrderedDict
 
 import yaml
@@ -22,7 +24,7 @@ from .electrode import Electrode
 from .data import MultiPatchExperiment
 from .pipette_metadata import PipetteMetadata
 from .genotypes import Genotype
-from .synphys_cache import SynPhysCache
+from .synphys_cache import get_cache, CacheUnavailable
 from . import yaml_local, config
 
 
@@ -47,6 +49,7 @@ class Experiment(object):
         self._mosaic_file = None
         self._nwb_file = None
         self._data = None
+        self._data_pinned = False  # True if the NWB file is pinned in the synphys cache while open
         self._stim_list = None
         self._genotype = None
         self._cre_types = None
@@ -346,54 +349,45 @@ class Experiment(object):
     def _generate_cell_qc(self, ad_chan):
         # tempporary qc used to decide how many connections were probed in an
         # experiment. will be replaced with per-pulse-response qc later.
-        cache_file = os.path.join(os.path.dirname(config.configfile), 'cell_qc_cache.pkl')
-        
-        cache = {}
-        if os.path.isfile(cache_file):
-            try:
-                cache = pickle.load(open(cache_file, 'rb'))
-            except Exception:
-                sys.excepthook(*sys.exc_info())
-                print("Failed to load cell qc cache (error above).")
-        
-        cache_key = (self.nwb_file, ad_chan)
-        if cache_key not in cache:
-            nwb = self.data
-            holding_qc = False
-            access_qc = False
-            spiking_qc = False
+        cache = CellQCCache.get()
+        nwb_mtime = os.path.getmtime(self.nwb_file)
+        result = cache.lookup(self.nwb_file, ad_chan, nwb_mtime)
+        if result is None:
+            # compute QC for all channels in one pass over the file
             try:
-                passed_holding = 0
-                for srec in nwb.contents:
-                    try:
-                        rec = srec[ad_chan]
-                    except KeyError:
-                        continue
-                    if rec.clamp_mode == 'vc':
-                        if rec.baseline_current is not None and abs(rec.baseline_current) < 800e-12:
-                            passed_holding += 1
-                    else:
-                        vm = rec.baseline_potential
-                        if vm > -75e-3 and vm < -50e-3:
-                            passed_holding += 1
-                    if passed_holding >= 5:
-                        break
-                if passed_holding >= 5:
-                    holding_qc = True
-                    # need to fix these!
-                    access_qc = True
-                    spiking_qc = True
+                results = self._compute_cell_qc(self.data)
             finally:
                 self.close_data()
-            cache[cache_key] = (holding_qc, access_qc, spiking_qc)
-            
-            tmp_file = cache_file+'_tmp'
-            pickle.dump(cache, open(tmp_file, 'wb'))
-            if os.path.exists(cache_file):
-                os.remove(cache_file)
-            os.rename(tmp_file, cache_file)
-            
-        return cache[cache_key]
+            results.setdefault(ad_chan, (False, False, False))
+            cache.store(self.nwb_file, nwb_mtime, results)
+            result = results[ad_chan]
+        return result
+
+    @staticmethod
+    def _compute_cell_qc(nwb):
+        """Return {ad_chan: (holding_qc, access_qc, spiking_qc)} for all channels in *nwb*.
+        """
+        passed_holding = {}
+        for srec in nwb.contents:
+            for ad_chan in srec.devices:
+                n = passed_holding.setdefault(ad_chan, 0)
+                if n >= 5:
+                    continue
+                rec = srec[ad_chan]
+                if rec.clamp_mode == 'vc':
+                    if rec.baseline_current is not None and abs(rec.baseline_current) < 800e-12:
+                        passed_holding[ad_chan] += 1
+                else:
+                    vm = rec.baseline_potential
+                    if vm > -75e-3 and vm < -50e-3:
+                        passed_holding[ad_chan] += 1
+
+        results = {}
+        for ad_chan, n in passed_holding.items():
+            # need to fix access and spiking qc!
+            qc_pass = n >= 5
+            results[ad_chan] = (qc_pass, qc_pass, qc_pass)
+        return results
 
     def _load_old_format(self, entry):
         """Load experiment metadata from an old-style summary file
@@ -768,7 +762,7 @@ class Experiment(object):
     @property
     def nwb_cache_file(self):
         try:
-            return SynPhysCache().get_cache(self.nwb_file)
+            return get_cache().get_cache(self.nwb_file)
         except:
             # deprecated soon..
             if not os.path.isdir('cache'):
@@ -793,15 +787,32 @@ class Experiment(object):
         """
         if self._data is None:
             try:
+                # keep the cached file from being evicted while it is open
+                cache = get_cache()
+                local_file = cache.pin(self.nwb_file)
+            except CacheUnavailable:
+                # synphys cache is not configured for this file; fall back to nwb_cache_file
                 self._data = MultiPatchExperiment(self.nwb_cache_file)
-            except IOError:
-                os.remove(self.nwb_cache_file)
-                self._data = MultiPatchExperiment(self.nwb_cache_file)
+                self._data_pinned = False
+                return self._data
+            try:
+                try:
+                    self._data = MultiPatchExperiment(local_file)
+                except IOError:
+                    # copy again only if the cached file is corrupt
+                    self._data = MultiPatchExperiment(cache.get_cache(self.nwb_file, verify=True))
+            except Exception:
+                cache.unpin(self.nwb_file)
+                raise
+            self._data_pinned = True
         return self._data
 
     def close_data(self):
         self.data.close()
         self._data = None
+        if getattr(self, '_data_pinned', False):
+            get_cache().unpin(self.nwb_file)
+            self._data_pinned = False
 
     @property
     def specimen_id(self):
@@ -975,4 +986,81 @@ class Experiment(object):
             print(colors)
             self._graph = pg.GraphItem(pos=pos, adj=adj, size=30, symbolBrush=brushes)
             v.addItem(self._graph)
-        self._view_widget.show()
\ No newline at end of file
+        self._view_widget.show()
+
+
+class CellQCCache(object):
+    """Persistent cache of per-channel cell QC results, keyed by (nwb_file, ad_chan).
+
+    Results are stored in a SQLite file, which may be safely shared by concurrent
+    processes. Entries are invalid if the NWB file's mtime has changed since they
+    were computed.
+    """
+    _instance = None
+
+    @classmethod
+    def get(cls):
+        if cls._instance is None:
+            cls._instance = cls(os.path.join(os.path.dirname(config.configfile), 'cell_qc_cache.sqlite'))
+        return cls._instance
+
+    def __init__(self, filename):
+        self.filename = filename
+        new_cache = not os.path.isfile(filename)
+        with self._connect() as conn:
+            conn.execute("""
+                create table if not exists cell_qc (
+                    nwb_file text,
+                    ad_chan integer,
+                    nwb_mtime real,
+                    holding_qc integer,
+                    access_qc integer,
+                    spiking_qc integer,
+                    primary key (nwb_file, ad_chan)
+                )""")
+        legacy_file = os.path.splitext(filename)[0] + '.pkl'
+        if new_cache and os.path.isfile(legacy_file):
+            self._import_legacy(legacy_file)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.filename, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _import_legacy(self, legacy_file):
+        try:
+            cache = pickle.load(open(legacy_file, 'rb'))
+        except Exception:
+            sys.excepthook(*sys.exc_info())
+            print("Failed to load cell qc cache (error above).")
+            return
+        # legacy entries have no mtime; they are accepted until the NWB file changes
+        rows = [(nwb_file, ad_chan, None) + tuple(map(int, qc)) for (nwb_file, ad_chan), qc in cache.items()]
+        with self._connect() as conn:
+            conn.executemany("insert or ignore into cell_qc values (?, ?, ?, ?, ?, ?)", rows)
+
+    def lookup(self, nwb_file, ad_chan, nwb_mtime):
+        """Return cached (holding_qc, access_qc, spiking_qc) or None if there is no valid entry.
+        """
+        with self._connect() as conn:
+            row = conn.execute("select nwb_mtime, holding_qc, access_qc, spiking_qc from cell_qc where nwb_file=? and ad_chan=?",
+                               (nwb_file, ad_chan)).fetchone()
+            if row is None:
+                return None
+            if row[0] is None:
+                conn.execute("update cell_qc set nwb_mtime=? where nwb_file=?", (nwb_mtime, nwb_file))
+            elif row[0] != nwb_mtime:
+                return None
+        return tuple(bool(x) for x in row[1:])
+
+    def store(self, nwb_file, nwb_mtime, results):
+        """Replace all entries for *nwb_file* with *results* {ad_chan: (holding_qc, access_qc, spiking_qc)}.
+        """
+        rows = [(nwb_file, int(ad_chan), nwb_mtime) + tuple(map(int, qc)) for ad_chan, qc in results.items()]
+        with self._connect() as conn:
+            conn.execute("delete from cell_qc where nwb_file=?", (nwb_file,))
+            conn.executemany("insert into cell_qc values (?, ?, ?, ?, ?, ?)", rows)
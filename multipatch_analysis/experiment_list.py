@@ -7,6 +7,7 @@ import scipy.optimize
 import scipy.stats
 import sys
 import traceback
+import multiprocessing
 import warnings
 import datetime
 
@@ -14,12 +15,13 @@ import pyqtgraph as pg
 
 from .ui.graphics import MatrixItem, distance_plot
 from .experiment import Experiment
+from .experiment_store import ExperimentStore
 from .constants import INHIBITORY_CRE_TYPES, EXCITATORY_CRE_TYPES
-from . import config
+from . import config, lims
 
 
 _expt_list = None
-cache_file = os.path.join(os.path.dirname(__file__), '..', 'expts_cache.pkl')
+cache_file = os.path.join(os.path.dirname(__file__), '..', 'expts_cache.sqlite')
 def cached_experiments():
     global _expt_list, cache_file
     if _expt_list is None:
@@ -58,51 +60,218 @@ def indentation(line):
     return len(line) - len(line.lstrip('- '))
 
 
+def _load_yml_experiment(yml_file):
+    """Load one experiment from a pipettes.yml file (process pool entry point for
+    ExperimentList.load_from_server).
+
+    Returns (yml_file, experiment, None) on success or (yml_file, None, traceback_str) on error.
+    """
+    try:
+        return yml_file, Experiment(yml_file=yml_file), None
+    except Exception as exc:
+        if len(exc.args) > 0 and exc.args[0] == 'breakpoint':
+            raise
+        return yml_file, None, traceback.format_exc()
+
+
+def _select_fields(expt):
+    """Return a dict of the values that ExperimentList.select filters on for one experiment.
+
+    Values that cannot be determined (for example, if LIMS or the index file is
+    unavailable) are None, and the names of the fields whose lookup raised an
+    exception are listed under the '_failed' key.
+    """
+    failed = []
+    def get(name, fn):
+        try:
+            return fn()
+        except Exception:
+            failed.append(name)
+            return None
+
+    def calcium():
+        if 'solution' not in expt.expt_info:
+            return None
+        solution = expt.expt_info['solution']
+        if '2mM' in solution:
+            return 'high'
+        elif '1.3mM' in solution:
+            return 'low'
+        return ''
+
+    age = get('age', lambda: expt.age)
+    return {
+        'date': expt.date.toordinal(),
+        'region': get('region', lambda: expt.region),
+        'source_file': expt.source_id[0],
+        'organism': get('organism', lambda: expt.lims_record['organism']),
+        'age': None if age is None or np.isnan(age) else float(age),
+        'calcium': get('calcium', calcium),
+        'temperature': get('temperature', lambda: expt.expt_info['temperature'][:2]),
+        'rig': get('rig', lambda: expt.rig_name),
+        'cre_types': get('cre_types', lambda: list(expt.cre_types)) or [],
+        'target_layers': get('target_layers', lambda: list(expt.target_layers)) or [],
+        '_failed': failed,
+    }
+
+
 class ExperimentList(object):
+    """An ordered collection of Experiments, optionally backed by an on-disk cache.
 
+    If *cache* is given, it names an ExperimentStore (SQLite) file. Only the store's
+    index is read at startup; each Experiment is unpickled the first time it is accessed.
+    For compatibility, a legacy ``.pkl`` cache name is mapped to a ``.sqlite`` file
+    next to it, and the pickle is imported once if the store does not exist yet.
+    """
     def __init__(self, expts=None, cache=None):
         self._cache_version = 8
         self._cache = cache
-        self._expts = []
-        self._expts_by_datetime = {}
-        self._expts_by_uid = {}
-        self._expts_by_source_id = {}
+        self._store = None
+        self._uids = []                  # uids in list order
+        self._expts_by_uid = {}          # uid: Experiment, or None if not loaded from the store yet
+        self._uids_by_datetime = {}
+        self._uids_by_source_id = {}
+        self._unsaved = set()            # uids that need to be written to the store
+        self._removed = set()            # uids that need to be deleted from the store
+        self._source_stats = {}          # uid: (mtime, size) of the source file when the experiment was loaded
+        self._unsaved_stats = set()      # uids whose source stats (only) need to be written
+        self._select_fields = {}         # uid: dict of values used by select()
+        self._unsaved_fields = set()     # uids whose select fields (only) need to be written
+        self._select_index = None        # columnar index built from _select_fields; see _get_select_index()
         self.start_skip = []
         self.stop_skip = []
 
         if expts is not None:
             for expt in expts:
                 self.add_experiment(expt)
-        if cache is not None and os.path.isfile(cache):
+        if cache is not None:
             try:
-                self.load(cache)
+                self._open_store(cache)
             except Exception:
                 sys.excepthook(*sys.exc_info())
                 print('Error reading cache file "%s". (exception printed above)' % cache)
 
-    def load_from_server(self):
+    def _open_store(self, cache):
+        base, ext = os.path.splitext(cache)
+        legacy_file = base + '.pkl'
+        if ext == '.pkl':
+            cache = base + '.sqlite'
+            self._cache = cache
+        new_store = not os.path.isfile(cache)
+        self._store = ExperimentStore(cache, self._cache_version)
+
+        for uid, timestamp, source_id in self._store.index():
+            if uid in self._expts_by_uid:
+                continue
+            self._add_index(uid, datetime.datetime.fromtimestamp(timestamp), source_id, None)
+        self._uids.sort()
+        for uid, mtime, size in self._store.source_stats().values():
+            if mtime is not None:
+                self._source_stats[uid] = (mtime, size)
+        self._select_fields.update(self._store.select_fields())
+
+        if new_store and os.path.isfile(legacy_file):
+            print("Importing legacy experiment cache %s => %s" % (legacy_file, cache))
+            self._load_pickle(legacy_file)
+            self.write_cache()
+
+    def _add_index(self, uid, dt, source_id, expt):
+        self._select_index = None
+        self._uids.append(uid)
+        self._expts_by_uid[uid] = expt
+        self._uids_by_datetime[dt] = uid
+        self._uids_by_source_id[source_id] = uid
+
+    def _remove(self, uid):
+        self._select_index = None
+        self._uids.remove(uid)
+        del self._expts_by_uid[uid]
+        for index in (self._uids_by_datetime, self._uids_by_source_id):
+            for k, v in list(index.items()):
+                if v == uid:
+                    del index[k]
+        self._source_stats.pop(uid, None)
+        self._select_fields.pop(uid, None)
+        self._unsaved.discard(uid)
+        self._unsaved_stats.discard(uid)
+        self._unsaved_fields.discard(uid)
+        self._removed.add(uid)
+
+    def _get(self, uid):
+        """Return the experiment with *uid*, loading it from the store if needed.
+        """
+        expt = self._expts_by_uid[uid]
+        if expt is None:
+            expt = self._store.load(uid)
+            self._expts_by_uid[uid] = expt
+        return expt
+
+    @property
+    def _expts(self):
+        return [self._get(uid) for uid in self._uids]
+
+    def load_from_server(self, workers=None):
+        """Load experiments from all pipettes.yml files found on the server.
+
+        Files whose mtime and size are unchanged since they were loaded (or cached) are
+        skipped. New or modified files are parsed in a pool of *workers* processes
+        (default is the number of CPUs; use 1 to parse serially in this process).
+        """
         errs = []
 
-        # Load all pipettes.yml files found on server
+        # Find new / changed pipettes.yml files on server
         yamls = glob.glob(os.path.join(config.synphys_data, '*', 'slice_*', 'site_*', 'pipettes.yml'))
+        to_load = []
+        stats = {}
         for i,yml_file in enumerate(yamls):
             # if i>15:
                 # break
+            st = os.stat(yml_file)
+            stat = (st.st_mtime, st.st_size)
+            uid = self._uids_by_source_id.get((yml_file, None))
+            if uid is not None:
+                cached_stat = self._source_stats.get(uid)
+                if cached_stat is None:
+                    # cached before file stats were recorded; assume unchanged
+                    self._source_stats[uid] = stat
+                    self._unsaved_stats.add(uid)
+                    continue
+                if cached_stat == stat:
+                    continue
+            to_load.append(yml_file)
+            stats[yml_file] = stat
+
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if workers > 1 and len(to_load) > 1:
+            pool = multiprocessing.Pool(processes=workers)
             try:
-                expt = Experiment(yml_file=yml_file)
-                self.add_experiment(expt)
-            except Exception as exc:
-                if len(exc.args) > 0 and exc.args[0] == 'breakpoint':
-                    raise
-                errs.append((yml_file, sys.exc_info()))
+                results = pool.imap_unordered(_load_yml_experiment, to_load, chunksize=1)
+                order = {yml_file: i for i, yml_file in enumerate(to_load)}
+                results = sorted(results, key=lambda r: order[r[0]])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_load_yml_experiment, to_load)
+
+        for yml_file, expt, err in results:
+            if expt is None:
+                errs.append((yml_file, err))
                 continue
+            # replace any previously cached version of this experiment
+            for uid in set([self._uids_by_source_id.get((yml_file, None)), expt.uid]):
+                if uid in self._expts_by_uid:
+                    self._remove(uid)
+            self.add_experiment(expt)
+            self._source_stats[expt.uid] = stats[yml_file]
 
         if len(errs) > 0:
             print("Errors loading %d experiments from server:" % len(errs))
             for yml_file, exc in errs:
                 print("=======================")
                 print("yml:", yml_file)
-                traceback.print_exception(*exc)
+                print(exc)
                 src_file = open(os.path.join(os.path.dirname(yml_file), 'sync_source')).read()
                 print("source:", os.path.join(src_file, 'pipettes.yml'))
                 print("")
@@ -114,12 +283,13 @@ class ExperimentList(object):
             self._load_text(filename)
 
     def _load_pickle(self, filename):
-        el = pickle.load(open(filename))
+        el = pickle.load(open(filename, 'rb'))
         ver = getattr(el, '_cache_version', None)
         if ver != self._cache_version:
             print("Ignoring cache file %s due to incompatible version (%s != %s)" % (filename, ver, self._cache_version))
             return
-        for expt in el._expts:
+        # legacy caches pickled the entire list object
+        for expt in el.__dict__.get('_expts', []):
             self.add_experiment(expt)
         self.sort()
 
@@ -156,7 +326,7 @@ class ExperimentList(object):
         for entry in root.children:
             try:
                 expt_id = Experiment._id_from_entry(entry)
-                if expt_id in self._expts_by_source_id:
+                if expt_id in self._uids_by_source_id:
                     # Already have this experiment cached
                     print("SKIPPED:", expt_id)
                     cached += 1
@@ -184,59 +354,160 @@ class ExperimentList(object):
         if expt.uid in self._expts_by_uid:
             print("SKIP adding %s; ID already exists." % expt)
             return
-        self._expts.append(expt)
-        self._expts_by_uid[expt.uid] = expt
-        self._expts_by_datetime[expt.datetime] = expt
-        self._expts_by_source_id[expt.source_id] = expt
-        self._expts.sort(key=lambda ex: ex.uid)
+        self._add_index(expt.uid, expt.datetime, expt.source_id, expt)
+        self._uids.sort()
+        self._unsaved.add(expt.uid)
 
     def write_cache(self):
-        if self._cache is None:
+        """Write all experiments that were added since the cache was last read or written.
+        """
+        if self._cache is None or self._store is None:
             raise Exception("ExperimentList has no cache file; cannot write cache.")
-        pickle.dump(self, open(self._cache, 'w'))
+        self._prefetch_lims_records(self._unsaved)
+        for uid in self._unsaved:
+            self._get_select_fields(uid)
+        self._store.remove(sorted(self._removed))
+        # fields that could not be determined (eg. LIMS was unreachable) are not stored,
+        # so that they are computed again the next time the cache is read
+        fields = {uid: f for uid, f in self._select_fields.items() if len(f.get('_failed', [])) == 0}
+        self._store.upsert([self._expts_by_uid[uid] for uid in sorted(self._unsaved)], stats=self._source_stats, fields=fields)
+        self._store.set_source_stats({uid: self._source_stats[uid] for uid in self._unsaved_stats - self._unsaved})
+        self._store.set_select_fields({uid: fields[uid] for uid in self._unsaved_fields - self._unsaved if uid in fields})
+        self._unsaved = set()
+        self._removed = set()
+        self._unsaved_stats = set()
+        self._unsaved_fields = set()
+
+    def _get_select_fields(self, uid):
+        """Return the values used by select() for one experiment, computing them if needed.
+        """
+        fields = self._select_fields.get(uid)
+        if fields is None:
+            fields = _select_fields(self._get(uid))
+            self._select_fields[uid] = fields
+            if uid not in self._unsaved:
+                self._unsaved_fields.add(uid)
+        return fields
+
+    def _prefetch_lims_records(self, uids):
+        """Query LIMS records for all experiments in *uids* that have no select fields yet,
+        using a single batch query (see lims.specimen_info_many). The records are kept
+        in the LIMS cache, where Experiment.lims_record finds them.
+        """
+        uids = [uid for uid in uids if uid not in self._select_fields]
+        if len(uids) < 2:
+            return
+        try:
+            lims.specimen_info_many([self._get(uid).specimen_id for uid in uids])
+        except Exception:
+            # not fatal: records that were not prefetched are queried per experiment
+            sys.excepthook(*sys.exc_info())
+            print("Error prefetching LIMS records for %d experiments. (exception printed above)" % len(uids))
+
+    def _get_select_index(self):
+        """Return a columnar index of select fields for all experiments, in list order.
+
+        Returns (cols, sets) where *cols* is a structured array with one row per experiment
+        and *sets* maps 'cre_types' and 'target_layers' to (names, membership) where
+        membership[i, j] is True if experiment i has names[j].
+        """
+        if self._select_index is None:
+            self._prefetch_lims_records(self._uids)
+            fields = [self._get_select_fields(uid) for uid in self._uids]
+            cols = np.empty(len(fields), dtype=[
+                ('uid', object), ('date', int), ('region', object), ('source_file', object),
+                ('organism', object), ('age', float), ('has_calcium', bool), ('calcium', object),
+                ('temperature', object), ('rig', object),
+            ])
+            cols['uid'] = self._uids
+            for name in cols.dtype.names[1:]:
+                if name == 'age':
+                    cols[name] = [np.nan if f['age'] is None else f['age'] for f in fields]
+                elif name == 'has_calcium':
+                    cols[name] = [f['calcium'] is not None for f in fields]
+                else:
+                    cols[name] = [f[name] for f in fields]
+
+            sets = {}
+            for name in ('cre_types', 'target_layers'):
+                names = sorted(set([x for f in fields for x in f[name]]), key=str)
+                col = {x: j for j, x in enumerate(names)}
+                membership = np.zeros((len(fields), len(names)), dtype=bool)
+                for i, f in enumerate(fields):
+                    membership[i, [col[x] for x in f[name]]] = True
+                sets[name] = (names, membership)
+
+            self._select_index = (cols, sets)
+        return self._select_index
 
     def select(self, start=None, stop=None, region=None, source_files=None, cre_type=None, target_layer=None, calcium=None,
                age=None, temp=None, organism=None, rig=None):
-        expts = []
-        for ex in self._expts:
-            # filter experiments by experimental date and conditions
-            if calcium is not None:
-                if 'solution' in ex.expt_info:
-                    if '2mM' in ex.expt_info['solution']:
-                        ex_calcium = 'high'
-                    elif '1.3mM' in ex.expt_info['solution']:
-                        ex_calcium = 'low'
-                else:
-                    print("External calcium concentration not set for experiment %s" % str(ex.source_id))
-                    continue
-            if age is not None:
-                age_range = sorted([int(i) for i in age.split('-')])
-            if start is not None and ex.date < start:
-                continue
-            elif stop is not None and ex.date > stop:
-                continue
-            elif region is not None and ex.region != region:
-                continue
-            elif source_files is not None and ex.source_id[0] not in source_files:
-                continue
-            elif cre_type is not None and len(set(cre_type) & set(ex.cre_types)) == 0:
-                continue
-            elif target_layer is not None and len(set(target_layer) & set(ex.target_layers)) == 0:
-                continue
-            elif calcium is not None and calcium.lower() != ex_calcium:
-                continue
-            elif age is not None and ((ex.age < age_range[0]) or (ex.age > age_range[1])) :
-                continue
-            elif temp is not None and ex.expt_info['temperature'][:2] != temp:
-                continue
-            elif organism is not None and ex.lims_record['organism'] != organism:
-                continue
-            elif rig is not None and ex.rig_name != rig_name:
-                continue
-            else:
-                expts.append(ex)
+        """Return a new ExperimentList containing only experiments that match all of the given criteria.
 
-        el = ExperimentList(expts)
+        Filtering uses a columnar index of per-experiment fields that is built once and
+        stored in the cache, so experiments are not loaded unless their fields have not
+        been computed yet. The returned list loads experiments from the same cache on demand.
+        """
+        cols, sets = self._get_select_index()
+        mask = np.ones(len(cols), dtype=bool)
+
+        if calcium is not None:
+            for i in np.argwhere(~cols['has_calcium'])[:, 0]:
+                uid = cols['uid'][i]
+                print("External calcium concentration not set for experiment %s" % str(self._source_id(uid)))
+            mask &= cols['has_calcium'] & (cols['calcium'] == calcium.lower())
+        if start is not None:
+            mask &= cols['date'] >= start.toordinal()
+        if stop is not None:
+            mask &= cols['date'] <= stop.toordinal()
+        if region is not None:
+            mask &= cols['region'] == region
+        if source_files is not None:
+            source_files = set(source_files)
+            mask &= np.array([f in source_files for f in cols['source_file']], dtype=bool)
+        for name, values in (('cre_types', cre_type), ('target_layers', target_layer)):
+            if values is None:
+                continue
+            names, membership = sets[name]
+            values = set(values)
+            mask &= membership[:, [j for j, x in enumerate(names) if x in values]].any(axis=1)
+        if age is not None:
+            age_range = sorted([int(i) for i in age.split('-')])
+            with np.errstate(invalid='ignore'):
+                mask &= ~((cols['age'] < age_range[0]) | (cols['age'] > age_range[1]))
+        if temp is not None:
+            mask &= cols['temperature'] == temp
+        if organism is not None:
+            mask &= cols['organism'] == organism
+        if rig is not None:
+            mask &= cols['rig'] == rig
+
+        return self._view(cols['uid'][mask])
+
+    def prefetch(self, uids=None):
+        """Start copying the NWB files for the given experiment uids (default all) into
+        the local cache in a background thread, and return the thread.
+        """
+        from .synphys_cache import get_cache
+        uids = self._uids if uids is None else uids
+        return get_cache().prefetch([self[uid].nwb_file for uid in uids])
+
+    def _source_id(self, uid):
+        for src, u in self._uids_by_source_id.items():
+            if u == uid:
+                return src
+
+    def _view(self, uids):
+        """Return a new ExperimentList containing *uids*, sharing this list's loaded
+        experiments, select fields and cache (for reading only).
+        """
+        datetimes = {uid: dt for dt, uid in self._uids_by_datetime.items()}
+        source_ids = {uid: src for src, uid in self._uids_by_source_id.items()}
+        el = ExperimentList()
+        el._store = self._store
+        for uid in uids:
+            el._add_index(uid, datetimes[uid], source_ids[uid], self._expts_by_uid[uid])
+            el._select_fields[uid] = self._select_fields[uid]
         return el
 
     def __getitem__(self, item):
@@ -245,7 +516,7 @@ class ExperimentList(object):
         if isinstance(item, str):
             item = "%0.2f" % float(item) # force correct formatting
             try:
-                return self._expts_by_uid[item]
+                return self._get(item)
             except KeyError:
                 try:
                     date = datetime.datetime.fromtimestamp(float(item)).strftime('%Y-%m-%d %H:%M:%S')
@@ -253,21 +524,32 @@ class ExperimentList(object):
                     raise KeyError("No experiment in this list with UID '%s'" % (item,))
                 raise KeyError("No experiment in this list with UID '%s' (%s)" % (item, date))
         elif isinstance(item, datetime.datetime):
-            return self._expts_by_datetime[item]
+            return self._get(self._uids_by_datetime[item])
+        elif isinstance(item, slice):
+            return [self._get(uid) for uid in self._uids[item]]
         else:
-            return self._expts[item]
+            return self._get(self._uids[item])
 
     def __len__(self):
-        return len(self._expts)
+        return len(self._uids)
 
     def __iter__(self):
-        return self._expts.__iter__()
+        for uid in list(self._uids):
+            yield self._get(uid)
 
     def append(self, expt):
         self.add_experiment(expt)
 
-    def sort(self, key=lambda expt: expt.source_id[1], **kwds):
-        self._expts.sort(key=key, **kwds)
+    def sort(self, key=None, **kwds):
+        """Sort experiments in place. By default, experiments are sorted by
+        source_id[1] using the index, so they need not be loaded from the cache.
+        """
+        self._select_index = None
+        source_ids = {uid: src for src, uid in self._uids_by_source_id.items()}
+        if key is None:
+            self._uids.sort(key=lambda uid: source_ids[uid][1], **kwds)
+        else:
+            self._uids.sort(key=lambda uid: key(self._get(uid)), **kwds)
 
     def check(self):
         # sanity check: all experiments should have cre and fl labels
@@ -0,0 +1,124 @@
+"""
+Indexed on-disk store for Experiment objects, used as the backing cache of ExperimentList.
+
+Each experiment is pickled separately into one row of a SQLite table, alongside a few
+index columns (uid, timestamp, source_id, the mtime/size of the source file, and the
+JSON-encoded fields used by ExperimentList.select). Opening the store only reads the index;
+experiments are unpickled one at a time when they are requested, and updates only
+rewrite the rows that changed.
+"""
+from __future__ import print_function
+import json, pickle, sqlite3
+from contextlib import contextmanager
+
+
+class ExperimentStore(object):
+    """SQLite-backed, per-experiment cache of Experiment objects.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the SQLite file (created if it does not exist).
+    version : int
+        Rows written with a different version are ignored as if they were missing,
+        so that a format change only requires regenerating the affected experiments.
+    """
+    def __init__(self, filename, version):
+        self.filename = filename
+        self.version = version
+        with self._connect() as conn:
+            conn.execute("""
+                create table if not exists experiment (
+                    uid text primary key,
+                    version integer,
+                    timestamp real,
+                    source_id text,
+                    data blob
+                )""")
+            # columns added after the first version of this table
+            columns = [row[1] for row in conn.execute("pragma table_info(experiment)")]
+            for col, typ in [('source_mtime', 'real'), ('source_size', 'integer'), ('select_fields', 'text')]:
+                if col not in columns:
+                    conn.execute("alter table experiment add column %s %s" % (col, typ))
+
+    @contextmanager
+    def _connect(self):
+        # connections are opened per operation so that the store can be shared
+        # with forked worker processes
+        conn = sqlite3.connect(self.filename, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def index(self):
+        """Return a list of (uid, timestamp, source_id) for all experiments in the store.
+        """
+        with self._connect() as conn:
+            rows = conn.execute("select uid, timestamp, source_id from experiment where version=?", (self.version,)).fetchall()
+        return [(str(uid), ts, tuple(json.loads(src))) for uid, ts, src in rows]
+
+    def source_stats(self):
+        """Return a dict mapping source file to (uid, mtime, size) that were recorded
+        when each experiment was stored. mtime and size may be None for older entries.
+        """
+        with self._connect() as conn:
+            rows = conn.execute("select uid, source_id, source_mtime, source_size from experiment where version=?", (self.version,)).fetchall()
+        return {json.loads(src)[0]: (str(uid), mtime, size) for uid, src, mtime, size in rows}
+
+    def set_source_stats(self, stats):
+        """Update the recorded source file (mtime, size) for existing entries.
+
+        *stats* is a dict mapping uid to (mtime, size).
+        """
+        with self._connect() as conn:
+            conn.executemany("update experiment set source_mtime=?, source_size=? where uid=?",
+                             [(mtime, size, uid) for uid, (mtime, size) in stats.items()])
+
+    def select_fields(self):
+        """Return a dict mapping uid to the select fields recorded for each experiment
+        (see ExperimentList.select). Entries that have no fields recorded are omitted.
+        """
+        with self._connect() as conn:
+            rows = conn.execute("select uid, select_fields from experiment where version=? and select_fields is not null", (self.version,)).fetchall()
+        return {str(uid): json.loads(fields) for uid, fields in rows}
+
+    def set_select_fields(self, fields):
+        """Update the select fields for existing entries; *fields* maps uid to a dict.
+        """
+        with self._connect() as conn:
+            conn.executemany("update experiment set select_fields=? where uid=?",
+                             [(json.dumps(f), uid) for uid, f in fields.items()])
+
+    def load(self, uid):
+        """Unpickle and return the experiment with the given uid.
+        """
+        with self._connect() as conn:
+            row = conn.execute("select data from experiment where uid=? and version=?", (uid, self.version)).fetchone()
+        if row is None:
+            raise KeyError("No experiment with UID '%s' in %s" % (uid, self.filename))
+        return pickle.loads(bytes(row[0]))
+
+    def upsert(self, expts, stats=None, fields=None):
+        """Insert or replace the given experiments (all in one transaction).
+
+        *stats* optionally maps uid to the (mtime, size) of the experiment's source file,
+        and *fields* maps uid to its select fields.
+        """
+        stats = stats or {}
+        fields = fields or {}
+        rows = []
+        for expt in expts:
+            data = pickle.dumps(expt, protocol=pickle.HIGHEST_PROTOCOL)
+            mtime, size = stats.get(expt.uid, (None, None))
+            sel = fields.get(expt.uid)
+            rows.append((expt.uid, self.version, expt.site_info['__timestamp__'], json.dumps(list(expt.source_id)),
+                         sqlite3.Binary(data), mtime, size, None if sel is None else json.dumps(sel)))
+        with self._connect() as conn:
+            conn.executemany("insert or replace into experiment (uid, version, timestamp, source_id, data, source_mtime, source_size, select_fields) "
+                             "values (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def remove(self, uids):
+        with self._connect() as conn:
+            conn.executemany("delete from experiment where uid=?", [(uid,) for uid in uids])
@@ -1,6 +1,143 @@
 from __future__ import print_function
-import os, re, json
+import os, re, json, time, pickle, sqlite3
+from contextlib import contextmanager
 from allensdk_internal.core import lims_utilities as lims
+from . import config
+
+
+class LimsCache(object):
+    """Persistent on-disk cache of LIMS query results.
+
+    Results are stored (pickled) in a SQLite file keyed by (kind, key). Entries older
+    than *ttl* seconds are refreshed from LIMS when requested; if LIMS cannot be reached,
+    the expired entry is returned instead so that cached records remain usable offline.
+    """
+    def __init__(self, filename, ttl):
+        self.filename = filename
+        self.ttl = ttl
+        with self._connect() as conn:
+            conn.execute("create table if not exists records (kind text, key text, time real, data blob, primary key (kind, key))")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.filename, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get_many(self, kind, keys):
+        """Return {key: (value, expired)} for all *keys* that have a cached entry.
+        """
+        keys = [str(k) for k in keys]
+        now = time.time()
+        result = {}
+        with self._connect() as conn:
+            # stay under sqlite's limit on query parameters
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                rows = conn.execute("select key, time, data from records where kind=? and key in (%s)" % ','.join('?'*len(chunk)),
+                                    [kind] + chunk).fetchall()
+                for key, t, data in rows:
+                    result[str(key)] = (pickle.loads(bytes(data)), now - t > self.ttl)
+        return result
+
+    def set_many(self, kind, values):
+        """Store *values*, a dict of {key: value}.
+        """
+        now = time.time()
+        rows = [(kind, str(k), now, sqlite3.Binary(pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL))) for k, v in values.items()]
+        with self._connect() as conn:
+            conn.executemany("insert or replace into records values (?, ?, ?, ?)", rows)
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("delete from records")
+
+
+_cache = None
+def get_cache():
+    """Return the LimsCache used by this module, or None if caching is disabled
+    (config.lims_cache_ttl is None).
+    """
+    global _cache
+    if config.lims_cache_ttl is None:
+        return None
+    if _cache is None:
+        path = config.cache_path
+        if not os.path.isabs(path):
+            path = os.path.join(os.path.expanduser('~'), path)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        _cache = LimsCache(os.path.join(path, 'lims_cache.sqlite'), ttl=config.lims_cache_ttl)
+    return _cache
+
+
+def _cached_many(kind, keys, fetch):
+    """Return {key: value} for *keys*, using the LIMS cache where possible.
+
+    *fetch(keys)* must return {key: value} for the keys that are missing or expired
+    from the cache; keys it omits are omitted from the result as well (unless an
+    expired entry exists).
+    """
+    keys = list(keys)
+    cache = get_cache()
+    if cache is None:
+        return fetch(keys)
+
+    cached = cache.get_many(kind, keys)
+    result = {k: cached[str(k)][0] for k in keys if str(k) in cached and not cached[str(k)][1]}
+    need = [k for k in keys if k not in result]
+    if len(need) == 0:
+        return result
+
+    try:
+        fetched = fetch(need)
+    except Exception as exc:
+        stale = {k: cached[str(k)][0] for k in need if str(k) in cached}
+        if len(stale) < len(need):
+            raise
+        print("LIMS query failed (%s); using expired cache entries for %s" % (exc, ', '.join(map(str, need))))
+        fetched = stale
+    else:
+        cache.set_many(kind, fetched)
+    result.update(fetched)
+    return result
+
+
+def _cached(kind, key, fetch):
+    """Return the value of *fetch()* for a single key, using the LIMS cache where possible.
+    """
+    return _cached_many(kind, [key], lambda keys: {key: fetch()})[key]
+
+
+_specimen_info_query = """
+    select 
+        organisms.name as organism, 
+        ages.days as age,
+        donors.date_of_birth as date_of_birth,
+        donors.full_genotype as genotype,
+        donors.weight as weight,
+        genders.name as sex,
+        tissue_processings.section_thickness_um as thickness,
+        tissue_processings.instructions as section_instructions,
+        plane_of_sections.name as plane_of_section,
+        flipped_specimens.name as flipped,
+        specimens.histology_well_name as histology_well_name,
+        specimens.carousel_well_name as carousel_well_name,
+        specimens.parent_id as parent_id,
+        specimens.name as specimen_name,
+        specimens.id as specimen_id
+    from specimens
+        left join donors on specimens.donor_id=donors.id 
+        left join organisms on donors.organism_id=organisms.id
+        left join ages on donors.age_id=ages.id
+        left join genders on donors.gender_id=genders.id
+        left join tissue_processings on specimens.tissue_processing_id=tissue_processings.id
+        left join plane_of_sections on tissue_processings.plane_of_section_id=plane_of_sections.id
+        left join flipped_specimens on flipped_specimens.id = specimens.flipped_specimen_id
+"""
 
 
 def specimen_info(specimen_name=None, specimen_id=None):
@@ -29,49 +166,64 @@ def specimen_info(specimen_name=None, specimen_id=None):
     exposed_surface : The surface that was exposed during the experiment (right, 
         left, anterior, or posterior)
     section_number : indicates the order this slice was sectioned (1=first)
-    """
-    
-    # Query all interesting information about this specimen from LIMS
-    query = """
-        select 
-            organisms.name as organism, 
-            ages.days as age,
-            donors.date_of_birth as date_of_birth,
-            donors.full_genotype as genotype,
-            donors.weight as weight,
-            genders.name as sex,
-            tissue_processings.section_thickness_um as thickness,
-            tissue_processings.instructions as section_instructions,
-            plane_of_sections.name as plane_of_section,
-            flipped_specimens.name as flipped,
-            specimens.histology_well_name as histology_well_name,
-            specimens.carousel_well_name as carousel_well_name,
-            specimens.parent_id as parent_id,
-            specimens.name as specimen_name,
-            specimens.id as specimen_id
-        from specimens
-            left join donors on specimens.donor_id=donors.id 
-            left join organisms on donors.organism_id=organisms.id
-            left join ages on donors.age_id=ages.id
-            left join genders on donors.gender_id=genders.id
-            left join tissue_processings on specimens.tissue_processing_id=tissue_processings.id
-            left join plane_of_sections on tissue_processings.plane_of_section_id=plane_of_sections.id
-            left join flipped_specimens on flipped_specimens.id = specimens.flipped_specimen_id
+
+    Results are cached on disk (see get_cache).
     """
     if specimen_name is not None:
         sid = specimen_name.strip()
-        query += "where specimens.name='%s';" % sid
+        query = _specimen_info_query + "where specimens.name='%s';" % sid
+        kind = 'specimen_info'
     elif specimen_id is not None:
         sid = specimen_id
-        query += "where specimens.id='%d';" % sid
+        query = _specimen_info_query + "where specimens.id='%d';" % sid
+        kind = 'specimen_info_by_id'
     else:
         raise ValueError("Must specify specimen name or ID")
-        
-    r = lims.query(query)
-    if len(r) != 1:
-        raise Exception("LIMS lookup for specimen '%s' returned %d results (expected 1)" % (sid, len(r)))
-    rec = r[0]
-    
+
+    def fetch():
+        r = lims.query(query)
+        if len(r) != 1:
+            raise Exception("LIMS lookup for specimen '%s' returned %d results (expected 1)" % (sid, len(r)))
+        return _parse_specimen_info(r[0])
+
+    return _cached(kind, sid, fetch)
+
+
+def specimen_info_many(specimen_names):
+    """Return a dict mapping specimen name to the information returned by specimen_info().
+
+    All specimens that are not already cached are queried from LIMS at once. Specimens
+    that are not found (or whose records cannot be interpreted) are omitted from
+    the result; call specimen_info() to get the error for one specimen.
+    """
+    names = sorted(set([name.strip() for name in specimen_names]))
+
+    def fetch(names):
+        recs = {}
+        # keep each query to a reasonable length
+        for i in range(0, len(names), 500):
+            chunk = names[i:i+500]
+            query = _specimen_info_query + "where specimens.name in (%s);" % ', '.join(["'%s'" % name for name in chunk])
+            for rec in lims.query(query):
+                recs.setdefault(rec['specimen_name'], []).append(rec)
+        result = {}
+        for name, r in recs.items():
+            if len(r) != 1:
+                continue
+            try:
+                result[name] = _parse_specimen_info(r[0])
+            except Exception:
+                continue
+        return result
+
+    return _cached_many('specimen_info', names, fetch)
+
+
+def _parse_specimen_info(rec):
+    """Convert a raw specimen record from LIMS into the form returned by specimen_info().
+    """
+    rec = dict(rec)
+
     # convert thickness to unscaled
     rec['thickness'] = rec['thickness'] * 1e-6
     # convert organism to more easily searchable form
@@ -143,6 +295,7 @@ def specimen_info(specimen_name=None, specimen_id=None):
 def specimen_images(specimen_name):
     """Return a list of (image ID, treatment) pairs for a specimen.
     
+    Results are cached on disk (see get_cache).
     """
     q = """
         select sub_images.id, treatments.name from specimens 
@@ -152,17 +305,21 @@ def specimen_images(specimen_name):
         left join treatments on treatments.id = images.treatment_id
         where specimens.name='%s';
         """ % specimen_name
-    r = lims.query(q)
-    return [(rec['id'], rec['name']) for rec in r]
+    def fetch():
+        r = lims.query(q)
+        return [(rec['id'], rec['name']) for rec in r]
+    return _cached('specimen_images', specimen_name, fetch)
 
 
 def specimen_id_from_name(spec_name):
     """Return the LIMS ID of a specimen give its name.
     """
-    recs = lims.query("select id from specimens where name='%s'" % spec_name)
-    if len(recs) == 0:
-        raise ValueError('No LIMS specimen named "%s"' % spec_name)
-    return recs[0]['id']
+    def fetch():
+        recs = lims.query("select id from specimens where name='%s'" % spec_name)
+        if len(recs) == 0:
+            raise ValueError('No LIMS specimen named "%s"' % spec_name)
+        return recs[0]['id']
+    return _cached('specimen_id', spec_name, fetch)
 
 
 def specimen_name(spec_id):
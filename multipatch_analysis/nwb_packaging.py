@@ -15,6 +15,9 @@ import h5py
 import shutil
 import tempfile
 import atexit
+import sys
+import sqlite3
+import multiprocessing
 
 # Requires the patched version of nwb-api from https://github.com/t-b/nwb-api/tree/local_fixes
 import nwb
@@ -22,6 +25,12 @@ from nwb.nwbco import *
 
 tmpdir = None
 
+# NWB handles opened by openNWB, keyed by output file name; closed by closeNWBs
+openHandles = {}
+
+# Linux ioctl for creating a copy-on-write clone of a file (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
 def removeTmpdir():
     global tmpdir
     if tmpdir is not None:
@@ -76,8 +85,6 @@ def appendMAFile(siteNWBs, filePath, filedesc):
             imageAttrs['desc'] = json.dumps(meta)
             handle.create_reference_image(image, name, **imageAttrs)
 
-        handle.close()
-
     root.close()
 
 def appendImageFileToNWB(siteNWBs, imageFilePath, filedesc):
@@ -100,7 +107,6 @@ def appendImageFileToNWB(siteNWBs, imageFilePath, filedesc):
 
         name = getUnusedDatasetName(handle, "/acquisition/images/", "image")
         handle.create_reference_image(data, name, **imageAttrs)
-        handle.close()
 
 def appendMiscFileToNWB(siteNWBs, basename, content):
     """ Write the given file contents into all NWB files"""
@@ -110,7 +116,6 @@ def appendMiscFileToNWB(siteNWBs, basename, content):
 
         name = getUnusedDatasetName(handle, "/general/misc_files", basename)
         handle.set_metadata("misc_files" + "/" + name, content)
-        handle.close()
 
 def getUnusedDatasetName(fileHandle, group, basename):
     """ Return an unuused dataset name """
@@ -202,12 +207,19 @@ def getSiteNWBs(basepath):
     return matches
 
 def openNWB(siteNWB):
-    """ Open the given NWB file """
+    """ Open the output NWB file for the given site NWB
+
+    The handle stays open (and is returned again by later calls) until closeNWBs is called.
+    """
 
     outputNWB = deriveOutputNWB(siteNWB)
 
+    handle = openHandles.get(outputNWB)
+    if handle is not None:
+        return handle
+
     if not os.path.isfile(outputNWB):
-        shutil.copyfile(siteNWB, outputNWB)
+        cloneFile(siteNWB, outputNWB)
 
     settings = {}
 
@@ -216,10 +228,42 @@ def openNWB(siteNWB):
     settings["modify"]        = True
 
     try:
-        return nwb.NWB(**settings)
+        handle = nwb.NWB(**settings)
     except:
         raise NameError("Could not open the NWB file \"%s\"." % outputNWB)
 
+    openHandles[outputNWB] = handle
+    return handle
+
+def closeNWBs(siteNWBs):
+    """ Close the output NWB files of the given site NWBs that were opened by openNWB """
+
+    for f in siteNWBs:
+        handle = openHandles.pop(deriveOutputNWB(f), None)
+        if handle is not None:
+            handle.close()
+
+def cloneFile(src, dst):
+    """ Copy `src` to `dst`
+
+    Where the filesystem supports it, the copy is a copy-on-write clone that shares all
+    data blocks with `src`, so only the blocks that are modified later are written.
+    Otherwise the whole file is copied.
+    """
+
+    if sys.platform.startswith('linux'):
+        import fcntl
+        with open(src, 'rb') as srcFile:
+            with open(dst, 'wb') as dstFile:
+                try:
+                    fcntl.ioctl(dstFile.fileno(), FICLONE, srcFile.fileno())
+                    return
+                except (IOError, OSError):
+                    # not supported, or src and dst are on different filesystems
+                    pass
+
+    shutil.copyfile(src, dst)
+
 def getFileContents(path):
     """ Read the contents of a file and return it """
 
@@ -242,14 +286,49 @@ def appendPseudoYamlLog(siteNWBs, path, basename, filedesc):
     appendMiscFileToNWB(siteNWBs, basename + "_meta", content = filedesc)
     appendMiscFileToNWB(siteNWBs, basename, content = data)
 
+def fileDigest(path, chunkSize=2**24):
+    """ Return the SHA-512 hex digest of the file contents, reading it in chunks
+
+    Digests are cached by path, size and mtime, so unchanged files are only read once.
+    """
+
+    path  = os.path.abspath(path)
+    stat  = os.stat(path)
+    cache = os.path.join(os.path.expanduser('~'), '.nwb_packaging_digests.sqlite')
+
+    conn = sqlite3.connect(cache, timeout=60)
+    try:
+        with conn:
+            conn.execute("create table if not exists digests (path text primary key, size integer, mtime real, digest text)")
+            row = conn.execute("select digest from digests where path=? and size=? and mtime=?",
+                               (path, stat.st_size, stat.st_mtime)).fetchone()
+    finally:
+        conn.close()
+
+    if row is not None:
+        return str(row[0])
+
+    hasher = hashlib.sha512()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunkSize), b''):
+            hasher.update(chunk)
+    digest = hasher.hexdigest()
+
+    conn = sqlite3.connect(cache, timeout=60)
+    try:
+        with conn:
+            conn.execute("insert or replace into digests values (?, ?, ?, ?)", (path, stat.st_size, stat.st_mtime, digest))
+    finally:
+        conn.close()
+
+    return digest
+
 def addDataSource(siteNWBs):
     """ Add entries to site NWB file identifying the source Igor Experiment (PXP) """
 
     try:
         pxpFile = glob.glob(os.path.join(os.path.dirname(siteNWBs[0]), '*.pxp'))[0]
-        filehandle = open(pxpFile, 'rb')
-        digest = hashlib.sha512(filehandle.read()).hexdigest()
-        filehandle.close()
+        digest  = fileDigest(pxpFile)
 
         name    = os.path.basename(pxpFile)
         mtime   = os.path.getmtime(pxpFile)
@@ -364,15 +443,20 @@ def fileShouldBeSkipped(path, filesToInclude):
 
     return not path in filesToInclude
 
-def deriveOutputNWB(siteNWB):
-    """ Derive the output NWB filename for a given site NWB """
+def getTmpdir():
+    """ Return the directory that output NWB files are written to """
     global tmpdir
     if tmpdir is None:
         tmpdir = tempfile.mkdtemp(prefix="nwb-packaging")
-    
+
+    return tmpdir
+
+def deriveOutputNWB(siteNWB):
+    """ Derive the output NWB filename for a given site NWB """
+
     filename  = os.path.splitext(os.path.basename(siteNWB))[0] + "_combined.nwb"
 
-    return os.path.abspath(os.path.join(tmpdir, filename))
+    return os.path.abspath(os.path.join(getTmpdir(), filename))
 
 def buildCombinedNWB(siteNWB, filesToInclude = []):
     """
@@ -408,8 +492,29 @@ def buildCombinedNWB(siteNWB, filesToInclude = []):
 #   - slice 2
 #   - ...
 
-def buildCombinedNWBInternal(basepath, siteNWBs, filesToInclude):
-    """ NOT FOR PUBLIC USE """
+def buildSiteNWB(args):
+    """ NOT FOR PUBLIC USE; package a single site NWB in a worker process """
+
+    basepath, siteNWB, filesToInclude = args
+
+    return buildCombinedNWBInternal(basepath, [siteNWB], filesToInclude)[0]
+
+def buildCombinedNWBInternal(basepath, siteNWBs, filesToInclude, workers = 1):
+    """ NOT FOR PUBLIC USE
+
+    If `workers` is larger than 1, each site NWB is packaged separately (as buildCombinedNWB
+    would) in a pool of worker processes.
+    """
+
+    if workers > 1 and len(siteNWBs) > 1:
+        # create the output directory before forking so that all workers write to it
+        getTmpdir()
+        pool = multiprocessing.Pool(min(workers, len(siteNWBs)))
+        try:
+            return pool.map(buildSiteNWB, [(basepath, elem, filesToInclude) for elem in siteNWBs])
+        finally:
+            pool.close()
+            pool.join()
 
     # we have three types of keys in the main index file
     # ---------------------------------------------------------------------
@@ -417,33 +522,40 @@ def buildCombinedNWBInternal(basepath, siteNWBs, filesToInclude):
     # '$existingFile'   | log file of the experiment           | (multiple)
     # '$existingFolder' | different slices for each experiment | (multiple)
 
+    # remove output files left over from an earlier call
+    closeNWBs(siteNWBs)
+    for elem in siteNWBs:
+        outputNWB = deriveOutputNWB(elem)
+        if os.path.isfile(outputNWB):
+            os.remove(outputNWB)
+
     dh = adm.getHandle(basepath)
     dh.checkIndex()
 
-    data = encodeAsJSONString(dh["."].info())
-    appendMiscFileToNWB(siteNWBs, basename = "main_index_meta", content = data)
-
-    logfile = os.path.join(basepath, '.index')
-    appendMiscFileToNWB(siteNWBs, basename = "main_index", content = getFileContents(logfile))
+    try:
+        data = encodeAsJSONString(dh["."].info())
+        appendMiscFileToNWB(siteNWBs, basename = "main_index_meta", content = data)
 
-    for elem in siteNWBs:
-        os.remove(deriveOutputNWB(elem))
+        logfile = os.path.join(basepath, '.index')
+        appendMiscFileToNWB(siteNWBs, basename = "main_index", content = getFileContents(logfile))
 
-    for k in dh.ls():
-        if not dh.isManaged(k):
-            continue
+        for k in dh.ls():
+            if not dh.isManaged(k):
+                continue
 
-        path = os.path.abspath(os.path.join(basepath, k))
+            path = os.path.abspath(os.path.join(basepath, k))
 
-        if os.path.isdir(path): # slice folder
-            addSliceContents(siteNWBs, filesToInclude, basepath, k)
-        elif os.path.isfile(path): # main log file
+            if os.path.isdir(path): # slice folder
+                addSliceContents(siteNWBs, filesToInclude, basepath, k)
+            elif os.path.isfile(path): # main log file
 
-            data = encodeAsJSONString(dh[k].info())
-            appendMiscFileToNWB(siteNWBs, basename = "main_logfile_meta", content = data)
-            appendMiscFileToNWB(siteNWBs, basename = "main_logfile", content = getFileContents(path))
-        else:
-            raise NameError("Unexpected key \"%s\" in index \"%s\"" % (k, logfile))
+                data = encodeAsJSONString(dh[k].info())
+                appendMiscFileToNWB(siteNWBs, basename = "main_logfile_meta", content = data)
+                appendMiscFileToNWB(siteNWBs, basename = "main_logfile", content = getFileContents(path))
+            else:
+                raise NameError("Unexpected key \"%s\" in index \"%s\"" % (k, logfile))
+    finally:
+        closeNWBs(siteNWBs)
 
     combinedNWBs = []
 
@@ -466,6 +578,7 @@ def main():
     parser.add_argument('--basePath', help='Base path to look for MIES NWB files, alternative to --siteNWB')
     parser.add_argument('--siteNWB', help='Site NWB file')
     parser.add_argument('--filesToInclude', default = [], nargs = '*', help='Only include these metadata files')
+    parser.add_argument('--workers', default = 1, type = int, help='Number of site NWB files to package in parallel')
 
     args = parser.parse_args()
 
@@ -495,7 +608,7 @@ def main():
 
     filesToInclude = [ os.path.abspath(elem) for elem in args.filesToInclude ]
 
-    outputNWBs = buildCombinedNWBInternal(basepath, siteNWBs, filesToInclude)
+    outputNWBs = buildCombinedNWBInternal(basepath, siteNWBs, filesToInclude, workers = args.workers)
 
     print "Creating combined NWB files:"
     for elem in outputNWBs:
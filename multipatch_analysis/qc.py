@@ -2,7 +2,54 @@
 
 QC functions meant to ensure consistent filtering across different analyses
 """
+from contextlib import contextmanager
 import numpy as np
+from .data import Analyzer
+from .util import StageTimer
+
+
+# StageTimer that accumulates the time spent in each QC check; see enable_profile()
+profile = None
+
+
+def enable_profile(enable=True):
+    """Start (or restart) collecting the time spent in each QC check.
+
+    Use profile_report() to see the results.
+    """
+    global profile
+    profile = StageTimer() if enable else None
+
+
+def profile_report():
+    """Return a string describing the time spent in each QC check since enable_profile() was called.
+    """
+    if profile is None:
+        return "QC profiling is not enabled"
+    return profile.report()
+
+
+@contextmanager
+def _timed(name):
+    if profile is None:
+        yield
+    else:
+        with profile.stage(name):
+            yield
+
+
+class RecordingQCAnalyzer(Analyzer):
+    """Caches the result of recording_qc_pass() on a recording.
+    """
+    def __init__(self, rec):
+        self._attach(rec)
+        self.rec = rec
+        self._qc_pass = None
+
+    def qc_pass(self):
+        if self._qc_pass is None:
+            self._qc_pass = _recording_qc_pass(self.rec)
+        return self._qc_pass
 
 
 def recording_qc_pass(rec):
@@ -21,21 +68,29 @@ def recording_qc_pass(rec):
     ----------
     rec : PatchClampRecording
         The PatchClampRecording instance to evaluate
+
+    The result is computed once and then cached on the recording (see RecordingQCAnalyzer).
     """
-    if rec.baseline_current < -800e-12 or rec.baseline_current > 800e-12:
-        return False
-    if rec.clamp_mode == 'ic':
-        if rec.baseline_potential < -85e-3 or rec.baseline_potential > -45e-3:
-            return False
-        if rec.baseline_rms_noise > 5e-3:
-            return False
-    elif rec.clamp_mode == 'vc':
-        if rec.baseline_rms_noise > 200e-12:
+    return RecordingQCAnalyzer.get(rec).qc_pass()
+
+
+def _recording_qc_pass(rec):
+    with _timed('recording baseline'):
+        if rec.baseline_current < -800e-12 or rec.baseline_current > 800e-12:
             return False
+        if rec.clamp_mode == 'ic':
+            if rec.baseline_potential < -85e-3 or rec.baseline_potential > -45e-3:
+                return False
+            if rec.baseline_rms_noise > 5e-3:
+                return False
+        elif rec.clamp_mode == 'vc':
+            if rec.baseline_rms_noise > 200e-12:
+                return False
         
-    data = rec['primary'].data
-    if (data == 0).sum() > len(data) // 10:
-        return False
+    with _timed('recording zeros'):
+        data = rec['primary'].data
+        if (data == 0).sum() > len(data) // 10:
+            return False
 
     return True
 
@@ -81,20 +136,21 @@ def pulse_response_qc_pass(post_rec, window, n_spikes, adjacent_pulses):
         return False, False
     
     # Check for noise in response window
-    if post_rec.clamp_mode == 'ic':
-        data = post_rec['primary'][window[0]:window[1]]
-        base = data.median()
-        if data.std() > 1.5e-3:
-            return False, False
-        if data.data.max() > -40e-3:
-            return False, False
-    elif post_rec.clamp_mode == 'vc':
-        data = post_rec['primary'][window[0]:window[1]]
-        base = post_rec['command'][window[0]:window[1]].median()
-        if data.std() > 15e-12:
-            return False, False
-    else:
-        raise TypeError('Unsupported clamp mode %s' % post_rec.clamp_mode)
+    with _timed('pulse window'):
+        if post_rec.clamp_mode == 'ic':
+            data = post_rec['primary'][window[0]:window[1]]
+            base = data.median()
+            if data.std() > 1.5e-3:
+                return False, False
+            if data.data.max() > -40e-3:
+                return False, False
+        elif post_rec.clamp_mode == 'vc':
+            data = post_rec['primary'][window[0]:window[1]]
+            base = post_rec['command'][window[0]:window[1]].median()
+            if data.std() > 15e-12:
+                return False, False
+        else:
+            raise TypeError('Unsupported clamp mode %s' % post_rec.clamp_mode)
 
     # Check timing of adjacent spikes
     if any([abs(t) < 8e-3 for t in adjacent_pulses]):
@@ -108,3 +164,103 @@ def pulse_response_qc_pass(post_rec, window, n_spikes, adjacent_pulses):
     qc_pass = tuple([((bmin < base < bmax) and (bmin < base2 < bmax)) for bmin, bmax in limits])
 
     return qc_pass
+
+
+def pulse_response_qc_pass_many(post_rec, windows, n_spikes, adjacent_pulses, primary_stats=None, command_stats=None):
+    """Apply the QC criteria of pulse_response_qc_pass() to many windows of the same
+    postsynaptic recording at once.
+
+    Parameters
+    ----------
+    post_rec : Recording
+        The postsynaptic Recording instance
+    windows : array
+        (n, 2) array of [start, stop] indices, one row per pulse response
+    n_spikes : array or None
+        The number of presynaptic spikes evoked for each pulse response, or None to skip this check.
+    adjacent_pulses : array or list
+        For each pulse response, the times of adjacent presynaptic stimulus pulses. May be given
+        as a list of lists or as an (n, m) array (pad missing values with inf).
+    primary_stats, command_stats : tuple or None
+        Optional (std, max, median) of the windows in the primary and command channels of
+        *post_rec*, as returned by pulse_window_stats(). These are measured from *post_rec*
+        if they are not given.
+
+    Returns
+    -------
+    ex_qc_pass : array
+        Boolean array; whether each pulse-response passes QC for detecting excitatory connections
+    in_qc_pass : array
+        Boolean array; whether each pulse-response passes QC for detecting inhibitory connections
+    """
+    windows = np.asarray(windows, dtype=int).reshape(-1, 2)
+    n = len(windows)
+    fail = np.zeros(n, dtype=bool), np.zeros(n, dtype=bool)
+    if n == 0:
+        return fail
+
+    # Require the postsynaptic recording to pass basic QC
+    if recording_qc_pass(post_rec) is False:
+        return fail
+
+    ok = np.ones(n, dtype=bool)
+
+    # require at least 1 presynaptic spike
+    if n_spikes is not None:
+        ok &= np.array([x != 0 for x in n_spikes], dtype=bool)
+
+    # Check for noise in response windows
+    with _timed('pulse window'):
+        if post_rec.clamp_mode not in ('ic', 'vc'):
+            raise TypeError('Unsupported clamp mode %s' % post_rec.clamp_mode)
+        if primary_stats is None:
+            primary_stats = pulse_window_stats(post_rec['primary'].data, windows)
+        std, vmax, median = primary_stats
+        if post_rec.clamp_mode == 'ic':
+            base = median
+            ok &= (std <= 1.5e-3) & (vmax <= -40e-3)
+        else:
+            if command_stats is None:
+                command_stats = pulse_window_stats(post_rec['command'].data, windows)
+            base = command_stats[2]
+            ok &= std <= 15e-12
+
+    # Check timing of adjacent spikes
+    if isinstance(adjacent_pulses, np.ndarray) and adjacent_pulses.ndim == 2:
+        nearest = np.abs(adjacent_pulses).min(axis=1) if adjacent_pulses.shape[1] > 0 else np.inf
+    else:
+        nearest = np.array([min([abs(t) for t in adj] or [np.inf]) for adj in adjacent_pulses])
+    ok &= nearest >= 8e-3
+
+    # Check holding potential is appropriate for each sign
+    limits = [[-85e-3, -45e-3], [-60e-3, -45e-3]]
+    base2 = post_rec.baseline_potential
+    return tuple([ok & (bmin < base) & (base < bmax) & (bmin < base2 < bmax) for bmin, bmax in limits])
+
+
+def pulse_window_stats(data, windows):
+    """Return (std, max, median) of data[..., start:stop] for each (start, stop) in *windows*.
+
+    *data* may be a single trace or a packed (channels, samples) array, in which case
+    each returned array has shape (channels, n_windows). All windows are gathered into
+    one nan-padded block, so the statistics are computed without a loop over windows.
+    """
+    block = _window_block(data, np.asarray(windows, dtype=int).reshape(-1, 2))
+    return np.nanstd(block, axis=-1), np.nanmax(block, axis=-1), np.nanmedian(block, axis=-1)
+
+
+def _window_block(data, windows):
+    """Gather data[..., start:stop] for each (start, stop) in *windows* into a float array
+    of shape data.shape[:-1] + (n_windows, max_len), padding the end of shorter windows with nan.
+
+    Windows are clipped to the bounds of *data*, as slicing would do.
+    """
+    n_samples = data.shape[-1]
+    starts = np.clip(windows[:, 0], 0, n_samples)
+    lengths = np.clip(windows[:, 1], 0, n_samples) - starts
+    if np.any(lengths <= 0):
+        raise ValueError("Empty QC window")
+    offsets = np.arange(lengths.max())
+    mask = offsets[None, :] < lengths[:, None]
+    index = np.where(mask, starts[:, None] + offsets[None, :], 0)
+    return np.where(mask, data[..., index].astype(float), np.nan)
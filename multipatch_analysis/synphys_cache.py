@@ -1,52 +1,258 @@
-import os, sys, glob
+import os, sys, glob, time, errno, hashlib, sqlite3, threading
+from contextlib import contextmanager
 import config
-from .util import sync_file
+from .util import chunk_copy
+
+
+class CacheUnavailable(Exception):
+    """Raised when a file can not be served by the synphys cache because no remote
+    repository is configured, or the file is not inside it.
+    """
 
 
 _cache = None
 def get_cache():
     global _cache
     if _cache is None:
+        if config.synphys_data is None:
+            raise CacheUnavailable("No synphys_data path is configured")
         _cache = SynPhysCache()
     return _cache
 
 
 class SynPhysCache(object):
     """Maintains a local cache of files from the synphys raw data repository.
+
+    Cached files are stored by content (sha1 checksum) under ``local_path/objects``.
+    An index (``local_path/cache_index.sqlite``) records the size, mtime and checksum of
+    each remote file that was copied, so a cached file is reused as long as the remote
+    file's size and mtime are unchanged. If *max_size* (bytes) is given, least-recently
+    used files are deleted to keep the cache under that size; files that are pinned by
+    a running process are never deleted.
     """
-    def __init__(self, local_path=config.cache_path, remote_path=config.synphys_data):
+    def __init__(self, local_path=config.cache_path, remote_path=config.synphys_data, max_size=config.cache_max_size):
         # If a relative path is given, then interpret it as relative to home
         if not os.path.isabs(local_path):
             local_path = os.path.join(os.path.expanduser('~'), local_path)
 
         self.local_path = os.path.abspath(local_path)
         self.remote_path = os.path.abspath(remote_path)
-        
+        self.max_size = max_size
+        self.mkdir(self.local_path)
+        self._index_file = os.path.join(self.local_path, 'cache_index.sqlite')
+        with self._connect() as conn:
+            conn.execute("create table if not exists files (remote_path text primary key, size integer, mtime real, checksum text)")
+            conn.execute("create table if not exists objects (checksum text primary key, local_path text, size integer, last_access real)")
+            conn.execute("create table if not exists pins (checksum text, pid integer)")
+
     def list_nwbs(self):
         return glob.glob(os.path.join(self.remote_path, '*', 'slice_*', 'site_*', '*.nwb'))
-    
+
     def list_pip_yamls(self):
         return glob.glob(os.path.join(self.remote_path, '*', 'slice_*', 'site_*', 'pipettes.yml'))
 
-    def get_cache(self, filename):
+    @contextmanager
+    def _connect(self, immediate=False):
+        """Open a connection to the index; the transaction is committed on exit.
+
+        If *immediate* is True, the write lock is taken at the start of the transaction,
+        so that what is read in the transaction can not be changed by another process
+        before it is written.
+        """
+        conn = sqlite3.connect(self._index_file, timeout=60)
+        try:
+            with conn:
+                if immediate:
+                    conn.execute("begin immediate")
+                yield conn
+        finally:
+            conn.close()
+
+    def _remote_file(self, filename):
         filename = os.path.abspath(filename)
         if not filename.startswith(self.remote_path):
-            raise Exception("Requested file %s is not inside %s" % (filename, self.remote_path))
-
-        rel_filename = filename[len(self.remote_path):].lstrip(os.sep)
-        path, _ = os.path.split(rel_filename)
-        
-        local_path = os.path.join(self.local_path, path)
-        self.mkdir(local_path)
-        
-        local_filename = os.path.join(self.local_path, rel_filename)
-        
-        sync_file(filename, local_filename)
-        return local_filename
-        
+            raise CacheUnavailable("Requested file %s is not inside %s" % (filename, self.remote_path))
+        return filename
+
+    def get_cache(self, filename, verify=False):
+        """Return the path to a local copy of *filename*, copying it into the cache if needed.
+
+        If *verify* is True, then the checksum of the cached copy is recomputed and
+        the file is copied again if it does not match.
+        """
+        filename = self._remote_file(filename)
+        stat = os.stat(filename)
+        local_file = self._lookup(filename, stat, verify=verify)
+        if local_file is None:
+            local_file = self._fetch(filename, stat)
+        return local_file
+
+    def _lookup(self, filename, stat, verify=False, pin=False):
+        """Return the cached copy of *filename* if it matches *stat*, or None.
+
+        If *pin* is True, the copy is pinned for this process in the same transaction
+        in which it is found, so it can not be evicted in between.
+        """
+        with self._connect(immediate=pin) as conn:
+            row = conn.execute("select f.checksum, o.local_path from files f join objects o on f.checksum=o.checksum "
+                               "where f.remote_path=? and f.size=? and f.mtime=?", (filename, stat.st_size, stat.st_mtime)).fetchone()
+            if row is None or not os.path.isfile(row[1]):
+                return None
+            if verify and _file_checksum(row[1]) != row[0]:
+                print("Cached file %s is corrupt; copying again." % row[1])
+                self._remove_object(conn, row[0], row[1])
+                return None
+            conn.execute("update objects set last_access=? where checksum=?", (time.time(), row[0]))
+            if pin:
+                conn.execute("insert into pins values (?, ?)", (row[0], os.getpid()))
+            return row[1]
+
+    def _fetch(self, filename, stat):
+        """Copy *filename* into the cache, record it in the index, and evict old files if needed.
+        """
+        obj_dir = os.path.join(self.local_path, 'objects')
+        self.mkdir(obj_dir)
+        ext = os.path.splitext(filename)[1]
+        tmp_file = os.path.join(obj_dir, 'tmp_%d_%d%s.partial' % (os.getpid(), threading.current_thread().ident, ext))
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        print("copy: %s => cache" % filename)
+        try:
+            # the checksum is computed from the local copy afterward, so that chunk_copy
+            # can copy in-kernel
+            chunk_copy(filename, tmp_file)
+            checksum = _file_checksum(tmp_file)
+            local_file = os.path.join(obj_dir, checksum[:2], checksum + ext)
+            self.mkdir(os.path.dirname(local_file))
+            if os.path.exists(local_file):
+                # identical content is already cached (eg. fetched concurrently)
+                os.remove(tmp_file)
+            else:
+                os.rename(tmp_file, local_file)
+        finally:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+
+        with self._connect(immediate=True) as conn:
+            conn.execute("insert or replace into files values (?, ?, ?, ?)", (filename, stat.st_size, stat.st_mtime, checksum))
+            conn.execute("insert or replace into objects values (?, ?, ?, ?)", (checksum, local_file, stat.st_size, time.time()))
+            self._evict(conn, keep=checksum)
+        return local_file
+
+    def _evict(self, conn, keep=None):
+        """Delete least-recently used files until the cache is within max_size.
+        """
+        if self.max_size is None:
+            return
+        total = conn.execute("select sum(size) from objects").fetchone()[0] or 0
+        if total <= self.max_size:
+            return
+        pinned = self._pinned_checksums(conn)
+        for checksum, local_file, size in conn.execute("select checksum, local_path, size from objects order by last_access").fetchall():
+            if total <= self.max_size:
+                break
+            if checksum == keep or checksum in pinned:
+                continue
+            self._remove_object(conn, checksum, local_file)
+            total -= size
+
+    def _remove_object(self, conn, checksum, local_file):
+        conn.execute("delete from objects where checksum=?", (checksum,))
+        conn.execute("delete from files where checksum=?", (checksum,))
+        if os.path.isfile(local_file):
+            os.remove(local_file)
+
+    def _pinned_checksums(self, conn):
+        pinned = set()
+        for checksum, pid in conn.execute("select checksum, pid from pins").fetchall():
+            if _pid_alive(pid):
+                pinned.add(checksum)
+            else:
+                conn.execute("delete from pins where pid=?", (pid,))
+        return pinned
+
+    def pin(self, filename, max_attempts=5):
+        """Return a local copy of *filename* (see get_cache) and protect it from eviction
+        until unpin() is called by this process.
+
+        If another process evicts the file after it is fetched but before it is pinned,
+        it is fetched again (up to *max_attempts* times).
+        """
+        filename = self._remote_file(filename)
+        for i in range(max_attempts):
+            stat = os.stat(filename)
+            local_file = self._lookup(filename, stat, pin=True)
+            if local_file is not None:
+                return local_file
+            self._fetch(filename, stat)
+        raise IOError("Could not pin %s; it was evicted from the cache after each of %d fetches" % (filename, max_attempts))
+
+    def unpin(self, filename):
+        filename = os.path.abspath(filename)
+        with self._connect() as conn:
+            row = conn.execute("select rowid from pins where pid=? and checksum=(select checksum from files where remote_path=?) limit 1",
+                               (os.getpid(), filename)).fetchone()
+            if row is not None:
+                conn.execute("delete from pins where rowid=?", row)
+
+    @contextmanager
+    def pinned(self, filename):
+        """Context manager that yields a pinned local copy of *filename*.
+        """
+        local_file = self.pin(filename)
+        try:
+            yield local_file
+        finally:
+            self.unpin(filename)
+
+    def prefetch(self, filenames):
+        """Copy *filenames* into the cache in a background thread.
+
+        Returns the thread; errors are printed and do not stop the remaining files from
+        being fetched.
+        """
+        def run():
+            for filename in filenames:
+                try:
+                    self.get_cache(filename)
+                except Exception:
+                    sys.excepthook(*sys.exc_info())
+                    print("Error prefetching %s (exception printed above)" % filename)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
     def mkdir(self, path):
         if not os.path.isdir(path):
             root, _ = os.path.split(path)
             if root != '':
                 self.mkdir(root)
-            os.mkdir(path)
+            try:
+                os.mkdir(path)
+            except OSError as exc:
+                # may have been created concurrently
+                if exc.errno != errno.EEXIST:
+                    raise
+
+
+def _file_checksum(filename, chunk_size=int(100e6)):
+    hasher = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        while True:
+            chunk = fh.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _pid_alive(pid):
+    if sys.platform == 'win32':
+        # os.kill would terminate the process on windows; assume pins are still in use
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno != errno.ESRCH
+    return True
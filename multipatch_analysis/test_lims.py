@@ -0,0 +1,160 @@
+"""
+Tests for the LIMS record cache, using a local stand-in for LIMS queries.
+"""
+from __future__ import print_function, division
+import re, sys, types
+import pytest
+
+
+def _stub_lims_utilities():
+    """Install a stand-in for allensdk_internal.core.lims_utilities (which is only
+    available inside the Institute) so that lims can be imported. Each test replaces
+    lims.lims with a FakeLims anyway.
+    """
+    try:
+        import allensdk_internal.core.lims_utilities
+        return
+    except ImportError:
+        pass
+    def query(query):
+        raise IOError("LIMS is not available in tests")
+    names = ['allensdk_internal', 'allensdk_internal.core', 'allensdk_internal.core.lims_utilities']
+    mods = [types.ModuleType(name) for name in names]
+    mods[2].query = query
+    mods[0].core = mods[1]
+    mods[1].lims_utilities = mods[2]
+    for name, mod in zip(names, mods):
+        sys.modules[name] = mod
+
+_stub_lims_utilities()
+
+from multipatch_analysis import lims, config
+
+
+class FakeLims(object):
+    """Stand-in for lims_utilities that answers specimen queries from a dict of
+    {specimen_name: [raw records]} and records every query it receives.
+    """
+    def __init__(self, specimens):
+        self.specimens = specimens
+        self.queries = []
+        self.online = True
+
+    def query(self, query):
+        if not self.online:
+            raise IOError("LIMS is unreachable")
+        self.queries.append(query)
+        names = re.findall(r"'([^']*)'", query.split('where', 1)[1])
+        return [rec for name in names for rec in self.specimens.get(name, [])]
+
+
+def specimen_rec(name, thickness=350):
+    return {
+        'organism': 'Homo Sapiens',
+        'age': None,
+        'date_of_birth': None,
+        'genotype': None,
+        'weight': None,
+        'sex': None,
+        'thickness': thickness,
+        'section_instructions': None,
+        'plane_of_section': None,
+        'flipped': 'unknown',
+        'histology_well_name': None,
+        'carousel_well_name': None,
+        'parent_id': None,
+        'specimen_name': name,
+        'specimen_id': 0,
+    }
+
+
+def specimen_names(n):
+    return ['H17.03.%03d.11.%02d' % (i // 100, i % 100) for i in range(n)]
+
+
+@pytest.fixture
+def fake_lims(monkeypatch, tmpdir):
+    fake = FakeLims({})
+    monkeypatch.setattr(lims, 'lims', fake)
+    monkeypatch.setattr(config, 'lims_cache_ttl', 100)
+    monkeypatch.setattr(lims, '_cache', lims.LimsCache(str(tmpdir.join('lims_cache.sqlite')), ttl=100))
+    return fake
+
+
+def test_specimen_info_many_batches(fake_lims):
+    names = specimen_names(1200)
+    fake_lims.specimens = {name: [specimen_rec(name)] for name in names}
+
+    info = lims.specimen_info_many(names + names[:10])
+    assert sorted(info.keys()) == sorted(names)
+    assert info[names[0]]['thickness'] == 350e-6
+    # 1200 unique names are queried in chunks of 500
+    assert [len(re.findall(r"'[^']*'", q.split('where', 1)[1])) for q in fake_lims.queries] == [500, 500, 200]
+
+    # everything is cached now
+    fake_lims.queries = []
+    assert lims.specimen_info_many(names) == info
+    assert fake_lims.queries == []
+
+
+def test_specimen_info_many_omitted(fake_lims):
+    names = specimen_names(4)
+    missing, duplicate = names[:2]
+    fake_lims.specimens = {name: [specimen_rec(name)] for name in names[2:]}
+    fake_lims.specimens[duplicate] = [specimen_rec(duplicate), specimen_rec(duplicate)]
+
+    info = lims.specimen_info_many(names)
+    assert sorted(info.keys()) == names[2:]
+
+    # omitted specimens are not cached, so they are queried again
+    fake_lims.queries = []
+    fake_lims.specimens[missing] = [specimen_rec(missing)]
+    info = lims.specimen_info_many(names)
+    assert sorted(info.keys()) == sorted([missing] + names[2:])
+    assert len(fake_lims.queries) == 1
+    assert set(re.findall(r"'([^']*)'", fake_lims.queries[0].split('where', 1)[1])) == set([missing, duplicate])
+
+    with pytest.raises(Exception):
+        lims.specimen_info(duplicate)
+
+
+def test_cache_ttl(fake_lims):
+    name = specimen_names(1)[0]
+    fake_lims.specimens = {name: [specimen_rec(name, thickness=350)]}
+    assert lims.specimen_info(name)['thickness'] == 350e-6
+
+    # changes in LIMS are not seen until the entry expires
+    fake_lims.specimens = {name: [specimen_rec(name, thickness=300)]}
+    assert lims.specimen_info(name)['thickness'] == 350e-6
+    assert lims.specimen_info_many([name])[name]['thickness'] == 350e-6
+    assert len(fake_lims.queries) == 1
+
+    lims._cache.ttl = -1
+    assert lims.specimen_info(name)['thickness'] == 300e-6
+    assert lims.specimen_info_many([name])[name]['thickness'] == 300e-6
+    assert len(fake_lims.queries) == 3
+
+
+def test_offline_fallback(fake_lims):
+    names = specimen_names(3)
+    fake_lims.specimens = {name: [specimen_rec(name)] for name in names[:2]}
+    info = lims.specimen_info_many(names[:2])
+
+    # expired entries are used when LIMS cannot be reached
+    lims._cache.ttl = -1
+    fake_lims.online = False
+    assert lims.specimen_info_many(names[:2]) == info
+    assert lims.specimen_info(names[0]) == info[names[0]]
+
+    # ..but only if every requested key has an entry
+    with pytest.raises(IOError):
+        lims.specimen_info_many(names)
+    with pytest.raises(IOError):
+        lims.specimen_info(names[2])
+
+    # fresh records replace expired ones once LIMS is back
+    fake_lims.online = True
+    fake_lims.specimens = {name: [specimen_rec(name, thickness=300)] for name in names}
+    info = lims.specimen_info_many(names)
+    assert sorted(info.keys()) == names
+    assert all(rec['thickness'] == 300e-6 for rec in info.values())
@@ -1,8 +1,18 @@
-import os, sys, time
+from __future__ import print_function
+import os, sys, time, gc, errno, json, hashlib, threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 
-def sync_file(src, dst):
+def sync_file(src, dst, limiter=None, progress=True):
     """Safely copy *src* to *dst*, but only if *src* is newer or a different size.
+
+    *limiter* and *progress* are passed to chunk_copy().
     """
     if os.path.isfile(dst):
         src_stat = os.stat(src)
@@ -12,23 +22,105 @@ def sync_file(src, dst):
         if up_to_date:
             return "skip"
         
-        safe_copy(src, dst)
+        safe_copy(src, dst, limiter=limiter, progress=progress)
         return "update"
     else:
-        safe_copy(src, dst)
+        safe_copy(src, dst, limiter=limiter, progress=progress)
         return "copy"
 
 
-def safe_copy(src, dst):
+def sync_files(pairs, workers=4, max_rate=None, report=print):
+    """Run sync_file() on many (src, dst) pairs concurrently.
+
+    Parameters
+    ----------
+    pairs : list
+        (src, dst) file paths
+    workers : int
+        Number of files to copy at once
+    max_rate : float | None
+        Maximum total copy rate (bytes/s) shared by all workers
+    report : callable | None
+        Called with a summary string describing aggregate throughput
+
+    Returns
+    -------
+    results : list
+        One (status, exc) per pair, in order: status is as returned by sync_file,
+        or None if the copy raised *exc*.
+    """
+    limiter = None if max_rate is None else BandwidthLimiter(max_rate)
+    progress = workers <= 1 or len(pairs) <= 1
+
+    def sync_one(pair):
+        src, dst = pair
+        try:
+            status = sync_file(src, dst, limiter=limiter, progress=progress)
+            n_bytes = 0 if status == 'skip' else os.stat(src).st_size
+            return status, None, n_bytes
+        except Exception as exc:
+            return None, exc, 0
+
+    start = time.time()
+    if workers > 1 and len(pairs) > 1:
+        pool = ThreadPool(min(workers, len(pairs)))
+        try:
+            results = pool.map(sync_one, pairs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [sync_one(pair) for pair in pairs]
+    elapsed = time.time() - start
+
+    n_bytes = sum([r[2] for r in results])
+    n_copied = len([r for r in results if r[0] not in (None, 'skip')])
+    if report is not None and n_copied > 0:
+        report("    copied %d files (%0.1f MB) in %0.1f s; %0.1f MB/s" % (n_copied, n_bytes / 1e6, elapsed, n_bytes / 1e6 / max(elapsed, 1e-6)))
+    return [r[:2] for r in results]
+
+
+def safe_copy(src, dst, limiter=None, progress=True, resume=None):
     """Copy a file, but rename the destination file if it already exists.
     
     Also, the destination file is suffixed ".partial" until the copy is complete.
+
+    If *resume* is True, then an interrupted copy leaves the ".partial" file in place,
+    along with a ".partial.resume" file that records the checksum of each block
+    copied so far. The next copy of the same (unmodified) source file verifies those
+    blocks and continues after the last good one. Resumable copies pass every block
+    through python to checksum it, so by default (*resume* is None) they are only
+    used for files of at least RESUME_MIN_SIZE bytes; smaller files can be copied
+    in-kernel (see chunk_copy).
     """
     tmp_dst = dst + '.partial'
+    state_file = tmp_dst + '.resume'
+    if resume is None:
+        resume = os.stat(src).st_size >= RESUME_MIN_SIZE
+    completed = False
     try:
         new_name = None
-        print("copy: %s => %s" % (src, dst))
-        chunk_copy(src, tmp_dst)
+        if resume:
+            offset = _resume_offset(src, tmp_dst, state_file)
+            if offset > 0:
+                print("resume: %s => %s  (at %d MB)" % (src, dst, int(offset/1e6)))
+            else:
+                print("copy: %s => %s" % (src, dst))
+            with open(state_file, 'a') as state_fh:
+                def record_block(chunk):
+                    state_fh.write(hashlib.md5(chunk).hexdigest() + '\n')
+                    state_fh.flush()
+                chunk_copy(src, tmp_dst, chunk_size=RESUME_BLOCK_SIZE, limiter=limiter, progress=progress,
+                           offset=offset, on_chunk=record_block, remove_on_error=False)
+            os.remove(state_file)
+        else:
+            print("copy: %s => %s" % (src, dst))
+            # discard leftovers from an earlier copy that can not be resumed
+            for f in (tmp_dst, state_file):
+                if os.path.isfile(f):
+                    os.remove(f)
+            chunk_copy(src, tmp_dst, limiter=limiter, progress=progress)
+        completed = True
         if os.path.exists(dst):
             # rename destination file to avoid overwriting
             now = time.strftime('%Y-%m-%d_%H:%M:%S')
@@ -46,47 +138,304 @@ def safe_copy(src, dst):
             os.rename(new_name, dst)
         raise
     finally:
-        if os.path.isfile(tmp_dst):
+        # keep partial copies that can be resumed
+        if os.path.isfile(tmp_dst) and (completed or not resume):
             os.remove(tmp_dst)
-    
 
-def chunk_copy(src, dst, chunk_size=100e6):
+
+RESUME_BLOCK_SIZE = int(8e6)
+RESUME_MIN_SIZE = int(1e9)
+
+
+def _resume_offset(src, tmp_dst, state_file):
+    """Prepare to resume copying *src* to *tmp_dst*.
+
+    Returns the number of bytes at the start of *tmp_dst* that match the block
+    checksums recorded in *state_file*. The partial file is truncated to that length
+    and the state file is rewritten to match. If the source has changed (size or
+    mtime) or there is nothing to resume, both files are reset and 0 is returned.
+    """
+    src_stat = os.stat(src)
+    header = json.dumps({'src': src, 'size': src_stat.st_size, 'mtime': src_stat.st_mtime, 'block_size': RESUME_BLOCK_SIZE})
+
+    blocks = []
+    if os.path.isfile(tmp_dst) and os.path.isfile(state_file):
+        lines = open(state_file, 'r').read().split('\n')
+        if lines[0] == header:
+            with open(tmp_dst, 'rb') as fh:
+                for checksum in lines[1:]:
+                    chunk = fh.read(RESUME_BLOCK_SIZE)
+                    if len(chunk) < RESUME_BLOCK_SIZE or hashlib.md5(chunk).hexdigest() != checksum:
+                        break
+                    blocks.append(checksum)
+
+    if len(blocks) == 0:
+        if os.path.exists(tmp_dst):
+            os.remove(tmp_dst)
+    else:
+        with open(tmp_dst, 'r+b') as fh:
+            fh.truncate(len(blocks) * RESUME_BLOCK_SIZE)
+    with open(state_file, 'w') as fh:
+        fh.write('\n'.join([header] + blocks) + '\n')
+    return len(blocks) * RESUME_BLOCK_SIZE
+
+
+def chunk_copy(src, dst, chunk_size=100e6, hasher=None, limiter=None, progress=True, offset=0, on_chunk=None, remove_on_error=True):
     """Manually copy a file one chunk at a time.
     
     This allows progress feedback and more graceful cancellation during long
-    copy operations.
+    copy operations. If *hasher* is given (eg. a hashlib object), then it is
+    updated with each chunk as it is copied; likewise *on_chunk* is called with each
+    chunk after it is written. If *limiter* (a BandwidthLimiter) is given, it is used
+    to throttle the copy rate.
+
+    If *offset* is nonzero, then *dst* must already exist and contain the first
+    *offset* bytes of *src*; copying continues from there.
+
+    Where possible, data is copied in-kernel (copy_file_range or sendfile) without
+    passing through python. Otherwise, reading the next chunk is overlapped with
+    writing the current one.
     """
-    if os.path.exists(dst):
+    if offset == 0 and os.path.exists(dst):
         raise Exception("Won't copy over existing file %s" % dst)
     size = os.stat(src).st_size
+    chunk_size = int(chunk_size)
+    if limiter is not None:
+        # smaller chunks give smoother throttling
+        chunk_size = min(chunk_size, int(8e6))
     in_fh = open(src, 'rb')
-    out_fh = open(dst, 'ab')
-    msglen = 0
+    out_fh = open(dst, 'wb' if offset == 0 else 'r+b')
+    in_fh.seek(offset)
+    out_fh.seek(offset)
+    if hasher is not None:
+        callbacks = [hasher.update] + ([] if on_chunk is None else [on_chunk])
+        def on_chunk(chunk):
+            for cb in callbacks:
+                cb(chunk)
+    msglen = [0]
+    show_progress = progress and size > chunk_size * 2
+
+    def update(tot):
+        if show_progress:
+            n = int(50 * (float(tot) / size))
+            msg = ('[' + '#' * n + '-' * (50-n) + ']  %d / %d MB\r') % (int(tot/1e6), int(size/1e6))
+            msglen[0] = len(msg)
+            sys.stdout.write(msg)
+            try:
+                sys.stdout.flush()
+            except IOError:  # Why does this happen??
+                pass
+
     try:
         with in_fh:
             with out_fh:
-                chunk_size = int(chunk_size)
-                tot = 0
-                while True:
-                    chunk = in_fh.read(chunk_size)
-                    out_fh.write(chunk)
-                    tot += len(chunk)
-                    if size > chunk_size * 2:
-                        n = int(50 * (float(tot) / size))
-                        msg = ('[' + '#' * n + '-' * (50-n) + ']  %d / %d MB\r') % (int(tot/1e6), int(size/1e6))
-                        msglen = len(msg)
-                        sys.stdout.write(msg)
-                        try:
-                            sys.stdout.flush()
-                        except IOError:  # Why does this happen??
-                            pass
-                    if len(chunk) < chunk_size:
-                        break
-                sys.stdout.write("[###  flushing..  \r")
-                sys.stdout.flush()
-        sys.stdout.write(' '*msglen + '\r')
-        sys.stdout.flush()
+                copied = False
+                if on_chunk is None:
+                    copied = _kernel_copy(in_fh, out_fh, offset, size, chunk_size, limiter, update)
+                if not copied:
+                    _overlapped_copy(in_fh, out_fh, offset, chunk_size, on_chunk, limiter, update)
+                if show_progress:
+                    sys.stdout.write("[###  flushing..  \r")
+                    sys.stdout.flush()
+        if show_progress:
+            sys.stdout.write(' '*msglen[0] + '\r')
+            sys.stdout.flush()
     except Exception:
-        if os.path.isfile(dst):
+        if remove_on_error and os.path.isfile(dst):
             os.remove(dst)
         raise
+
+
+def _kernel_copy(in_fh, out_fh, offset, size, chunk_size, limiter, update):
+    """Copy from *offset* to *size* using copy_file_range or sendfile, if available.
+
+    Returns False (having copied nothing) if neither is supported for these files.
+    """
+    if hasattr(os, 'copy_file_range'):
+        copy_fn = lambda offset, n: os.copy_file_range(in_fh.fileno(), out_fh.fileno(), n, offset, offset)
+    elif hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        copy_fn = lambda offset, n: os.sendfile(out_fh.fileno(), in_fh.fileno(), offset, n)
+    else:
+        return False
+
+    tot = offset
+    while tot < size:
+        n = min(chunk_size, size - tot)
+        if limiter is not None:
+            limiter.consume(n)
+        try:
+            sent = copy_fn(tot, n)
+        except OSError as exc:
+            if tot == offset and exc.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                # not supported between these files (eg. network filesystem); use the fallback
+                return False
+            raise
+        if sent == 0:
+            # source ended early (eg. truncated while copying)
+            raise IOError("Copy stopped at %d of %d bytes; source file %s may have changed" % (tot, size, in_fh.name))
+        tot += sent
+        update(tot)
+    return True
+
+
+def _overlapped_copy(in_fh, out_fh, offset, chunk_size, on_chunk, limiter, update):
+    """Copy with a reader thread that reads ahead while the current chunk is written.
+    """
+    chunks = queue.Queue(maxsize=2)
+    stop = threading.Event()
+
+    def read():
+        try:
+            while not stop.is_set():
+                chunk = in_fh.read(chunk_size)
+                chunks.put(chunk)
+                if len(chunk) < chunk_size:
+                    break
+        except Exception as exc:
+            chunks.put(exc)
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    try:
+        tot = offset
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if limiter is not None:
+                limiter.consume(len(chunk))
+            out_fh.write(chunk)
+            if on_chunk is not None and len(chunk) > 0:
+                on_chunk(chunk)
+            tot += len(chunk)
+            update(tot)
+            if len(chunk) < chunk_size:
+                break
+    finally:
+        # unblock the reader if we are exiting early
+        stop.set()
+        while reader.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        reader.join()
+
+
+class BandwidthLimiter(object):
+    """Caps the combined rate (bytes/s) of any number of concurrent copies.
+
+    Each call to consume(n) reserves the next n/rate seconds of transfer time and
+    sleeps until that reservation has elapsed.
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def consume(self, n_bytes):
+        with self._lock:
+            now = time.time()
+            self._next = max(now, self._next) + n_bytes / self.rate
+            delay = self._next - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class StageTimer(object):
+    """Accumulates the time spent in named processing stages.
+
+    Example::
+
+        timer = StageTimer()
+        with timer.stage('load'):
+            ...
+        print(timer.report())
+    """
+    def __init__(self):
+        self.times = OrderedDict()
+        self._nested = []  # time spent in stages nested inside each active stage
+
+    @contextmanager
+    def stage(self, name):
+        """Time a block of code. Time spent in a nested stage is counted only
+        for the inner stage.
+        """
+        start = time.time()
+        self._nested.append(0.0)
+        try:
+            yield
+        finally:
+            dt = time.time() - start
+            self.add(name, dt - self._nested.pop())
+            if len(self._nested) > 0:
+                self._nested[-1] += dt
+
+    def add(self, name, dt):
+        self.times[name] = self.times.get(name, 0.0) + dt
+
+    def merge(self, times):
+        """Add stage times collected elsewhere (eg. by a worker process).
+        """
+        for name, dt in times.items():
+            self.add(name, dt)
+
+    def report(self):
+        return '  '.join(['%s %0.2fs' % (name, dt) for name, dt in self.times.items()])
+
+
+def current_rss():
+    """Return the resident set size of this process in bytes, or None if it cannot be determined.
+    """
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # no portable way to get the current RSS; fall back to the peak
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class MemoryMonitor(object):
+    """Tracks the high-water mark of this process's resident memory over some span of work,
+    and optionally enforces a soft budget.
+
+    Call ``sample()`` periodically (for example once per sweep). If the RSS is above
+    *budget* (bytes), garbage is collected and the sample is repeated; ``sample()``
+    returns False if the process is still over budget afterward.
+    """
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.start = current_rss()
+        self.peak = self.start
+        self.n_over_budget = 0
+
+    def sample(self):
+        rss = current_rss()
+        if rss is None:
+            return True
+        self.peak = max(self.peak, rss)
+        if self.budget is None or rss <= self.budget:
+            return True
+        gc.collect()
+        rss = current_rss()
+        if rss <= self.budget:
+            return True
+        self.n_over_budget += 1
+        return False
+
+    def report(self):
+        if self.peak is None:
+            return 'peak RSS unknown'
+        msg = 'peak RSS %0.1f MB (start %0.1f MB)' % (self.peak / 1e6, self.start / 1e6)
+        if self.budget is not None:
+            msg += ', budget %0.1f MB' % (self.budget / 1e6)
+            if self.n_over_budget > 0:
+                msg += ' exceeded %d times' % self.n_over_budget
+        return msg
@@ -1,11 +1,13 @@
-import os, sys, re, shutil, hashlib, time
+import os, sys, re, shutil, hashlib, time, sqlite3
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 
 ignored_files = ['.*Thumbs.db']
 ignored_regex = [re.compile(x) for x in ignored_files]
 
 
-def conditional_delete(path1, path2):
+def conditional_delete(path1, path2, hash_cache=None, workers=4):
     """Delete *path1* only if all files that would be deleted also exist in *path2*.
 
     Return True if *path1* was deleted.
@@ -13,7 +15,7 @@ def conditional_delete(path1, path2):
     This is used for recovering disk space after verifying the contents of a backup.
     """
     print("Comparing %s..." % path1)
-    if not compare_paths(path1, path2):
+    if not compare_paths(path1, path2, hash_cache=hash_cache, workers=workers):
         print("    Skipping %s" % path1)
         return False
 
@@ -23,12 +25,14 @@ def conditional_delete(path1, path2):
     return True
 
 
-def conditional_delete_old(path1, path2, min_age=120):
+def conditional_delete_old(path1, path2, min_age=120, hash_cache=None, workers=4):
     """Conditionally delete subdirectories from *path1* if they are older than *min_age* (in days) and
     have a valid copy in *path2*.
 
     The age of each subfolder is determined using its MTIME.
     """
+    if hash_cache is None:
+        hash_cache = HashCache()
     too_young = []
     deleted_paths = []
     invalid_paths = []
@@ -42,7 +46,7 @@ def conditional_delete_old(path1, path2, min_age=120):
             too_young.append(src_path)
             continue
         dst_path = os.path.join(path2, f)
-        deleted = conditional_delete(src_path, dst_path)
+        deleted = conditional_delete(src_path, dst_path, hash_cache=hash_cache, workers=workers)
         if deleted:
             deleted_paths.append(src_path)
         else:
@@ -55,11 +59,16 @@ def age_in_days(path):
     return (time.time() - os.stat(path).st_mtime) / (3600*24.)
 
 
-def compare_paths(path1, path2):
+def compare_paths(path1, path2, hash_cache=None, workers=4):
     """Return True only if all files inside the tree at *path1* also exist in the same relative 
     locations in *path2*.
+
+    Source and destination files are hashed concurrently using *workers* threads. If a
+    HashCache is given, hashes of files whose size and mtime have not changed since they
+    were last hashed are reused.
     """
     match = True
+    to_hash = []
     for src_path, dirs, files in os.walk(path1):
         subpath = os.path.relpath(src_path, path1)
         dst_path = os.path.join(path2, subpath)
@@ -91,27 +100,98 @@ def compare_paths(path1, path2):
                 match = False
                 print("      Wrong size %s" % rel_file)
                 continue
-            if file_hash(src_file) != file_hash(dst_file):
-                match = False
-                print("      Hash mismatch %s" % rel_file)
-                continue
+            to_hash.append((rel_file, src_file, dst_file))
+
+    if len(to_hash) == 0:
+        return match
+
+    # hash all source and destination files in one pool so that reads from both
+    # disks overlap
+    start = time.time()
+    filenames = [fn for _, src_file, dst_file in to_hash for fn in (src_file, dst_file)]
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(lambda fn: _cached_file_hash(fn, hash_cache), filenames)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+
+    for i, (rel_file, src_file, dst_file) in enumerate(to_hash):
+        if results[2*i][0] != results[2*i+1][0]:
+            match = False
+            print("      Hash mismatch %s" % rel_file)
+
+    n_hashed = sum([1 for _, nbytes in results if nbytes is not None])
+    n_bytes = sum([nbytes for _, nbytes in results if nbytes is not None])
+    print("      Hashed %d files (%0.1f MB) in %0.1f s; %0.1f MB/s  (%d cached)" % (
+        n_hashed, n_bytes * 1e-6, elapsed, n_bytes * 1e-6 / max(elapsed, 1e-6), len(results) - n_hashed))
 
     return match
 
 
-def file_hash(filename, blocksize=2**24, func=hashlib.sha1):
+def _hash_func():
+    # blake2b is much faster than sha1 on 64-bit machines, but is only available in python 3.6+
+    return getattr(hashlib, 'blake2b', hashlib.sha1)
+
+
+def file_hash(filename, blocksize=2**24, func=None):
     """Source: https://stackoverflow.com/questions/3431825/generating-an-md5-checksum-of-a-file
     """
-    hash = func()
+    hash = (func or _hash_func())()
     with open(filename, "rb") as f:
         for block in iter(lambda: f.read(blocksize), b""):
             hash.update(block)
     return hash.hexdigest()
 
 
+def _cached_file_hash(filename, hash_cache=None):
+    """Return (hash, nbytes) for *filename*, where nbytes is None if the hash was cached.
+    """
+    stat = os.stat(filename)
+    if hash_cache is not None:
+        cached = hash_cache.lookup(filename, stat.st_size, stat.st_mtime)
+        if cached is not None:
+            return cached, None
+    digest = file_hash(filename)
+    if hash_cache is not None:
+        hash_cache.store(filename, stat.st_size, stat.st_mtime, digest)
+    return digest, stat.st_size
+
+
+class HashCache(object):
+    """SQLite record of file hashes keyed on (path, size, mtime), so that files that
+    were already verified are not read again on later runs.
+    """
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(os.path.expanduser('~'), '.conditional_delete_hashes.sqlite')
+        self.filename = filename
+        self.algorithm = _hash_func()().name
+        with self._connect() as conn:
+            conn.execute("create table if not exists hashes (path text primary key, size integer, mtime real, algorithm text, hash text)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.filename, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def lookup(self, path, size, mtime):
+        with self._connect() as conn:
+            row = conn.execute("select hash from hashes where path=? and size=? and mtime=? and algorithm=?",
+                               (os.path.abspath(path), size, mtime, self.algorithm)).fetchone()
+        return None if row is None else str(row[0])
+
+    def store(self, path, size, mtime, digest):
+        with self._connect() as conn:
+            conn.execute("insert or replace into hashes values (?, ?, ?, ?, ?)",
+                         (os.path.abspath(path), size, mtime, self.algorithm, digest))
+
+
 if __name__ == '__main__':
     path1, path2 = sys.argv[1:]
     conditional_delete_old(path1, path2)
-
-
-
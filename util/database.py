@@ -16,3 +16,11 @@ if '--vacuum' in sys.argv:
     print("Mopping up %s.." % synphys_db)
     db.vacuum()
     print("   ..done.")
+
+if '--migrate-arrays' in sys.argv:
+    # rewrite legacy np.save array blobs using the compact array codec
+    print("Migrating array columns in %s.." % synphys_db)
+    counts = db.migrate_array_columns()
+    for table, n in counts.items():
+        print("   %s: %d rows rewritten" % (table, n))
+    print("   ..done.")
@@ -2,19 +2,20 @@ from __future__ import print_function
 
 import os, sys, time, glob, argparse
 import multiprocessing
+from functools import partial
 
 import pyqtgraph as pg
 pg.dbg()
 
 from multipatch_analysis.database.submission import SliceSubmission, ExperimentDBSubmission
 from multipatch_analysis.database import database
-from multipatch_analysis import config, synphys_cache, experiment_list, constants
+from multipatch_analysis import config, synphys_cache, experiment_list, constants, qc
 
 
 all_expts = experiment_list.cached_experiments()
 
 
-def submit_expt(expt_id, raise_exc=False):
+def submit_expt(expt_id, raise_exc=False, sweep_workers=None, bulk=True, stream=False, max_rss=None):
     # print(os.getpid(), expt_id, "start")
     try:
         expt = all_expts[expt_id]
@@ -31,11 +32,16 @@ def submit_expt(expt_id, raise_exc=False):
         
         print("submit experiment:")
         print("    ", expt)
-        sub = ExperimentDBSubmission(expt)
+        sub = ExperimentDBSubmission(expt, workers=sweep_workers, bulk=bulk, stream=stream, max_rss=max_rss)
         if sub.submitted():
             print("   already in DB")
         else:
             sub.submit()
+            print("    %s" % sub.timing_report())
+            print("    %s" % sub.memory_report())
+            if qc.profile is not None:
+                print("    qc: %s" % qc.profile_report())
+                qc.enable_profile()
 
         print("    %g sec" % (time.time()-start))
     except Exception:
@@ -47,16 +53,53 @@ def submit_expt(expt_id, raise_exc=False):
     # print(os.getpid(), expt_id, "return")
 
 
+def benchmark_insert(expt, sweep_workers=None):
+    """Import one experiment twice, once through the ORM and once with bulk COPY,
+    and print the timing for each. Both transactions are rolled back.
+    """
+    print("benchmark experiment:", expt)
+    for bulk in (False, True):
+        sub = ExperimentDBSubmission(expt, workers=sweep_workers, bulk=bulk)
+        if sub.submitted():
+            print("   already in DB; skipping")
+            return
+        session = database.Session()
+        try:
+            start = time.time()
+            sub.create(session)
+            print("    %s: %0.2f sec" % ('bulk' if bulk else 'orm', time.time() - start))
+            print("        %s" % sub.timing_report())
+        finally:
+            session.rollback()
+            session.close()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--limit', type=int, default=None)
     parser.add_argument('--local', action='store_true', default=False)
     parser.add_argument('--workers', type=int, default=6)
+    parser.add_argument('--sweep-workers', type=int, default=None, dest='sweep_workers',
+                        help='Number of processes used to analyze sweeps within each experiment (only with --local)')
     parser.add_argument('--uid', type=str, default=None)
     parser.add_argument('--ex-only', action='store_true', default=False, dest='ex_only', help='Only import experiments with excitatory types')
+    parser.add_argument('--orm-insert', action='store_true', default=False, dest='orm_insert',
+                        help='Insert pulse responses / baselines through the ORM rather than bulk COPY')
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help='Load and release one sweep at a time to limit memory usage')
+    parser.add_argument('--max-rss', type=float, default=None, dest='max_rss',
+                        help='Soft memory budget (MB) per import process; pending entries are flushed when exceeded')
+    parser.add_argument('--benchmark', action='store_true', default=False,
+                        help='Compare ORM and bulk insert times for the selected experiments without committing')
+    parser.add_argument('--qc-profile', action='store_true', default=False, dest='qc_profile',
+                        help='Report the time spent in each QC check for every imported experiment')
     parser.add_argument('--raise-exc', action='store_true', default=False, dest='raise_exc', help='Do not ignore exceptions')
     
     args, extra = parser.parse_known_args(sys.argv[1:])
+    max_rss = None if args.max_rss is None else int(args.max_rss * 1e6)
+    submit_opts = dict(bulk=not args.orm_insert, stream=args.stream, max_rss=max_rss)
+    if args.qc_profile:
+        qc.enable_profile()
     
     if args.uid is not None:
         selected_expts = [all_expts[uid] for uid in args.uid.split(',')]
@@ -88,9 +131,12 @@ if __name__ == '__main__':
           (len(all_expts), len(selected_expts)))
     print([ex.uid for ex in selected_expts])
     
-    if args.local is True:
+    if args.benchmark:
+        for expt in selected_expts:
+            benchmark_insert(expt, sweep_workers=args.sweep_workers)
+    elif args.local is True:
         for i, expt in enumerate(selected_expts):
-            submit_expt(expt.uid, raise_exc=args.raise_exc)
+            submit_expt(expt.uid, raise_exc=args.raise_exc, sweep_workers=args.sweep_workers, **submit_opts)
     else:
         ids = [expt.uid for expt in selected_expts]
 
@@ -99,5 +145,6 @@ if __name__ == '__main__':
         # http://docs.sqlalchemy.org/en/rel_1_0/faq/connections.html#how-do-i-use-engines-connections-sessions-with-python-multiprocessing-or-os-fork
         database.engine.dispose()
         
+        # (pool workers are daemonic and cannot start their own sweep pools)
         pool = multiprocessing.Pool(processes=args.workers, maxtasksperchild=1)
-        pool.map(submit_expt, ids, chunksize=1)  # note: maxtasksperchild is broken unless we also force chunksize
+        pool.map(partial(submit_expt, **submit_opts), ids, chunksize=1)  # note: maxtasksperchild is broken unless we also force chunksize
@@ -16,11 +16,13 @@ rsync itself, but in practice this presents a few difficult issues:
   subprocessing, CLI flag generation, and fragile pipe communication.
 """
 
-import os, sys, shutil, glob, traceback, pickle, time
+import os, sys, shutil, glob, traceback, pickle, time, json, hashlib, sqlite3
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from acq4.util.DataManager import getDirHandle
 
 from multipatch_analysis import config
-from multipatch_analysis.util import sync_file
+from multipatch_analysis.util import sync_files
 
 
 class RawDataSubmission(object):
@@ -28,9 +30,11 @@ class RawDataSubmission(object):
     """
     message = "Copying data to server"
     
-    def __init__(self, site_dh):
+    def __init__(self, site_dh, manifest=None):
         self.changes = None
         self.site_dh = site_dh
+        self.manifest = manifest
+        self.synced_files = []
         
     def check(self):
         return [], []
@@ -47,6 +51,12 @@ class RawDataSubmission(object):
         now = time.strftime('%Y-%m-%d_%H:%M:%S')
         self.log("========== %s : Sync %s to server" % (now, site_dh.name()))
         self.skipped = 0
+        self.synced_files = []
+        # interrupted syncs are tracked in the local manifest even when file skipping is not used
+        pending = self.manifest if self.manifest is not None else SyncManifest(trust_files=False)
+        pending.set_site_pending(site_dh.name(), True)
+        # record directory state before copying so that changes made during the sync are seen next time
+        dir_mtimes = site_dir_mtimes(site_dh.name())
         
         try:
             # Decide how the top-level directory will be named on the remote server
@@ -70,6 +80,9 @@ class RawDataSubmission(object):
             
             # Leave a note about the source of this data
             open(os.path.join(server_site_path, 'sync_source'), 'wb').write(site_dh.name())
+            pending.set_site_pending(site_dh.name(), False)
+            if self.manifest is not None and not any([ch[0] == 'error' for ch in self.changes]):
+                self.manifest.record_site(site_dh.name(), dir_mtimes, self.synced_files)
         except Exception:
             err = traceback.format_exc()
             self.changes.append(('error', site_dh.name(), err))
@@ -86,6 +99,8 @@ class RawDataSubmission(object):
         if not os.path.isdir(target):
             os.mkdir(target)
             self.changes.append(('mkdir', source, target))
+        pairs = []
+        file_infos = {}
         for fname in os.listdir(source):
             src_path = os.path.join(source, fname)
             if os.path.isfile(src_path):
@@ -99,16 +114,36 @@ class RawDataSubmission(object):
                     self.log("    err! %s => %s" % (src_path, dst_path))
                     self.changes.append(('error', src_path, 'file too large'))
                     continue
-                
-                status = sync_file(src_path, dst_path)
-                if status == 'skip':
+
+                # skip files that are unchanged since they were last synced, without touching the server
+                file_info = (src_path, src_stat.st_size, src_stat.st_mtime)
+                if self.manifest is not None and self.manifest.file_synced(*file_info):
                     self.skipped += 1
-                elif status == 'copy':
-                    self.log("    copy %s => %s" % (src_path, dst_path))
-                    self.changes.append(('copy', src_path, dst_path))
-                elif status == 'update':
-                    self.log("    updt %s => %s" % (src_path, dst_path))
-                    self.changes.append(('update', src_path, dst_path))
+                    self.synced_files.append(file_info)
+                    continue
+                
+                pairs.append((src_path, dst_path))
+                file_infos[src_path] = file_info
+
+        # copy several files at once
+        results = sync_files(pairs, workers=config.sync_copy_workers, max_rate=config.sync_max_rate, report=self.log)
+        errors = []
+        for (src_path, dst_path), (status, exc) in zip(pairs, results):
+            if exc is not None:
+                self.log("    err! %s => %s: %r" % (src_path, dst_path, exc))
+                errors.append(exc)
+                continue
+            self.synced_files.append(file_infos[src_path])
+            if status == 'skip':
+                self.skipped += 1
+            elif status == 'copy':
+                self.log("    copy %s => %s" % (src_path, dst_path))
+                self.changes.append(('copy', src_path, dst_path))
+            elif status == 'update':
+                self.log("    updt %s => %s" % (src_path, dst_path))
+                self.changes.append(('update', src_path, dst_path))
+        if len(errors) > 0:
+            raise errors[0]
 
 
 def get_experiment_server_path(dh):
@@ -195,9 +230,9 @@ def write_expt_path_cache():
     os.rename(tmp, cache_file)
     
 
-def sync_experiment(site_dir):
+def sync_experiment(site_dir, manifest=None):
     dh = getDirHandle(site_dir)
-    sub = RawDataSubmission(dh)
+    sub = RawDataSubmission(dh, manifest=manifest)
     err, warn = sub.check()
     if len(err) > 0:
         return [], err, warn
@@ -211,16 +246,164 @@ def find_all_sites(root):
     return sites
     
 
-def sync_all(log):
-    for raw_data_path in config.raw_data_paths:
-        paths = find_all_sites(raw_data_path)
-        sync_paths(paths, log)
+def sync_all(log, full=False, scan_workers=8):
+    """Sync all sites found in config.raw_data_paths.
+
+    Unless *full* is True, sites whose directories and files are unchanged since their last
+    successful sync (according to the local SyncManifest) are skipped.
+    """
+    manifest = SyncManifest(trust_files=not full)
+
+    # first finish any sites that were interrupted during a previous run
+    # (partially copied files are resumed; see util.safe_copy)
+    pending = [site for site in manifest.pending_sites() if os.path.isdir(site)]
+    if len(pending) > 0:
+        print("Resuming %d interrupted site(s)" % len(pending))
+        sync_paths(pending, log, manifest=manifest)
+
+    pool = ThreadPool(scan_workers)
+    try:
+        all_sites = [p for sites in pool.map(find_all_sites, config.raw_data_paths) for p in sites]
+        all_sites = [p for p in all_sites if p not in pending]
+        if full:
+            paths = all_sites
+        else:
+            paths = changed_sites(all_sites, manifest, pool)
+    finally:
+        pool.close()
+        pool.join()
+    print("%d / %d sites changed since last sync" % (len(paths), len(all_sites)))
+    sync_paths(paths, log, manifest=manifest)
+
+
+def site_dir_mtimes(site_dir):
+    """Return the mtimes of the experiment, slice, and site directories containing *site_dir*.
+    """
+    slice_dir = os.path.dirname(site_dir)
+    expt_dir = os.path.dirname(slice_dir)
+    return [os.stat(d).st_mtime for d in (expt_dir, slice_dir, site_dir)]
+
+
+def site_file_listing(site_dir):
+    """Return a list of (path, size, mtime) for all files in the experiment, slice,
+    and site directories containing *site_dir*.
+    """
+    slice_dir = os.path.dirname(site_dir)
+    expt_dir = os.path.dirname(slice_dir)
+    files = []
+    for d in (expt_dir, slice_dir, site_dir):
+        for fname in os.listdir(d):
+            path = os.path.join(d, fname)
+            if os.path.isfile(path):
+                st = os.stat(path)
+                files.append((path, st.st_size, st.st_mtime))
+    return files
+
+
+def listing_hash(files):
+    """Return a hash of the (path, size, mtime) listing in *files*.
+    """
+    return hashlib.md5(json.dumps(sorted(files)).encode('utf8')).hexdigest()
+
+
+def changed_sites(sites, manifest, pool):
+    """Return the subset of *sites* that have changed since the sync recorded in *manifest*.
+
+    A site is unchanged only if its directory mtimes match and the size and mtime of
+    every local file in its experiment/slice/site directories match the recorded
+    listing; the latter catches files that were appended in place, which does not
+    always update the directory mtime. Only local files are stat-ed, concurrently
+    using *pool*.
+    """
+    recorded = manifest.site_records()
+    def changed(site):
+        if site not in recorded:
+            return True
+        dir_mtimes, recorded_hash = recorded[site]
+        try:
+            if site_dir_mtimes(site) != dir_mtimes:
+                return True
+            return listing_hash(site_file_listing(site)) != recorded_hash
+        except OSError:
+            return True
+    return [site for site, ch in zip(sites, pool.map(changed, sites, chunksize=16)) if ch]
+
+
+class SyncManifest(object):
+    """Local record of sites and files that have been synced to the server.
+
+    For each site, the mtimes of its experiment/slice/site directories are recorded,
+    along with a hash of the synced file listing; for each file, its size and mtime.
+    Sites whose sync was started but did not complete are also listed here, so that
+    each rig keeps its own pending list rather than sharing one on the server.
+    This allows unchanged sites to be skipped after checking only local directory
+    and file stats, and unchanged files to be skipped without stat-ing the server copy.
+    Use ``sync_all(full=True)`` (``--full``) to compare everything against the server.
+    If *trust_files* is False, then file_synced() always returns False so that every
+    file is compared against the server, but sites are still recorded.
+    """
+    def __init__(self, filename=None, trust_files=True):
+        if filename is None:
+            filename = os.path.join(os.path.dirname(config.configfile), 'sync_manifest.sqlite')
+        self.filename = filename
+        self.trust_files = trust_files
+        with self._connect() as conn:
+            conn.execute("create table if not exists sites (site_dir text primary key, dir_mtimes text, listing_hash text, sync_time real)")
+            conn.execute("create table if not exists files (path text primary key, site_dir text, size integer, mtime real)")
+            conn.execute("create table if not exists pending (site_dir text primary key, start_time real)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.filename, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def site_records(self):
+        """Return {site_dir: (dir_mtimes, listing_hash)} for all recorded sites.
+        """
+        with self._connect() as conn:
+            rows = conn.execute("select site_dir, dir_mtimes, listing_hash from sites").fetchall()
+        return {site: (json.loads(mtimes), lhash) for site, mtimes, lhash in rows}
+
+    def file_synced(self, path, size, mtime):
+        if not self.trust_files:
+            return False
+        with self._connect() as conn:
+            row = conn.execute("select size, mtime from files where path=?", (path,)).fetchone()
+        return row is not None and tuple(row) == (size, mtime)
+
+    def record_site(self, site_dir, dir_mtimes, files):
+        """Record a successful sync of *site_dir*; *files* is a list of (path, size, mtime).
+        """
+        with self._connect() as conn:
+            conn.execute("insert or replace into sites values (?, ?, ?, ?)", (site_dir, json.dumps(dir_mtimes), listing_hash(files), time.time()))
+            conn.executemany("insert or replace into files values (?, ?, ?, ?)", [(path, site_dir, size, mtime) for path, size, mtime in files])
+
+    def pending_sites(self):
+        """Return the list of site directories whose last sync did not complete.
+        """
+        with self._connect() as conn:
+            rows = conn.execute("select site_dir from pending order by start_time").fetchall()
+        return [row[0] for row in rows]
+
+    def set_site_pending(self, site_dir, pending):
+        """Add or remove *site_dir* from the list of sites whose sync has not completed.
+        """
+        with self._connect() as conn:
+            if pending:
+                conn.execute("insert or replace into pending values (?, ?)", (site_dir, time.time()))
+            else:
+                conn.execute("delete from pending where site_dir=?", (site_dir,))
+
 
 
-def sync_paths(paths, log):
+def sync_paths(paths, log, manifest=None):
     for site_dir in paths:
         try:
-            changes, err, warn = sync_experiment(site_dir)
+            changes, err, warn = sync_experiment(site_dir, manifest=manifest)
             if len(changes) > 0:
                 log.append((site_dir, changes, err, warn))
         except Exception:
@@ -233,10 +416,12 @@ if __name__ == '__main__':
     log = []
     
     paths = sys.argv[1:]
+    full = '--full' in paths
+    paths = [p for p in paths if p != '--full']
     if len(paths) == 0:
-        sync_all(log)
+        sync_all(log, full=full)
     else:
-        sync_paths(paths, log)
+        sync_paths(paths, log, manifest=SyncManifest(trust_files=not full))
     
     errs = [change for site in log for change in site[1] if change[0] == 'error']
     print("\n----- DONE ------\n   %d errors" % len(errs))